@@ -0,0 +1,129 @@
+# ログ出力の非同期化とペイロードの要約
+# ログの書き出しはバックグラウンドスレッドで行い、大きな結果はサイズ・件数だけを残す
+import atexit
+import contextvars
+import hmac
+import logging
+import logging.handlers
+import queue
+import random
+
+# env
+import os
+from dotenv import load_dotenv
+load_dotenv()
+
+# 要約時の文字数上限
+LOG_MAX_CHARS = int(os.getenv("LOG_MAX_CHARS", 300))
+# 全ペイロードを出力するリクエストの割合 (0〜1)
+LOG_PAYLOAD_SAMPLE_RATE = float(os.getenv("LOG_PAYLOAD_SAMPLE_RATE", 0))
+# このヘッダーに管理トークンを付けたリクエストは全ペイロードを出力する (トークン未設定なら無効)
+LOG_PAYLOAD_HEADER = "x-debug-payload"
+LOG_PAYLOAD_TOKEN = os.getenv("LOG_PAYLOAD_TOKEN", os.getenv("PROFILE_ADMIN_TOKEN", ""))
+
+_full_payload = contextvars.ContextVar("full_payload", default=False)
+_listener = None
+_handlers = []  # リスナーが出力する実際のハンドラ
+
+def setup():
+    """root ロガーのハンドラをキュー経由にする (出力はリスナースレッドで行う)"""
+    global _listener, _handlers
+    if _listener is not None:
+        return
+    root = logging.getLogger()
+    handlers = root.handlers[:]
+    if not handlers:
+        handler = logging.StreamHandler()
+        handler.setFormatter(logging.Formatter('[%(asctime)s] %(message)s'))
+        handlers = [handler]
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+    log_queue = queue.SimpleQueue()
+    root.addHandler(logging.handlers.QueueHandler(log_queue))
+    _handlers = handlers
+    _listener = logging.handlers.QueueListener(log_queue, *handlers, respect_handler_level=True)
+    _listener.start()
+    atexit.register(_stop)
+
+def _stop():
+    if _listener is not None:
+        _listener.stop()
+
+def _restart_after_fork():
+    # gunicorn --preload ではマスターで setup() 済みのため、ワーカー側で新しいリスナーを起動する
+    # (親のキューに残っていた記録は親が出力するため、子は新しいキューに差し替える)
+    global _listener
+    if _listener is None:
+        return
+    log_queue = queue.SimpleQueue()
+    for handler in logging.getLogger().handlers:
+        if isinstance(handler, logging.handlers.QueueHandler):
+            handler.queue = log_queue
+    _listener = logging.handlers.QueueListener(log_queue, *_handlers, respect_handler_level=True)
+    _listener.start()
+
+os.register_at_fork(after_in_child=_restart_after_fork)
+
+class PayloadLoggingMiddleware:
+    """リクエストごとに全ペイロード出力の要否を決める ASGI ミドルウェア"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        enabled = LOG_PAYLOAD_SAMPLE_RATE > 0 and random.random() < LOG_PAYLOAD_SAMPLE_RATE
+        if not enabled and LOG_PAYLOAD_TOKEN:
+            header = LOG_PAYLOAD_HEADER.encode()
+            expected = LOG_PAYLOAD_TOKEN.encode()
+            enabled = any(
+                k == header and hmac.compare_digest(v.strip(), expected)
+                for k, v in scope["headers"]
+            )
+        token = _full_payload.set(enabled)
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            _full_payload.reset(token)
+
+def _truncate(text, limit=LOG_MAX_CHARS):
+    if len(text) <= limit:
+        return text
+    return f"{text[:limit]}...({len(text)} chars)"
+
+def _brief(value):
+    # 値の中身は展開せず、型と大きさだけにする
+    if isinstance(value, str):
+        return _truncate(value, 80)
+    if isinstance(value, (bytes, bytearray)):
+        return f"<bytes {len(value)}>"
+    if isinstance(value, list):
+        return f"<list {len(value)}>"
+    if isinstance(value, dict):
+        return f"<dict {len(value)} keys>"
+    return value
+
+def summarize(obj):
+    """ログ用の短い要約"""
+    if hasattr(obj, "model_dump"):
+        obj = obj.model_dump()
+    if isinstance(obj, dict):
+        if "results" in obj:
+            return f"results={len(obj['results'])} matching_results={obj.get('matching_results')}"
+        if "documents" in obj:
+            return f"documents={len(obj['documents'])} matching_results={obj.get('matching_results')}"
+        if "completions" in obj:
+            return f"completions={len(obj['completions'])}"
+        return _truncate(repr({k: _brief(v) for k, v in obj.items()}))
+    if isinstance(obj, str):
+        return _truncate(obj)
+    if isinstance(obj, (bytes, bytearray)):
+        return _brief(obj)
+    return _truncate(repr(obj))
+
+def payload(obj):
+    """デバッグ対象のリクエストなら全体、それ以外は要約を返す"""
+    if _full_payload.get():
+        return repr(obj)
+    return summarize(obj)
@@ -0,0 +1,238 @@
+# オートコンプリート用のローカル前方一致インデックス
+# 取り込んだドキュメントの語句をコレクションごとにソート済み配列で保持する
+# 語句はミラーインデックス (mirror_index) の文書から読み込むため、再起動後や他のワーカーで
+# 取り込んだ文書も含まれる。読み込み済み (warm) のコレクションは Discovery を呼ばずに応答できる
+import bisect
+import heapq
+import re
+import threading
+import time
+from collections import Counter, OrderedDict
+
+# Module files
+import mirror_index as MIRROR
+
+# env
+import os
+from dotenv import load_dotenv
+load_dotenv()
+
+# LOG
+import logging
+logging.basicConfig(format='[%(asctime)s] %(message)s', level=logging.INFO)
+logger = logging.getLogger("LOG")
+
+# 句読点・括弧・空白で区切った語句を候補にする
+_SPLIT = re.compile(r"[\s、。,，.．・:：;；!！?？「」『』（）()\[\]【】<>＜＞/／\"'”“]+")
+MIN_TERM_LEN = 2
+MAX_TERM_LEN = 64
+# Discovery の補完結果を再利用する秒数 (入力中に同じ接頭辞が続く場合の往復を省く)
+AUTOCOMP_UPSTREAM_TTL = float(os.getenv("AUTOCOMP_UPSTREAM_TTL", 60))
+# ミラーインデックスのログに追加された文書を確認する間隔(秒)
+AUTOCOMP_REFRESH_INTERVAL = float(os.getenv("AUTOCOMP_REFRESH_INTERVAL", 5))
+
+def extract_terms(value):
+    terms = []
+    if isinstance(value, list):
+        for v in value:
+            terms.extend(extract_terms(v))
+        return terms
+    if value is None:
+        return terms
+    for term in _SPLIT.split(str(value)):
+        if MIN_TERM_LEN <= len(term) <= MAX_TERM_LEN:
+            terms.append(term)
+    return terms
+
+def entry_terms(entry):
+    """ミラーインデックスの文書 (索引用の本文) から語句を数える"""
+    return Counter(extract_terms(entry["text"])) if entry else Counter()
+
+def document_terms(file):
+    """add_document に渡した file (JSON文字列/辞書/配列) から語句を数える (ミラーインデックスと同じ項目)"""
+    return entry_terms(MIRROR.document_entry(file))
+
+class _Terms:
+    """1コレクション分のソート済み語句と出現数"""
+
+    def __init__(self):
+        self.terms = []  # ソート済み
+        self.counts = {}  # 語句 -> 出現数
+
+    def add(self, counter):
+        for term, n in counter.items():
+            if term in self.counts:
+                self.counts[term] += n
+            else:
+                self.counts[term] = n
+                bisect.insort(self.terms, term)
+
+    def remove(self, counter):
+        for term, n in counter.items():
+            left = self.counts.get(term, 0) - n
+            if left > 0:
+                self.counts[term] = left
+            elif term in self.counts:
+                del self.counts[term]
+                i = bisect.bisect_left(self.terms, term)
+                if i < len(self.terms) and self.terms[i] == term:
+                    del self.terms[i]
+
+    def matches(self, prefix):
+        lo = bisect.bisect_left(self.terms, prefix)
+        hi = bisect.bisect_left(self.terms, prefix + "\U0010ffff", lo)
+        return self.terms[lo:hi]
+
+class PrefixIndex:
+    """コレクションごとのソート済み語句配列 + 出現数による前方一致インデックス"""
+
+    def __init__(self, memo_size=1024, refresh_interval=AUTOCOMP_REFRESH_INTERVAL):
+        self._collections = {}  # collection_id -> _Terms
+        self._docs = {}  # collection_id -> {document_id: Counter}
+        self._memo = OrderedDict()  # (prefix, count, collection_ids) -> 結果
+        self._memo_size = memo_size
+        self._upstream = OrderedDict()  # (prefix, count) -> (期限, Discovery の補完結果)
+        self._lock = threading.Lock()
+        # ミラーインデックスから読み込んだコレクションと、読み終えたログの位置
+        self._positions = {}  # collection_id -> (inode, 位置)
+        self._checked = {}  # collection_id -> 最終確認時刻
+        self._refresh_interval = refresh_interval
+        self._sync_lock = threading.Lock()
+
+    def _put(self, collection_id, document_id, counter):
+        terms = self._collections.setdefault(collection_id, _Terms())
+        docs = self._docs.setdefault(collection_id, {})
+        old = docs.pop(document_id, None)
+        if old:
+            terms.remove(old)
+        if counter:
+            docs[document_id] = counter
+            terms.add(counter)
+
+    def _delete(self, collection_id, document_id):
+        old = self._docs.get(collection_id, {}).pop(document_id, None)
+        if old:
+            self._collections[collection_id].remove(old)
+
+    def add_document(self, collection_id, document_id, file):
+        counter = document_terms(file)
+        with self._lock:
+            self._put(collection_id, document_id, counter)
+            self._memo.clear()
+
+    def remove_document(self, collection_id, document_id):
+        with self._lock:
+            self._delete(collection_id, document_id)
+            self._memo.clear()
+
+    def sync(self, collection_id, mirror):
+        """ミラーインデックスの文書を読み込む (読み込み済みならログに追加された操作だけを反映する)"""
+        now = time.monotonic()
+        with self._sync_lock:
+            if now - self._checked.get(collection_id, float("-inf")) < self._refresh_interval:
+                return
+            position = self._positions.get(collection_id)
+            changes = mirror.changes(collection_id, position) if position is not None else None
+            if changes is not None:
+                ops, position = changes
+                with self._lock:
+                    for rec in ops:
+                        if rec["op"] == "put":
+                            self._put(collection_id, rec["id"], entry_terms(rec))
+                        else:
+                            self._delete(collection_id, rec["id"])
+                    if ops:
+                        self._memo.clear()
+            else:
+                loaded = mirror.entries(collection_id)
+                if loaded is None:
+                    self._checked[collection_id] = now
+                    return
+                docs, position = loaded
+                counters = {doc_id: entry_terms(entry) for doc_id, entry in docs.items()}
+                terms = _Terms()
+                for counter in counters.values():
+                    terms.add(counter)
+                with self._lock:
+                    self._collections[collection_id] = terms
+                    self._docs[collection_id] = {d: c for d, c in counters.items() if c}
+                    self._memo.clear()
+                logger.info(f"autocomp_index: loaded {collection_id} ({len(docs)} docs, {len(terms.terms)} terms)")
+            self._positions[collection_id] = position
+            self._checked[collection_id] = now
+
+    def is_warm(self, collection_ids):
+        """全コレクションの語句をミラーインデックスから読み込み済みか"""
+        return bool(collection_ids) and all(c in self._positions for c in collection_ids)
+
+    def complete(self, prefix, count=5, collection_ids=None):
+        """出現数の多い順に前方一致する語句を返す (collection_ids 省略時は全コレクション, 該当なしは空配列)"""
+        if not prefix:
+            return []
+        key = (prefix, count, tuple(collection_ids) if collection_ids else None)
+        with self._lock:
+            hit = self._memo.get(key)
+            if hit is not None:
+                self._memo.move_to_end(key)
+                return hit
+            counts = {}
+            for collection_id in (collection_ids or list(self._collections)):
+                terms = self._collections.get(collection_id)
+                if terms is None:
+                    continue
+                for term in terms.matches(prefix):
+                    counts[term] = counts.get(term, 0) + terms.counts[term]
+            top = heapq.nlargest(count, counts, key=lambda t: (counts[t], -len(t)))
+            self._memo[key] = top
+            if len(self._memo) > self._memo_size:
+                self._memo.popitem(last=False)
+            return top
+
+    def upstream(self, prefix, count):
+        """期限内の Discovery の補完結果 (無ければ None)"""
+        key = (prefix, count)
+        with self._lock:
+            hit = self._upstream.get(key)
+            if hit is None or hit[0] < time.monotonic():
+                return None
+            self._upstream.move_to_end(key)
+            return hit[1]
+
+    def set_upstream(self, prefix, count, completions):
+        key = (prefix, count)
+        with self._lock:
+            self._upstream[key] = (time.monotonic() + AUTOCOMP_UPSTREAM_TTL, completions)
+            self._upstream.move_to_end(key)
+            if len(self._upstream) > self._memo_size:
+                self._upstream.popitem(last=False)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "terms": sum(len(t.terms) for t in self._collections.values()),
+                "documents": sum(len(d) for d in self._docs.values()),
+                "warm": sorted(self._positions),
+                "memo": len(self._memo),
+                "upstream_memo": len(self._upstream),
+            }
+
+def merge(upstream, local, count):
+    """Discovery の補完結果を優先し、ローカルの語句で不足分を補う (重複は除く)"""
+    ret = []
+    for value in list(upstream) + list(local):
+        if value not in ret:
+            ret.append(value)
+        if len(ret) >= count:
+            break
+    return ret
+
+prefix_index = PrefixIndex()
+
+def sync(collection_ids):
+    """指定したコレクションの語句をミラーインデックスから読み込む"""
+    for collection_id in collection_ids:
+        prefix_index.sync(collection_id, MIRROR.mirror_index)
+
+def warmup():
+    """起動時にミラーインデックスにある全コレクションの語句を読み込む"""
+    sync(MIRROR.mirror_index.collections())
@@ -0,0 +1,326 @@
+# Excel比較フローのサーバ側バッチ処理
+# 行ごとの WD検索 + AI判定 を並列に実行し、完了した行から NDJSON で返す
+import asyncio
+import json
+import os
+import re
+from typing import AsyncGenerator
+
+import orjson
+
+# Module files
+import local_judge as LOCAL
+import projection as PROJECTION
+import req_wxai as GEN
+import wd_async as WDASYNC
+import xlsx_stream as XLSX
+
+# LOG
+import logging
+logging.basicConfig(format='[%(asctime)s] %(message)s', level=logging.INFO)
+logger = logging.getLogger("LOG")
+
+# 1リクエストあたりの同時処理行数の上限
+BATCH_MAX_CONCURRENCY = int(os.getenv("BATCH_MAX_CONCURRENCY", 8))
+BATCH_DEFAULT_CONCURRENCY = int(os.getenv("BATCH_DEFAULT_CONCURRENCY", 4))
+
+# 1行あたりの候補数(優先度1〜3)
+MAX_CANDIDATES = 3
+
+# watson-exec.js の prompts と同じ構成のプロンプトテンプレート
+DEFAULT_PROMPTS = {
+    "system": (
+        '\n\n# 命令\nあなたは、与えられた"[要件]"の項目が、"[検索する機能]"と一致するかを判定するAIです。\n'
+        '以下の"# ルール"と"# 出力形式"に厳密に従い、判定結果を生成してください。\n\n'
+        '# ルール\n1.  "[要件]"に含まれるJSONオブジェクトを評価します。\n'
+        '2.  **"judge"**の値は、評価対象オブジェクトの**"回答"キーの値（◯または×または△）を最優先**とし、そのまま反映させます。\n'
+        '3.  **"score"**の値は、"要件"と"[検索する機能]"の**文言の一致度**を**0から100の整数**で評価して設定してください。\n'
+        '4.  "reason"には、文言の一致度と、その理由を簡潔に記述します。\n'
+        '5.  全ての評価結果を、単一のJSONにまとめてください。\n\n'
+        '# 出力形式 (JSONの例)\n{\n  "judge": "◯",\n  "score": 85,\n  "reason": "文言が大きく一致しており、信頼度は高いです"\n}\n\n'
+        '# 最重要ルール\n-   **出力は、後述の"# 出力形式"に合致する単一で有効なJSONのみとしてください。**\n'
+        '-   **出力は ```json  から始まり ``` で終わること。**\n\n'
+    ),
+    "search_item": "# 入力データ\n[検索する機能]: ",
+    "search_list": "[要件]:\n",
+    "result_title": "\n[判定結果]:\n",
+}
+
+# 1行の候補をまとめて1つのプロンプトで判定する場合のテンプレート
+MULTI_PROMPTS = {
+    "system": (
+        '\n\n# 命令\nあなたは、与えられた"[要件一覧]"の各項目が、"[検索する機能]"と一致するかを判定するAIです。\n'
+        '以下の"# ルール"と"# 出力形式"に厳密に従い、判定結果を生成してください。\n\n'
+        '# ルール\n1.  "[要件一覧]"はJSONオブジェクトの配列です。各要素を順番に評価します。\n'
+        '2.  **"judge"**の値は、評価対象オブジェクトの**"回答"キーの値（◯または×または△）を最優先**とし、そのまま反映させます。\n'
+        '3.  **"score"**の値は、"要件"と"[検索する機能]"の**文言の一致度**を**0から100の整数**で評価して設定してください。\n'
+        '4.  "reason"には、文言の一致度と、その理由を簡潔に記述します。\n'
+        '5.  評価結果は、入力と同じ順序・同じ件数のJSON配列にまとめてください。\n\n'
+        '# 出力形式 (JSONの例)\n[\n  {\n    "judge": "◯",\n    "score": 85,\n    "reason": "文言が大きく一致しており、信頼度は高いです"\n  }\n]\n\n'
+        '# 最重要ルール\n-   **出力は、後述の"# 出力形式"に合致する単一で有効なJSON配列のみとしてください。**\n'
+        '-   **出力は ```json  から始まり ``` で終わること。**\n\n'
+    ),
+    "search_item": "# 入力データ\n[検索する機能]: ",
+    "search_list": "[要件一覧]:\n",
+    "result_title": "\n[判定結果]:\n",
+}
+
+# 独自の prompts から multi 用のプロンプトを作るときに system の末尾へ加える指示
+MULTI_INSTRUCTION = (
+    '# 複数件の判定\n-   "[要件]"はJSONオブジェクトの配列です。各要素を上記のルールで順番に評価し、'
+    '入力と同じ順序・同じ件数のJSON配列 (各要素は上記の出力形式のJSON) を出力してください。\n\n'
+)
+
+def derive_multi_prompts(prompts):
+    """候補ごとのプロンプト (prompts) を、候補をまとめて判定するプロンプトにする"""
+    if prompts == DEFAULT_PROMPTS:
+        return dict(MULTI_PROMPTS)
+    return {**prompts, "system": prompts["system"] + MULTI_INSTRUCTION}
+
+# 判定方法
+#   multi : 1行の候補を1つのプロンプトにまとめる (解析できなければ batch で再判定)
+#   batch : 候補ごとのプロンプトを1回の generate 呼び出しで送る
+#   single: 候補ごとに /gen と同じ呼び出しを行う
+JUDGE_MODES = ("multi", "batch", "single")
+
+DEFAULT_LLM_OPTIONS = {
+    "decoding_method": "greedy",
+    "min_new_tokens": 10,
+    "max_new_tokens": 300,
+    # シートの再実行ではディスクキャッシュの結果を使う
+    "cache": True,
+}
+
+_JSON_BLOCK = re.compile(r"```json([\s\S]*?)```")
+
+def extract_json(text):
+    """LLM応答の最後の ```json ブロックを取り出す"""
+    if not isinstance(text, str):
+        return None
+    matches = _JSON_BLOCK.findall(text)
+    if matches:
+        return matches[-1].strip()
+    return None
+
+def get_item_confidence(item):
+    """検索結果の先頭パッセージの回答信頼度(excel.html の getItemConfidence と同じ)"""
+    passages = item.get("document_passages") or []
+    if passages and passages[0].get("answers"):
+        return passages[0]["answers"][0].get("confidence", 0)
+    return 0
+
+def judge_input(candidate):
+    return {
+        "要件": candidate.get("要件"),
+        "カテゴリ": candidate.get("カテゴリ"),
+        "回答": candidate.get("回答"),
+    }
+
+def build_prompt(prompts, query, candidate):
+    wd_result = judge_input(candidate)
+    return (
+        f'{prompts["system"]}{prompts["search_item"]}{query}\n\n'
+        f'{prompts["search_list"]}\n{json.dumps(wd_result, ensure_ascii=False)}\n\n'
+        f'{prompts["result_title"]}'
+    )
+
+def build_multi_prompt(prompts, query, candidates):
+    wd_results = [judge_input(c) for c in candidates]
+    return (
+        f'{prompts["system"]}{prompts["search_item"]}{query}\n\n'
+        f'{prompts["search_list"]}\n{json.dumps(wd_results, ensure_ascii=False)}\n\n'
+        f'{prompts["result_title"]}'
+    )
+
+def parse_multi_result(ret_text, count):
+    """JSON配列の判定結果を解析する (件数が合わなければ None)"""
+    extjson_str = extract_json(ret_text)
+    if not extjson_str:
+        return None
+    try:
+        results = json.loads(extjson_str)
+    except json.JSONDecodeError:
+        return None
+    if not isinstance(results, list) or len(results) != count:
+        return None
+    if not all(isinstance(r, dict) for r in results):
+        return None
+    return results
+
+def parse_ai_result(ret_text):
+    if not ret_text:
+        return {"judge": "Error", "reason": "AIからの応答がありません", "score": 0}
+    extjson_str = extract_json(ret_text)
+    if extjson_str:
+        try:
+            return json.loads(extjson_str)
+        except json.JSONDecodeError as e:
+            logger.error(f"AI応答のJSON解析エラー: {str(e)}")
+            return {"judge": "Error", "reason": "AIの応答形式が不正です", "score": 0}
+    return {"judge": "Error", "reason": "AIからの応答がありません", "score": 0}
+
+class BatchJudge:
+    """/batch/judge の1リクエスト分の設定と処理"""
+
+    def __init__(self, data, rows=None):
+        self.rows = rows if rows is not None else (data.get("rows") or [])
+        self.wd_params = data.get("wd_params") or {}
+        self.threshold = float(data.get("confidence_threshold", 0)) / 100
+        self.judge = bool(data.get("judge", True))
+        # 返却する候補の項目 (未指定なら全項目)
+        self.fields = data.get("fields")
+        self.prompts = {**DEFAULT_PROMPTS, **(data.get("prompts") or {})}
+        # multi_prompts の指定が無ければ prompts から作る (独自の prompts を multi でも使う)
+        self.multi_prompts = {
+            **derive_multi_prompts(self.prompts), **(data.get("multi_prompts") or {})
+        }
+        self.judge_mode = data.get("judge_mode") or "multi"
+        # local_judge: judge / score を文字 n-gram の一致度で決め、曖昧な候補だけLLMで判定する
+        # reason: 理由文をLLMに書かせる (local_judge 指定時も全候補をLLMで判定する)
+        self.local_judge = bool(data.get("local_judge", False))
+        self.reason = bool(data.get("reason", not self.local_judge))
+        llm = {**DEFAULT_LLM_OPTIONS, **(data.get("llm") or {})}
+        llm.setdefault("modelname", GEN.DEFAULT_MODEL)
+        self.llm = llm
+        concurrency = int(data.get("concurrency") or BATCH_DEFAULT_CONCURRENCY)
+        self.concurrency = max(1, min(concurrency, BATCH_MAX_CONCURRENCY))
+
+    def validate(self):
+        if isinstance(self.rows, list) and not self.rows:
+            raise ValueError("rows is required")
+        if not self.wd_params.get("collection_ids"):
+            raise ValueError("wd_params.collection_ids is required")
+        if self.judge_mode not in JUDGE_MODES:
+            raise ValueError(f"judge_mode must be one of {JUDGE_MODES}")
+
+    async def search(self, row):
+        query = str(row.get("検索要件") or "").replace("\n", "")
+        params = {**self.wd_params, "natural_language_query": query}
+        ret = await WDASYNC.call_wdsearch(params)
+        results = [
+            res for res in (ret or {}).get("results", [])
+            if get_item_confidence(res) >= self.threshold
+        ]
+        return [PROJECTION.project(res, self.fields) for res in results[:MAX_CANDIDATES]]
+
+    async def judge_candidate(self, query, candidate):
+        params = GEN.Params(**{
+            **self.llm,
+            "prompt": build_prompt(self.prompts, query, candidate),
+        })
+        ret_text = await GEN.acall_genai(params)
+        return parse_ai_result(ret_text)
+
+    async def judge_batch(self, query, candidates):
+        params = GEN.BatchParams(**{
+            **self.llm,
+            "prompts": [build_prompt(self.prompts, query, c) for c in candidates],
+        })
+        ret_texts = await GEN.acall_genai_batch(params)
+        return [parse_ai_result(text) for text in ret_texts]
+
+    async def judge_multi(self, query, candidates):
+        if len(candidates) == 1:
+            return [await self.judge_candidate(query, candidates[0])]
+        # 出力トークンは候補数に比例させる
+        params = GEN.Params(**{
+            **self.llm,
+            "max_new_tokens": self.llm["max_new_tokens"] * len(candidates),
+            "prompt": build_multi_prompt(self.multi_prompts, query, candidates),
+        })
+        ret_text = await GEN.acall_genai(params)
+        results = parse_multi_result(ret_text, len(candidates))
+        if results is None:
+            logger.info("batch_judge: 一括判定の応答を解析できないため候補ごとに判定します")
+            return await self.judge_batch(query, candidates)
+        return results
+
+    async def judge_candidates(self, query, candidates):
+        if not candidates:
+            return []
+        if self.local_judge and not self.reason:
+            return await self.judge_local(query, candidates)
+        return await self.judge_llm(query, candidates)
+
+    async def judge_local(self, query, candidates):
+        results = LOCAL.judge_pairs(query, candidates)
+        ambiguous = [c for c, r in zip(candidates, results) if r is None]
+        if ambiguous:
+            llm_results = iter(await self.judge_llm(query, ambiguous))
+            results = [r if r is not None else next(llm_results) for r in results]
+        return results
+
+    async def judge_llm(self, query, candidates):
+        if self.judge_mode == "multi":
+            return await self.judge_multi(query, candidates)
+        if self.judge_mode == "batch":
+            return await self.judge_batch(query, candidates)
+        return await asyncio.gather(
+            *[self.judge_candidate(query, c) for c in candidates]
+        )
+
+    async def process_row(self, row):
+        row = dict(row)
+        if (row.get("wditem1") or {}).get("id"):
+            # 検索済みの行は既存の候補を使う
+            candidates = [row.get(f"wditem{i}") or {} for i in range(1, MAX_CANDIDATES + 1)]
+        else:
+            results = await self.search(row)
+            candidates = [
+                results[i] if i < len(results) else {}
+                for i in range(MAX_CANDIDATES)
+            ]
+
+        if self.judge:
+            query = row.get("検索要件")
+            targets = [c for c in candidates if c and c.get("要件")]
+            ai_results = await self.judge_candidates(query, targets)
+            for candidate, ai_result in zip(targets, ai_results):
+                candidate["ai_result"] = ai_result
+
+        for i, candidate in enumerate(candidates, start=1):
+            row[f"wditem{i}"] = candidate
+        return row
+
+    async def run_row(self, index, row, semaphore):
+        async with semaphore:
+            try:
+                return {"index": index, "row": await self.process_row(row)}
+            except Exception as e:
+                logger.error(f"batch_judge 行エラー (index: {index}): {str(e)}")
+                return {
+                    "index": index,
+                    "error": str(e),
+                    "row": {**row, "wditem1": {"ai_result": {"judge": "エラー", "reason": str(e)}}},
+                }
+
+    async def stream(self) -> AsyncGenerator[str, None]:
+        """完了した行から順に NDJSON の1行として返す"""
+        logger.info(f"batch_judge: concurrency={self.concurrency}")
+        semaphore = asyncio.Semaphore(self.concurrency)
+        pending = set()
+        count = 0
+        try:
+            # 行はイテレータでも受け付け、同時に保持するタスク数を抑える
+            # シートから読む行はスレッドで読み進め、イベントループを止めない
+            index = -1
+            async for row in XLSX.aiter_rows(self.rows):
+                index += 1
+                pending.add(asyncio.create_task(self.run_row(index, row, semaphore)))
+                if len(pending) >= self.concurrency * 2:
+                    finished, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                    for task in finished:
+                        count += 1
+                        yield orjson.dumps(task.result()) + b"\n"
+            while pending:
+                finished, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in finished:
+                    count += 1
+                    yield orjson.dumps(task.result()) + b"\n"
+            yield json.dumps({"done": True, "count": count}, ensure_ascii=False) + "\n"
+        finally:
+            # クライアント切断時は未処理の行をキャンセルする
+            for task in pending:
+                task.cancel()
+            if pending:
+                logger.info(f"batch_judge: 中断 (完了 {count} 件)")
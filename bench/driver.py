@@ -0,0 +1,201 @@
+# ベンチマークの負荷ドライバ
+# 要件シート (xlsx) の行を /wdsearch, /gen, /stream, 取り込み (/wdbulkadd) に流し、
+# エンドポイントごとのスループットと p50/p95/p99 レイテンシを記録する
+#
+#   python bench/driver.py --base-url http://localhost:8000 --sheet 要件.xlsx --collection-id bench
+#
+# 結果は bench/results/<label>.json に保存し、前回の結果と比較して悪化した項目を表示する
+import argparse
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import time
+from datetime import datetime
+
+import httpx
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import xlsx_stream as XLSX
+
+ENDPOINTS = ("wdsearch", "gen", "stream", "import")
+RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "results")
+# 前回より p95 がこの割合以上遅くなったら悪化として表示する
+REGRESSION_RATIO = 1.10
+
+def load_queries(sheet, limit):
+    """シートの 検索要件 (なければ 要件) を取り出す。シート未指定なら合成した文を使う"""
+    if not sheet:
+        return [f"日報データから月報データを作成すること ({i})" for i in range(limit)]
+    queries = []
+    for row in XLSX.iter_row_objects(sheet):
+        text = str(row.get("検索要件") or row.get("要件") or "").replace("\n", "")
+        if text:
+            queries.append(text)
+        if len(queries) >= limit:
+            break
+    return queries
+
+def load_import_rows(sheet, limit):
+    if not sheet:
+        return [{"要件": q, "カテゴリ": "bench", "回答": "◯"} for q in load_queries(None, limit)]
+    rows = XLSX.to_import_rows(XLSX.iter_row_objects(sheet), XLSX.sheet_name(sheet), os.path.basename(sheet))
+    return [row for _, row in zip(range(limit), rows)]
+
+class Recorder:
+    def __init__(self):
+        self.latencies = {}  # endpoint -> [秒]
+        self.first_byte = {}  # endpoint -> [秒] (ストリーミングのみ)
+        self.errors = {}
+        self.elapsed = {}
+
+    def add(self, endpoint, seconds, ok, first_byte=None):
+        self.latencies.setdefault(endpoint, []).append(seconds)
+        if first_byte is not None:
+            self.first_byte.setdefault(endpoint, []).append(first_byte)
+        if not ok:
+            self.errors[endpoint] = self.errors.get(endpoint, 0) + 1
+
+    def report(self):
+        ret = {}
+        for endpoint, values in self.latencies.items():
+            ms = np.array(values) * 1000
+            entry = {
+                "requests": len(values),
+                "errors": self.errors.get(endpoint, 0),
+                "throughput": round(len(values) / self.elapsed[endpoint], 2),
+                "p50": round(float(np.percentile(ms, 50)), 1),
+                "p95": round(float(np.percentile(ms, 95)), 1),
+                "p99": round(float(np.percentile(ms, 99)), 1),
+            }
+            if endpoint in self.first_byte:
+                fb = np.array(self.first_byte[endpoint]) * 1000
+                entry["ttfb_p50"] = round(float(np.percentile(fb, 50)), 1)
+                entry["ttfb_p95"] = round(float(np.percentile(fb, 95)), 1)
+            ret[endpoint] = entry
+        return ret
+
+async def timed_post(client, recorder, endpoint, url, body, stream=False):
+    start = time.perf_counter()
+    first = None
+    try:
+        if stream:
+            async with client.stream("POST", url, json=body) as res:
+                async for _ in res.aiter_bytes():
+                    if first is None:
+                        first = time.perf_counter() - start
+                ok = res.status_code == 200
+        else:
+            res = await client.post(url, json=body)
+            ok = res.status_code == 200 and "error" not in res.text[:200]
+    except httpx.HTTPError:
+        ok = False
+    recorder.add(endpoint, time.perf_counter() - start, ok, first)
+
+def requests_for(endpoint, args, queries, import_rows):
+    """エンドポイントごとに送るリクエスト (URL, 本文, ストリーミングか) の一覧"""
+    if endpoint == "wdsearch":
+        return [("/wdsearch", {
+            "collection_ids": [args.collection_id], "count": 3, "natural_language_query": q,
+        }, False) for q in queries]
+    if endpoint in ("gen", "stream"):
+        return [(f"/{endpoint}", {
+            "prompt": q, "decoding_method": "greedy", "min_new_tokens": 10, "max_new_tokens": 60,
+        }, endpoint == "stream") for q in queries]
+    # 取り込みは import.html の「1行ずつ登録」と同じく行をまとめて /wdbulkadd に送る
+    chunks = [import_rows[i:i + args.import_chunk] for i in range(0, len(import_rows), args.import_chunk)]
+    return [("/wdbulkadd", {
+        "collection_id": args.collection_id, "filename": "bench.xlsx", "rows": chunk,
+    }, True) for chunk in chunks]
+
+async def run_endpoint(client, recorder, endpoint, items, concurrency):
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def one(item):
+        async with semaphore:
+            await timed_post(client, recorder, endpoint, *item)
+
+    start = time.perf_counter()
+    await asyncio.gather(*[one(item) for item in items])
+    recorder.elapsed[endpoint] = time.perf_counter() - start
+
+async def run(args):
+    queries = load_queries(args.sheet, args.requests)
+    import_rows = load_import_rows(args.sheet, args.requests)
+    recorder = Recorder()
+    timeout = httpx.Timeout(args.timeout)
+    limits = httpx.Limits(max_connections=args.concurrency * 2)
+    async with httpx.AsyncClient(base_url=args.base_url, timeout=timeout, limits=limits) as client:
+        # 取り込みを先に行い、検索対象の文書を用意する
+        for endpoint in sorted(args.endpoints, key=lambda e: e != "import"):
+            items = requests_for(endpoint, args, queries, import_rows)
+            print(f"{endpoint}: {len(items)} requests (concurrency {args.concurrency})")
+            await run_endpoint(client, recorder, endpoint, items, args.concurrency)
+    return recorder.report()
+
+def git_label():
+    try:
+        return subprocess.run(
+            ["git", "describe", "--always", "--dirty"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+def previous_result(directory, exclude):
+    files = sorted(
+        (os.path.join(directory, f) for f in os.listdir(directory) if f.endswith(".json")),
+        key=os.path.getmtime,
+    )
+    files = [f for f in files if f != exclude]
+    if not files:
+        return None
+    with open(files[-1], "r", encoding="utf-8") as f:
+        return json.load(f)
+
+def print_report(report, previous):
+    header = f"{'endpoint':<10}{'req':>6}{'err':>5}{'req/s':>9}{'p50':>9}{'p95':>9}{'p99':>9}"
+    print(header)
+    for endpoint, r in report["endpoints"].items():
+        line = f"{endpoint:<10}{r['requests']:>6}{r['errors']:>5}{r['throughput']:>9}{r['p50']:>9}{r['p95']:>9}{r['p99']:>9}"
+        prev = (previous or {}).get("endpoints", {}).get(endpoint)
+        if prev and prev["p95"] > 0 and r["p95"] > prev["p95"] * REGRESSION_RATIO:
+            line += f"  <- p95 悪化 ({prev['p95']} -> {r['p95']}, {previous['label']})"
+        print(line)
+
+def main():
+    parser = argparse.ArgumentParser(description="Load driver for server.py")
+    parser.add_argument("--base-url", default="http://localhost:8000")
+    parser.add_argument("--sheet", help="要件シート (xlsx)。未指定なら合成した要件を使う")
+    parser.add_argument("--collection-id", default="bench")
+    parser.add_argument("--endpoints", default=",".join(ENDPOINTS))
+    parser.add_argument("--requests", type=int, default=200, help="エンドポイントごとの件数 (シートの行数が上限)")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--import-chunk", type=int, default=20)
+    parser.add_argument("--timeout", type=float, default=120)
+    parser.add_argument("--label", default=None, help="結果の名前 (既定: git describe)")
+    parser.add_argument("--out", default=RESULTS_DIR)
+    args = parser.parse_args()
+    args.endpoints = [e for e in args.endpoints.split(",") if e]
+    unknown = set(args.endpoints) - set(ENDPOINTS)
+    if unknown:
+        parser.error(f"unknown endpoints: {', '.join(sorted(unknown))}")
+
+    label = args.label or git_label()
+    report = {
+        "label": label,
+        "date": datetime.now().isoformat(timespec="seconds"),
+        "settings": {k: getattr(args, k) for k in ("requests", "concurrency", "import_chunk", "sheet")},
+        "endpoints": asyncio.run(run(args)),
+    }
+    os.makedirs(args.out, exist_ok=True)
+    path = os.path.join(args.out, f"{label}.json")
+    previous = previous_result(args.out, path)
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print_report(report, previous)
+    print(f"saved: {path}")
+
+if __name__ == "__main__":
+    main()
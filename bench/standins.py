@@ -0,0 +1,239 @@
+# ベンチマーク用の Discovery / watsonx.ai / IAM の代替サーバ
+# 本番のクラウド資格情報なしで server.py の処理量を測るため、使用しているエンドポイントだけを真似る
+#
+#   python bench/standins.py --port 9100 --wd-latency 120 --wx-latency 800 --error-rate 0.01
+#
+# server.py 側は .env を以下のように向ける
+#   WD_URL=http://localhost:9100  WML_URL=http://localhost:9100  IAM_URL=http://localhost:9100
+import argparse
+import asyncio
+import itertools
+import random
+import time
+import uuid
+
+import jwt
+import orjson
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, ORJSONResponse, StreamingResponse
+
+# LOG
+import logging
+logging.basicConfig(format='[%(asctime)s] %(message)s', level=logging.INFO)
+logger = logging.getLogger("LOG")
+
+class Behavior:
+    """サービスごとの応答遅延 (平均 ± 揺らぎ, ミリ秒) とエラー率"""
+
+    def __init__(self, latency, jitter, error_rate):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+
+    async def delay(self, scale=1.0):
+        ms = max(0.0, random.gauss(self.latency, self.jitter)) * scale
+        await asyncio.sleep(ms / 1000)
+
+    def error(self):
+        """エラー率に従って 429 / 503 の応答を返す (エラーにしない場合は None)"""
+        if random.random() >= self.error_rate:
+            return None
+        status = random.choice((429, 503))
+        return JSONResponse({"code": status, "error": "injected by standins"}, status_code=status)
+
+app = FastAPI()
+settings = {}
+# collection_id -> {document_id: 本文}
+collections = {}
+
+# IAM
+@app.post("/identity/token")
+async def identity_token():
+    now = int(time.time())
+    token = jwt.encode({"iat": now, "exp": now + 3600, "sub": "bench"}, "bench", algorithm="HS256")
+    return {
+        "access_token": token,
+        "refresh_token": "bench",
+        "token_type": "Bearer",
+        "expires_in": 3600,
+        "expiration": now + 3600,
+    }
+
+# Discovery v2
+def document_text(doc):
+    return " ".join(str(doc.get(f) or "") for f in ("要件", "カテゴリ"))
+
+def match_score(query, text):
+    """文字 bigram の重なりで簡易的に順位付けする"""
+    grams = {query[i:i + 2] for i in range(len(query) - 1)}
+    if not grams:
+        return 0.0
+    return sum(1 for g in grams if g in text) / len(grams)
+
+def query_result(collection_id, document_id, doc, score):
+    return {
+        "document_id": document_id,
+        **doc,
+        "result_metadata": {"collection_id": collection_id, "confidence": round(score, 4)},
+        "document_passages": [{
+            "passage_text": doc.get("要件", ""),
+            "field": "要件",
+            "answers": [{"answer_text": doc.get("要件", ""), "confidence": round(score, 4)}],
+        }],
+    }
+
+@app.get("/v2/projects/{project_id}/collections")
+async def list_collections(project_id: str):
+    await settings["wd"].delay(0.3)
+    return {"collections": [{"collection_id": c, "name": c} for c in collections]}
+
+@app.post("/v2/projects/{project_id}/query")
+async def query(project_id: str, request: Request):
+    wd = settings["wd"]
+    data = orjson.loads(await request.body())
+    await wd.delay()
+    if (err := wd.error()) is not None:
+        return err
+    text = data.get("natural_language_query") or ""
+    count = int(data.get("count") or 10)
+    scored = [
+        (match_score(text, document_text(doc)), c, d, doc)
+        for c in data.get("collection_ids") or []
+        for d, doc in collections.get(c, {}).items()
+    ]
+    scored.sort(key=lambda s: s[0], reverse=True)
+    results = [query_result(c, d, doc, score) for score, c, d, doc in scored[:count]]
+    return ORJSONResponse({"matching_results": len(scored), "results": results})
+
+@app.get("/v2/projects/{project_id}/autocompletion")
+async def autocompletion(project_id: str, prefix: str = "", count: int = 5):
+    wd = settings["wd"]
+    await wd.delay(0.5)
+    if (err := wd.error()) is not None:
+        return err
+    return {"completions": [f"{prefix}{i}" for i in range(count)]}
+
+@app.get("/v2/projects/{project_id}/collections/{collection_id}/documents")
+async def list_documents(project_id: str, collection_id: str, count: int = 100, offset: int = 0):
+    await settings["wd"].delay(0.5)
+    docs = collections.get(collection_id, {})
+    page = itertools.islice(docs, offset, offset + count)
+    return {
+        "matching_results": len(docs),
+        "documents": [{"document_id": d, "status": "available"} for d in page],
+    }
+
+@app.post("/v2/projects/{project_id}/collections/{collection_id}/documents")
+async def add_document(project_id: str, collection_id: str, request: Request):
+    wd = settings["wd"]
+    form = await request.form()
+    await wd.delay()
+    if (err := wd.error()) is not None:
+        return err
+    upload = form.get("file")
+    body = await upload.read() if hasattr(upload, "read") else (upload or b"{}")
+    doc = orjson.loads(body)
+    document_id = uuid.uuid4().hex
+    collections.setdefault(collection_id, {})[document_id] = doc[0] if isinstance(doc, list) else doc
+    return JSONResponse({"document_id": document_id, "status": "processing"}, status_code=202)
+
+@app.get("/v2/projects/{project_id}/collections/{collection_id}/documents/{document_id}")
+async def get_document(project_id: str, collection_id: str, document_id: str):
+    wd = settings["wd"]
+    await wd.delay(0.5)
+    if (err := wd.error()) is not None:
+        return err
+    doc = collections.get(collection_id, {}).get(document_id)
+    if doc is None:
+        return JSONResponse({"code": 404, "error": "not found"}, status_code=404)
+    return {"document_id": document_id, "status": "available", "children": {}, **doc}
+
+@app.post("/v2/projects/{project_id}/collections/{collection_id}/documents/{document_id}")
+async def update_document(project_id: str, collection_id: str, document_id: str, request: Request):
+    await add_document(project_id, collection_id, request)
+    return JSONResponse({"document_id": document_id, "status": "processing"}, status_code=202)
+
+@app.delete("/v2/projects/{project_id}/collections/{collection_id}/documents/{document_id}")
+async def delete_document(project_id: str, collection_id: str, document_id: str):
+    await settings["wd"].delay(0.5)
+    collections.get(collection_id, {}).pop(document_id, None)
+    return {"document_id": document_id, "status": "deleted"}
+
+# watsonx.ai
+def generated_tokens(params):
+    count = int((params or {}).get("max_new_tokens") or settings["tokens"])
+    return min(count, settings["tokens"])
+
+@app.post("/ml/v1/text/generation")
+async def generation(request: Request):
+    wx = settings["wx"]
+    data = orjson.loads(await request.body())
+    tokens = generated_tokens(data.get("parameters"))
+    await wx.delay()
+    if (err := wx.error()) is not None:
+        return err
+    await asyncio.sleep(tokens * settings["token_ms"] / 1000)
+    return {
+        "model_id": data.get("model_id"),
+        "results": [{
+            "generated_text": "```json\n{\"judge\": \"◯\", \"score\": 80, \"reason\": \"bench\"}\n```",
+            "generated_token_count": tokens,
+            "input_token_count": len(data.get("input") or "") // 2,
+            "stop_reason": "eos_token",
+        }],
+    }
+
+@app.post("/ml/v1/text/generation_stream")
+async def generation_stream(request: Request):
+    wx = settings["wx"]
+    data = orjson.loads(await request.body())
+    tokens = generated_tokens(data.get("parameters"))
+    await wx.delay()
+    if (err := wx.error()) is not None:
+        return err
+
+    async def events():
+        for i in range(tokens):
+            await asyncio.sleep(settings["token_ms"] / 1000)
+            last = i == tokens - 1
+            result = {
+                "generated_text": "あ",
+                "generated_token_count": i + 1,
+                "input_token_count": 0,
+                "stop_reason": "eos_token" if last else "not_finished",
+            }
+            payload = orjson.dumps({"model_id": data.get("model_id"), "results": [result]})
+            yield f"id: {i + 1}\nevent: message\ndata: {payload.decode()}\n\n"
+        yield "event: close\n\n"
+
+    return StreamingResponse(events(), media_type="text/event-stream")
+
+# SDK の初期化時に呼ばれるその他のエンドポイントは空の応答を返す
+@app.api_route("/{path:path}", methods=["GET", "POST"])
+async def fallback(path: str):
+    logger.info(f"standins: unhandled /{path}")
+    return {}
+
+def main():
+    parser = argparse.ArgumentParser(description="Discovery / watsonx.ai stand-in servers for benchmarks")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=9100)
+    parser.add_argument("--wd-latency", type=float, default=150, help="Discovery の平均遅延 (ms)")
+    parser.add_argument("--wd-jitter", type=float, default=50)
+    parser.add_argument("--wd-error-rate", type=float, default=0.0)
+    parser.add_argument("--wx-latency", type=float, default=400, help="watsonx.ai の最初のトークンまでの遅延 (ms)")
+    parser.add_argument("--wx-jitter", type=float, default=100)
+    parser.add_argument("--wx-error-rate", type=float, default=0.0)
+    parser.add_argument("--tokens", type=int, default=60, help="生成するトークン数の上限")
+    parser.add_argument("--token-ms", type=float, default=15, help="1トークンあたりの生成時間 (ms)")
+    args = parser.parse_args()
+
+    settings["wd"] = Behavior(args.wd_latency, args.wd_jitter, args.wd_error_rate)
+    settings["wx"] = Behavior(args.wx_latency, args.wx_jitter, args.wx_error_rate)
+    settings["tokens"] = args.tokens
+    settings["token_ms"] = args.token_ms
+    uvicorn.run(app, host=args.host, port=args.port, log_level="warning")
+
+if __name__ == "__main__":
+    main()
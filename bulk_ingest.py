@@ -0,0 +1,168 @@
+# ドキュメント一括登録
+# 行ごとの add_document を同時実行数・レート制限付きで並列に行い、進捗を NDJSON で返す
+import asyncio
+import fcntl
+import json
+import os
+import tempfile
+import time
+from typing import AsyncGenerator
+
+import xxhash
+
+# Module files
+import wd_async as WDASYNC
+import xlsx_stream as XLSX
+
+# LOG
+import logging
+logging.basicConfig(format='[%(asctime)s] %(message)s', level=logging.INFO)
+logger = logging.getLogger("LOG")
+
+# 1秒あたりの add_document 呼び出し数と同時実行数の上限
+BULK_RATE = float(os.getenv("BULK_RATE", 5))
+BULK_MAX_CONCURRENCY = int(os.getenv("BULK_MAX_CONCURRENCY", 4))
+BULK_LEDGER_DIR = os.getenv("BULK_LEDGER_DIR", os.path.join(tempfile.gettempdir(), "wx_bulk_ledger"))
+
+def row_hash(row):
+    data = json.dumps(row, sort_keys=True, ensure_ascii=False, default=str)
+    return xxhash.xxh3_128_hexdigest(data.encode("utf-8"))
+
+class RateLimiter:
+    """トークンバケットによる呼び出し間隔の制御"""
+
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.capacity = max(1, burst)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        if self.rate <= 0:
+            return
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+class IngestLedger:
+    """登録済み行の記録 (行のハッシュ -> document_id) をコレクションごとのファイルに残す"""
+
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(self.path, exist_ok=True)
+
+    def _file(self, collection_id):
+        return os.path.join(self.path, f"{collection_id}.jsonl")
+
+    def load(self, collection_id):
+        entries = {}
+        try:
+            with open(self._file(collection_id), "r", encoding="utf-8") as f:
+                for line in f:
+                    rec = json.loads(line)
+                    if rec.get("deleted"):
+                        entries = {h: d for h, d in entries.items() if d != rec["document_id"]}
+                    else:
+                        entries[rec["hash"]] = rec["document_id"]
+        except FileNotFoundError:
+            pass
+        return entries
+
+    def _append(self, collection_id, rec):
+        # 複数ワーカーから追記されるため排他ロックを取る
+        with open(self._file(collection_id), "a", encoding="utf-8") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            f.write(json.dumps(rec, ensure_ascii=False) + "\n")
+
+    def record(self, collection_id, key, document_id):
+        self._append(collection_id, {"hash": key, "document_id": document_id})
+
+    def forget(self, collection_id, document_id):
+        if os.path.exists(self._file(collection_id)):
+            self._append(collection_id, {"document_id": document_id, "deleted": True})
+
+ingest_ledger = IngestLedger(BULK_LEDGER_DIR)
+
+class BulkIngest:
+    """/wdbulkadd の1リクエスト分の設定と処理"""
+
+    def __init__(self, data, rows=None):
+        self.collection_id = data.get("collection_id")
+        self.rows = rows if rows is not None else (data.get("rows") or [])
+        self.filename = data.get("filename") or "row"
+        concurrency = int(data.get("concurrency") or BULK_MAX_CONCURRENCY)
+        self.concurrency = max(1, min(concurrency, BULK_MAX_CONCURRENCY))
+        # リクエストで指定できるのは上限以下のレートのみ
+        rate = float(data.get("rate") or BULK_RATE)
+        self.limiter = RateLimiter(min(rate, BULK_RATE))
+
+    def validate(self):
+        if not self.collection_id:
+            raise ValueError("collection_id is required")
+
+    async def add_row(self, index, row, key):
+        params = {
+            "collection_id": self.collection_id,
+            "filename": f"{self.filename}-{key[:16]}.json",
+            "file": json.dumps(row, ensure_ascii=False),
+            "file_content_type": "application/json",
+        }
+        await self.limiter.acquire()
+        # 429 の再試行は resilience で行う (5xx・期限切れは重複登録を避けるため再試行しない)
+        ret = await WDASYNC.call_adddocument(params)
+        return ret.get("document_id")
+
+    async def run_row(self, index, row, done, semaphore):
+        key = row_hash(row)
+        if key in done:
+            return {"index": index, "status": "skipped", "document_id": done[key]}
+        # 同じバッチ内の重複行は1回だけ登録する
+        done[key] = None
+        async with semaphore:
+            try:
+                document_id = await self.add_row(index, row, key)
+            except Exception as e:
+                logger.error(f"bulkadd 行エラー (index: {index}): {str(e)}")
+                del done[key]
+                return {"index": index, "status": "error", "error": str(e)}
+        done[key] = document_id
+        await asyncio.to_thread(ingest_ledger.record, self.collection_id, key, document_id)
+        return {"index": index, "status": "added", "document_id": document_id}
+
+    async def stream(self) -> AsyncGenerator[str, None]:
+        """行ごとの登録結果を完了順に NDJSON で返す"""
+        done = await asyncio.to_thread(ingest_ledger.load, self.collection_id)
+        semaphore = asyncio.Semaphore(self.concurrency)
+        pending = set()
+        counts = {"added": 0, "skipped": 0, "error": 0}
+        try:
+            # 行はイテレータでも受け付け、同時に保持するタスク数を抑える
+            # シートから読む行はスレッドで読み進め、イベントループを止めない
+            index = -1
+            async for row in XLSX.aiter_rows(self.rows):
+                index += 1
+                pending.add(asyncio.create_task(self.run_row(index, row, done, semaphore)))
+                if len(pending) >= self.concurrency * 2:
+                    finished, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                    for task in finished:
+                        result = task.result()
+                        counts[result["status"]] += 1
+                        yield json.dumps(result, ensure_ascii=False) + "\n"
+            while pending:
+                finished, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in finished:
+                    result = task.result()
+                    counts[result["status"]] += 1
+                    yield json.dumps(result, ensure_ascii=False) + "\n"
+            yield json.dumps({"done": True, **counts}, ensure_ascii=False) + "\n"
+        finally:
+            for task in pending:
+                task.cancel()
+            logger.info(f"bulkadd 完了: {counts}")
@@ -2,6 +2,9 @@ import os
 import sys
 import time
 import json
+import math
+import hashlib
+import subprocess
 from dotenv import load_dotenv
 from ibm_cloud_sdk_core.authenticators import IAMAuthenticator
 from ibm_code_engine_sdk.code_engine_v2 import CodeEngineV2
@@ -43,6 +46,35 @@ IMAGE_URL = build_config.get("IMAGE_URL") or os.getenv("IMAGE_URL")
 REGISTRY_SECRET_NAME = build_config.get("REGISTRY_SECRET_NAME") or os.getenv("REGISTRY_SECRET_NAME")
 STRATEGY_SIZE = build_config.get("STRATEGY_SIZE", "medium")
 
+# Build run polling: starts at BUILD_POLL_INITIAL seconds and backs off up to BUILD_POLL_MAX
+BUILD_TIMEOUT = float(build_config.get("TIMEOUT_SECONDS", 1800))
+BUILD_POLL_INITIAL = float(build_config.get("POLL_INITIAL_SECONDS", 2))
+BUILD_POLL_MAX = float(build_config.get("POLL_MAX_SECONDS", 30))
+BUILD_POLL_BACKOFF = 1.5
+
+# Image digests recorded per build-inputs hash (skip the build when nothing changed)
+BUILD_CACHE_FILE = build_config.get("CACHE_FILE", ".ce_build_cache.json")
+BUILD_CACHE_SIZE = 20
+
+# Scaling Profile
+# Values left unset keep the Code Engine defaults. LOAD_TEST_RESULT (or --scaling-from)
+# derives concurrency, max instances, workers and memory from a bench/driver.py result.
+scaling_config = config.get("SCALING", {})
+
+# Valid Code Engine memory sizes per vCPU
+CE_MEMORY_OPTIONS = {
+    "0.125": ["0.25G", "0.5G", "1G"],
+    "0.25": ["0.5G", "1G", "2G"],
+    "0.5": ["1G", "2G", "4G"],
+    "1": ["2G", "4G", "8G"],
+    "2": ["4G", "8G", "16G"],
+    "4": ["8G", "16G", "32G"],
+    "6": ["12G", "24G", "48G"],
+    "8": ["16G", "32G"],
+    "10": ["20G", "40G"],
+    "12": ["24G", "48G"],
+}
+
 if not API_KEY:
     print("Error: API_KEY is not set (check ce_config.json or .env).")
     sys.exit(1)
@@ -55,6 +87,215 @@ if not GIT_REPO_URL or not IMAGE_URL:
     print("Error: GIT_REPO_URL and IMAGE_URL must be set (check ce_config.json).")
     sys.exit(1)
 
+def get_arg_value(flag):
+    """Return the value following a command line flag (e.g. --scaling-from result.json)."""
+    if flag in sys.argv:
+        index = sys.argv.index(flag)
+        if index + 1 < len(sys.argv):
+            return sys.argv[index + 1]
+        print(f"Error: {flag} requires a value.")
+        sys.exit(1)
+    return None
+
+def derive_scaling(result, profile):
+    """Derive scaling values from a load test result (bench/driver.py output).
+
+    - concurrency: the concurrency the test ran at, halved while errors or p95 exceed the targets
+    - max instances: PEAK_RPS / per-instance throughput of the request mix, plus headroom
+    - workers: WORKERS_PER_CPU per vCPU (the workload is I/O bound)
+    - memory: the smallest valid size for the CPU that fits MEMORY_PER_WORKER_GB per worker
+    """
+    endpoints = result.get("endpoints", {})
+    if not endpoints:
+        print("Error: load test result has no endpoints.")
+        sys.exit(1)
+    tested_concurrency = int(result.get("settings", {}).get("concurrency", 8))
+
+    # Per-instance throughput of the mix (each endpoint weighted by its share of requests)
+    mix = profile.get("TRAFFIC_MIX") or {e: r["requests"] for e, r in endpoints.items()}
+    total_share = sum(mix.get(e, 0) for e in endpoints) or 1
+    seconds_per_request = sum(
+        (mix.get(e, 0) / total_share) / r["throughput"]
+        for e, r in endpoints.items() if r["throughput"] > 0
+    )
+    instance_rps = 1 / seconds_per_request if seconds_per_request else 0
+
+    requests = sum(r["requests"] for r in endpoints.values())
+    errors = sum(r["errors"] for r in endpoints.values())
+    error_rate = errors / requests if requests else 0
+    target_p95 = float(profile.get("TARGET_P95_MS", 0))
+    slow = [e for e, r in endpoints.items() if target_p95 and e != "stream" and r["p95"] > target_p95]
+    concurrency = tested_concurrency
+    if error_rate > float(profile.get("MAX_ERROR_RATE", 0.01)) or slow:
+        concurrency = max(1, tested_concurrency // 2)
+        print(f"Load test exceeded targets (error rate {error_rate:.2%}, slow: {slow or '-'}); halving concurrency.")
+
+    derived = {"CONCURRENCY": concurrency}
+    peak_rps = float(profile.get("PEAK_RPS", 0))
+    if peak_rps and instance_rps:
+        headroom = float(profile.get("HEADROOM", 0.3))
+        derived["MAX_INSTANCES"] = min(250, max(1, math.ceil(peak_rps * (1 + headroom) / instance_rps)))
+
+    cpu = str(profile.get("CPU", "1"))
+    workers = max(1, round(float(cpu) * float(profile.get("WORKERS_PER_CPU", 2))))
+    derived["WORKERS"] = workers
+    memory_needed = workers * float(profile.get("MEMORY_PER_WORKER_GB", 1))
+    for memory in CE_MEMORY_OPTIONS.get(cpu, []):
+        if float(memory[:-1]) >= memory_needed:
+            derived["MEMORY"] = memory
+            break
+    else:
+        print(f"Warning: no memory size for {cpu} vCPU fits {memory_needed}G; keeping configured memory.")
+
+    print(f"Derived from load test '{result.get('label')}': {instance_rps:.1f} req/s per instance, {derived}")
+    return derived
+
+def load_scaling_profile():
+    """Scaling profile from ce_config.json SCALING, optionally derived from a load test result."""
+    profile = dict(scaling_config)
+    result_file = get_arg_value("--scaling-from") or profile.get("LOAD_TEST_RESULT")
+    if result_file:
+        try:
+            with open(result_file, "r", encoding="utf-8") as f:
+                result = json.load(f)
+        except (OSError, json.JSONDecodeError) as e:
+            print(f"Error reading load test result {result_file}: {e}")
+            sys.exit(1)
+        # Derived values replace the configured ones; CPU and the targets come from SCALING
+        profile = {**profile, **derive_scaling(result, profile)}
+
+    cpu = profile.get("CPU")
+    memory = profile.get("MEMORY")
+    if cpu is not None and memory is not None and memory not in CE_MEMORY_OPTIONS.get(str(cpu), []):
+        print(f"Error: {cpu} vCPU / {memory} is not a valid Code Engine combination "
+              f"(valid: {CE_MEMORY_OPTIONS.get(str(cpu), [])}).")
+        sys.exit(1)
+    return profile
+
+def scaling_app_fields(profile):
+    """Map the scaling profile to Code Engine app fields (unset values are omitted)."""
+    fields = {
+        'scale_min_instances': APP_MIN_INSTANCES,
+        'scale_max_instances': profile.get("MAX_INSTANCES"),
+        'scale_concurrency': profile.get("CONCURRENCY"),
+        'scale_cpu_limit': str(profile["CPU"]) if profile.get("CPU") is not None else None,
+        'scale_memory_limit': profile.get("MEMORY"),
+    }
+    return {k: v for k, v in fields.items() if v is not None}
+
+def git_output(*args):
+    """Run a git command and return its stdout (None on failure)."""
+    try:
+        return subprocess.run(
+            ["git", *args], capture_output=True, text=True, check=True, timeout=120
+        ).stdout.strip()
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+def source_fingerprint():
+    """Identify the source Code Engine will build: the git tree of GIT_BRANCH at GIT_REPO_URL.
+
+    The tree id covers every file the Dockerfile copies (including requirements.txt)
+    and ignores commit metadata, so rebases and merges without content changes match.
+    """
+    if git_output("fetch", "--quiet", GIT_REPO_URL, GIT_BRANCH) is not None:
+        tree = git_output("rev-parse", "FETCH_HEAD^{tree}")
+        if tree:
+            return f"tree:{tree}"
+    # Fall back to the branch head commit when the repository cannot be fetched locally
+    head = git_output("ls-remote", GIT_REPO_URL, f"refs/heads/{GIT_BRANCH}")
+    if head:
+        return f"commit:{head.split()[0]}"
+    return None
+
+def build_inputs_hash():
+    """Hash of everything that determines the built image (None if the source cannot be identified)."""
+    source = source_fingerprint()
+    if source is None:
+        print("Warning: could not identify the build source; build skipping is disabled for this run.")
+        return None
+    inputs = {
+        "source": source,
+        "output_image": IMAGE_URL,
+        "output_secret": REGISTRY_SECRET_NAME,
+        "strategy_type": "dockerfile",
+        "strategy_size": STRATEGY_SIZE,
+    }
+    return hashlib.sha256(json.dumps(inputs, sort_keys=True).encode("utf-8")).hexdigest()
+
+def load_build_cache():
+    try:
+        with open(BUILD_CACHE_FILE, "r") as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+
+def save_build_cache(inputs_hash, digest, build_run_name):
+    cache = load_build_cache()
+    cache[inputs_hash] = {
+        "digest": digest,
+        "image": IMAGE_URL,
+        "build_run": build_run_name,
+        "built_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+    }
+    # Keep the most recent entries only
+    entries = sorted(cache.items(), key=lambda kv: kv[1].get("built_at", ""))[-BUILD_CACHE_SIZE:]
+    with open(BUILD_CACHE_FILE, "w") as f:
+        json.dump(dict(entries), f, indent=2)
+
+def build_run_status(status_response):
+    """Extract (state, reason, output digest) from a get_build_run response."""
+    if isinstance(status_response, str):
+        try:
+            status_response = json.loads(status_response)
+        except json.JSONDecodeError:
+            return status_response, "See status string", None
+    if not isinstance(status_response, dict):
+        return "Unknown", f"Unexpected status type: {type(status_response)}", None
+
+    status_field = status_response.get('status')
+    details = status_response.get('status_details')
+    details = details if isinstance(details, dict) else {}
+    if isinstance(status_field, dict):
+        state = status_field.get('condition', 'Unknown')
+        reason = status_field.get('reason', 'Unknown')
+        digest = details.get('output_digest') or status_field.get('output_digest')
+    else:
+        state = status_field if isinstance(status_field, str) else 'Unknown'
+        reason = details.get('reason', 'Unknown')
+        digest = details.get('output_digest')
+    return state, reason, digest
+
+def wait_for_build_run(ce_client, build_run_name):
+    """Poll the build run with exponential backoff until it finishes; return the image digest."""
+    interval = BUILD_POLL_INITIAL
+    started = time.monotonic()
+    last_state = None
+    while True:
+        status_response = ce_client.get_build_run(project_id=PROJECT_ID, name=build_run_name).get_result()
+        state, reason, digest = build_run_status(status_response)
+        elapsed = time.monotonic() - started
+
+        # Print only when the state changes
+        if state != last_state:
+            print(f"Status: {state} ({elapsed:.0f}s)")
+            last_state = state
+
+        if state.lower() == 'succeeded':
+            print(f"Build completed successfully in {elapsed:.0f}s!")
+            if digest:
+                print(f"Build Output Digest: {digest}")
+            return digest
+        elif state.lower() in ['failed', 'false']:
+            print(f"Build failed. Reason: {reason}")
+            sys.exit(1)
+
+        if elapsed + interval > BUILD_TIMEOUT:
+            print(f"Build did not finish within {BUILD_TIMEOUT:.0f}s (last status: {state}).")
+            sys.exit(1)
+        time.sleep(interval)
+        interval = min(interval * BUILD_POLL_BACKOFF, BUILD_POLL_MAX)
+
 def main():
     print(f"Starting deployment to IBM Cloud Code Engine (Source Build)...")
     print(f"Region: {REGION}")
@@ -65,6 +306,10 @@ def main():
     print(f"Min Instances: {APP_MIN_INSTANCES}")
     print(f"Build Strategy Size: {STRATEGY_SIZE}")
 
+    scaling_profile = load_scaling_profile()
+    scaling_fields = scaling_app_fields(scaling_profile)
+    print(f"Scaling: {scaling_fields}, workers per container: {scaling_profile.get('WORKERS', 'default')}")
+
     # Authenticate
     authenticator = IAMAuthenticator(API_KEY)
     ce_client = CodeEngineV2(authenticator=authenticator)
@@ -72,8 +317,21 @@ def main():
 
     # Check for skip build flag
     skip_build = "--skip-build" in sys.argv
+    force_build = "--force-build" in sys.argv
 
+    # Reuse the image built from identical inputs (content-addressed build skipping)
+    inputs_hash = None
+    cached_build = None
     if not skip_build:
+        inputs_hash = build_inputs_hash()
+        if inputs_hash and not force_build:
+            cached_build = load_build_cache().get(inputs_hash)
+
+    if cached_build:
+        built_image_digest = cached_build["digest"]
+        print(f"\nBuild inputs unchanged ({inputs_hash[:12]}); skipping build.")
+        print(f"Reusing image digest from build run '{cached_build.get('build_run')}': {built_image_digest}")
+    elif not skip_build:
         # 1. Define Build
         build_name = f"{APP_NAME}-build"
         print(f"\n[1/3] Configuring Build '{build_name}'...")
@@ -133,68 +391,13 @@ def main():
             
             build_run_name = build_run['name']
             print(f"Build Run '{build_run_name}' submitted. Waiting for completion...")
-            
-            # Poll for completion
-            built_image_digest = None
-            while True:
-                status_response = ce_client.get_build_run(project_id=PROJECT_ID, name=build_run_name).get_result()
-                print(f"DEBUG: Status response type: {type(status_response)}")
-                
-                state = 'Unknown'
-                reason = 'Unknown'
-
-                if isinstance(status_response, dict):
-                    print(f"DEBUG: Status response content: {status_response}")
-                    status_field = status_response.get('status')
-                    if isinstance(status_field, dict):
-                        state = status_field.get('condition', 'Unknown')
-                        reason = status_field.get('reason', 'Unknown')
-                        # Check recursively just in case
-                        built_image_digest = status_field.get('output_digest')
-                    elif isinstance(status_field, str):
-                        state = status_field
-                        reason = 'See status string'
-                    else:
-                        state = 'Unknown'
-                        reason = f"Unexpected status field type: {type(status_field)}"
-                    
-                    # Correctly look for status_details in the root response
-                    if 'status_details' in status_response:
-                        details = status_response.get('status_details', {})
-                        if isinstance(details, dict):
-                            built_image_digest = details.get('output_digest')
-                    
-                elif isinstance(status_response, str):
-                    # If the SDK returns a raw string, we might need to parse it or it might be just the status?
-                    # Let's print it to be sure in the logs
-                    print(f"DEBUG: Status response content: {status_response}")
-                    try:
-                        status_dict = json.loads(status_response)
-                        if isinstance(status_dict, dict):
-                            state = status_dict.get('status', {}).get('condition', 'Unknown')
-                            reason = status_dict.get('status', {}).get('reason', 'Unknown')
-                            built_image_digest = status_dict.get('status', {}).get('output_digest')
-                    except json.JSONDecodeError:
-                        state = str(status_response) # Treat the string as the state itself if not JSON
-                else:
-                    print(f"DEBUG: Unexpected status type: {status_response}")
-
-                print(f"Status: {state}")
-                
-                if state.lower() == 'succeeded':
-                    print("Build completed successfully!")
-                    if built_image_digest:
-                        print(f"Build Output Digest: {built_image_digest}")
-                    break
-                elif state.lower() in ['failed', 'false']: 
-                    print(f"Build failed. Reason: {reason}")
-                    sys.exit(1)
-                
-                time.sleep(10)
-                
+            built_image_digest = wait_for_build_run(ce_client, build_run_name)
         except ApiException as e:
             print(f"Build run failed: {e}")
             sys.exit(1)
+
+        if built_image_digest and inputs_hash:
+            save_build_cache(inputs_hash, built_image_digest, build_run_name)
     else:
         print("Skipping build steps as requested.")
         # Try to find the latest successful build run to get the digest
@@ -259,6 +462,10 @@ def main():
                 elif v.startswith("'") and v.endswith("'"): v = v[1:-1]
                 env_vars_to_pass[k] = v
     
+    # The container sizes its gunicorn workers from the same profile (see gunicorn.conf.py)
+    if scaling_profile.get("WORKERS") is not None:
+        env_vars_to_pass.setdefault("GUNICORN_WORKERS", str(scaling_profile["WORKERS"]))
+
     env_list = []
     for k, v in env_vars_to_pass.items():
         env_list.append({'name': k, 'value': v, 'type': 'literal'})
@@ -277,7 +484,7 @@ def main():
                 'run_env_variables': env_list,
                 'image_secret': REGISTRY_SECRET_NAME,
                 'image_port': APP_PORT,
-                'scale_min_instances': APP_MIN_INSTANCES
+                **scaling_fields
             }
             
             ce_client.update_app(
@@ -296,7 +503,7 @@ def main():
                     run_env_variables=env_list,
                     image_secret=REGISTRY_SECRET_NAME,
                     image_port=APP_PORT,
-                    scale_min_instances=APP_MIN_INSTANCES
+                    **scaling_fields
                 )
             else:
                 raise e
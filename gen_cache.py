@@ -0,0 +1,147 @@
+# 決定的な生成(greedy)結果のディスクキャッシュ
+# キーは xxhash、値は zstandard 圧縮し、全 gunicorn ワーカーで同じディレクトリを共有する
+import fcntl
+import json
+import os
+import tempfile
+import threading
+
+import xxhash
+import zstandard
+
+# env
+from dotenv import load_dotenv
+load_dotenv()
+
+# LOG
+import logging
+logging.basicConfig(format='[%(asctime)s] %(message)s', level=logging.INFO)
+logger = logging.getLogger("LOG")
+
+def make_key(model_id, params, prompt):
+    """モデルID・生成パラメータ・展開後プロンプトから内容アドレスを作る"""
+    h = xxhash.xxh3_128()
+    h.update(model_id.encode("utf-8"))
+    h.update(b"\0")
+    h.update(json.dumps(params, sort_keys=True, ensure_ascii=False, default=str).encode("utf-8"))
+    h.update(b"\0")
+    h.update(prompt.encode("utf-8"))
+    return h.hexdigest()
+
+class GenerationCache:
+    """プロセス間で共有するサイズ上限付きのディスクキャッシュ"""
+
+    def __init__(self, path, max_bytes=256 * 1024 * 1024, level=3):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.level = level
+        self._local = threading.local()
+        self._writes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        os.makedirs(self.path, exist_ok=True)
+
+    # zstandard のコンテキストはスレッド間で共有できないためスレッドごとに持つ
+    def _compressor(self):
+        if not hasattr(self._local, "cctx"):
+            self._local.cctx = zstandard.ZstdCompressor(level=self.level)
+        return self._local.cctx
+
+    def _decompressor(self):
+        if not hasattr(self._local, "dctx"):
+            self._local.dctx = zstandard.ZstdDecompressor()
+        return self._local.dctx
+
+    def _file(self, key):
+        return os.path.join(self.path, key[:2], key + ".zst")
+
+    def get(self, key):
+        file = self._file(key)
+        try:
+            with open(file, "rb") as f:
+                data = f.read()
+            # 最終利用時刻を更新して LRU 的に残す
+            os.utime(file)
+        except FileNotFoundError:
+            self.misses += 1
+            return None
+        try:
+            text = self._decompressor().decompress(data).decode("utf-8")
+        except zstandard.ZstdError as e:
+            logger.error(f"gen_cache 読み込みエラー: {str(e)}")
+            self.misses += 1
+            return None
+        self.hits += 1
+        return text
+
+    def put(self, key, text):
+        file = self._file(key)
+        os.makedirs(os.path.dirname(file), exist_ok=True)
+        data = self._compressor().compress(text.encode("utf-8"))
+        # 他ワーカーが途中のファイルを読まないよう一時ファイルから置き換える
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(file), suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(tmp, file)
+        except OSError:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+        self._writes += 1
+        if self._writes % 64 == 1:
+            self.evict()
+
+    def _scan(self):
+        files = []
+        for shard in os.scandir(self.path):
+            if not shard.is_dir():
+                continue
+            for entry in os.scandir(shard.path):
+                if entry.name.endswith(".zst"):
+                    st = entry.stat()
+                    files.append((st.st_mtime, st.st_size, entry.path))
+        return files
+
+    def evict(self):
+        """合計サイズが上限を超えたら古いものから削除する"""
+        with open(os.path.join(self.path, ".lock"), "w") as lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                # 他のワーカーが削除中
+                return
+            files = self._scan()
+            total = sum(size for _, size, _ in files)
+            if total <= self.max_bytes:
+                return
+            files.sort()
+            for _, size, path in files:
+                if total <= self.max_bytes * 0.9:
+                    break
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+                total -= size
+                self.evictions += 1
+
+    def stats(self):
+        files = self._scan()
+        total = self.hits + self.misses
+        return {
+            "path": self.path,
+            "entries": len(files),
+            "bytes": sum(size for _, size, _ in files),
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": (self.hits / total) if total else 0.0,
+            "evictions": self.evictions,
+        }
+
+generation_cache = GenerationCache(
+    path=os.getenv("GEN_CACHE_DIR", os.path.join(tempfile.gettempdir(), "wx_gen_cache")),
+    max_bytes=int(os.getenv("GEN_CACHE_MAX_BYTES", 256 * 1024 * 1024)),
+)
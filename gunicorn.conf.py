@@ -0,0 +1,20 @@
+# gunicorn の設定 (Dockerfile の CMD で読み込む)
+import os
+
+import startup as STARTUP
+
+# ワーカー数は deploy.py のスケーリング設定から渡される (未設定なら1)
+workers = int(os.getenv("GUNICORN_WORKERS") or os.getenv("WEB_CONCURRENCY") or 1)
+
+# server.py をマスタープロセスで読み込み、fork 後のワーカーで共有する
+preload_app = os.getenv("GUNICORN_PRELOAD", "true").lower() in ("1", "true")
+
+def on_starting(server):
+    # SDK は遅延 import のため、preload 時はここで読み込んでおく
+    if preload_app:
+        STARTUP.import_sdks()
+        server.log.info(f"startup: {STARTUP.report()['phases']}")
+
+def post_fork(server, worker):
+    # クライアントの生成は各ワーカーの startup イベントで行う (/ready で完了を確認できる)
+    server.log.info(f"worker {worker.pid}: forked")
@@ -0,0 +1,144 @@
+# IAMトークンのプロセス間共有キャッシュ
+# トークンをロック付きの共有ファイルに置き、期限前にバックグラウンドで更新する
+import fcntl
+import json
+import os
+import tempfile
+import threading
+import time
+
+import xxhash
+from ibm_cloud_sdk_core.authenticators import Authenticator
+from ibm_cloud_sdk_core.token_managers.iam_token_manager import IAMTokenManager
+
+# env
+from dotenv import load_dotenv
+load_dotenv()
+
+# LOG
+import logging
+logging.basicConfig(format='[%(asctime)s] %(message)s', level=logging.INFO)
+logger = logging.getLogger("LOG")
+
+IAM_TOKEN_CACHE_DIR = os.getenv("IAM_TOKEN_CACHE_DIR", os.path.join(tempfile.gettempdir(), "wx_iam_tokens"))
+# 有効期限のこの秒数前から更新する
+IAM_REFRESH_BEFORE = float(os.getenv("IAM_REFRESH_BEFORE", 600))
+IAM_URL = os.getenv("IAM_URL", None)
+
+class SharedTokenProvider:
+    """APIキー1つ分のIAMトークンを全ワーカーで共有する"""
+
+    def __init__(self, apikey, url=None):
+        self.apikey = apikey
+        self.manager = IAMTokenManager(apikey=apikey, url=url)
+        os.makedirs(IAM_TOKEN_CACHE_DIR, mode=0o700, exist_ok=True)
+        name = xxhash.xxh64_hexdigest(apikey.encode("utf-8"))
+        self.path = os.path.join(IAM_TOKEN_CACHE_DIR, f"{name}.json")
+        self._token = None
+        self._expiration = 0
+        self._lock = threading.Lock()
+        self._pid = None
+        self._listeners = []
+        self.refreshes = 0
+
+    def add_listener(self, callback):
+        """トークン更新時に呼ばれるコールバック (APIClient.set_token など)"""
+        self._listeners.append(callback)
+
+    def _read_file(self):
+        try:
+            with open(self.path, "r") as f:
+                fcntl.flock(f, fcntl.LOCK_SH)
+                data = json.load(f)
+            return data["access_token"], data["expiration"]
+        except (FileNotFoundError, ValueError, KeyError):
+            return None, 0
+
+    def _set(self, token, expiration):
+        changed = token != self._token
+        self._token, self._expiration = token, expiration
+        if changed:
+            for callback in self._listeners:
+                try:
+                    callback(token)
+                except Exception as e:
+                    logger.error(f"iam_token 通知エラー: {str(e)}")
+
+    def _needs_refresh(self, expiration):
+        return expiration - time.time() < IAM_REFRESH_BEFORE
+
+    def refresh(self, force=False):
+        """共有ファイルが古ければIAMから取得し直す (取得は1プロセスだけが行う)"""
+        with open(self.path + ".lock", "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            token, expiration = self._read_file()
+            if force or token is None or self._needs_refresh(expiration):
+                ret = self.manager.request_token()
+                token, expiration = ret["access_token"], ret["expiration"]
+                fd = os.open(self.path + ".tmp", os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+                with os.fdopen(fd, "w") as f:
+                    json.dump({"access_token": token, "expiration": expiration}, f)
+                os.replace(self.path + ".tmp", self.path)
+                self.refreshes += 1
+                logger.info("iam_token: トークンを更新しました")
+        self._set(token, expiration)
+        return token
+
+    def _refresh_loop(self):
+        while True:
+            wait = self._expiration - IAM_REFRESH_BEFORE - time.time()
+            # 他のワーカーが更新した分も拾えるよう長くても60秒ごとに確認する
+            time.sleep(min(max(wait, 1), 60))
+            try:
+                token, expiration = self._read_file()
+                if token is not None and not self._needs_refresh(expiration):
+                    self._set(token, expiration)
+                else:
+                    self.refresh()
+            except Exception as e:
+                logger.error(f"iam_token 更新エラー: {str(e)}")
+
+    def _ensure_thread(self):
+        # fork 後のプロセスではスレッドを起動し直す
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            threading.Thread(target=self._refresh_loop, daemon=True, name="iam-refresh").start()
+
+    def get_token(self):
+        """有効なトークンを返す (期限切れでなければIAMの応答を待たない)"""
+        with self._lock:
+            self._ensure_thread()
+            if self._token is not None and self._expiration > time.time() + 30:
+                return self._token
+            token, expiration = self._read_file()
+            if token is not None and expiration > time.time() + 30:
+                self._set(token, expiration)
+                return token
+            return self.refresh()
+
+class SharedIAMAuthenticator(Authenticator):
+    """SharedTokenProvider のトークンを使う ibm-cloud-sdk-core 用の認証"""
+
+    def __init__(self, provider):
+        self.provider = provider
+
+    def validate(self):
+        if not self.provider.apikey:
+            raise ValueError("apikey is required")
+
+    def authenticate(self, req):
+        req["headers"]["Authorization"] = f"Bearer {self.provider.get_token()}"
+
+    def authentication_type(self):
+        return Authenticator.AUTHTYPE_IAM
+
+_providers = {}
+_providers_lock = threading.Lock()
+
+def get_provider(apikey):
+    """APIキーごとに1つの SharedTokenProvider を返す"""
+    with _providers_lock:
+        provider = _providers.get(apikey)
+        if provider is None:
+            provider = _providers[apikey] = SharedTokenProvider(apikey, IAM_URL)
+        return provider
@@ -0,0 +1,76 @@
+# ローカルでの一致度判定
+# 要件と検索する機能の文字 n-gram の重なりを NumPy でまとめて計算し、judge / score を決める
+import re
+
+import numpy as np
+
+# env
+import os
+from dotenv import load_dotenv
+load_dotenv()
+
+NGRAM = int(os.getenv("LOCAL_JUDGE_NGRAM", 2))
+# sample_prompt.txt の基準 (70%以上: 高, 30%以上: 中, それ未満: 低)
+HIGH_THRESHOLD = 70
+MID_THRESHOLD = 30
+# 境界からこの幅以内のスコアは曖昧としてLLMに判定させる
+AMBIGUOUS_MARGIN = float(os.getenv("LOCAL_JUDGE_MARGIN", 5))
+
+_SPACES = re.compile(r"\s+")
+
+def normalize(text):
+    return _SPACES.sub("", str(text or "")).lower()
+
+def ngrams(text, n=NGRAM):
+    text = normalize(text)
+    if len(text) < n:
+        return [text] if text else []
+    return [text[i:i + n] for i in range(len(text) - n + 1)]
+
+def score_pairs(queries, targets, n=NGRAM):
+    """各組 (queries[i], targets[i]) の n-gram 一致度 (Dice係数, 0〜100) をまとめて返す"""
+    count = len(queries)
+    if count == 0:
+        return np.zeros(0)
+    vocab = {}
+    q_keys, t_keys = [], []
+    # n-gram に通し番号を振り、(組番号, n-gram番号) を1つの整数にまとめる
+    for i, (q, t) in enumerate(zip(queries, targets)):
+        for keys, text in ((q_keys, q), (t_keys, t)):
+            keys.extend((i, vocab.setdefault(g, len(vocab))) for g in set(ngrams(text, n)))
+    width = max(len(vocab), 1)
+    q = np.unique(np.array([i * width + g for i, g in q_keys], dtype=np.int64))
+    t = np.unique(np.array([i * width + g for i, g in t_keys], dtype=np.int64))
+    common = np.intersect1d(q, t, assume_unique=True)
+    q_size = np.bincount(q // width, minlength=count)
+    t_size = np.bincount(t // width, minlength=count)
+    overlap = np.bincount(common // width, minlength=count)
+    total = q_size + t_size
+    return np.where(total > 0, 200.0 * overlap / np.maximum(total, 1), 0.0)
+
+def level(score):
+    if score >= HIGH_THRESHOLD:
+        return "高"
+    if score >= MID_THRESHOLD:
+        return "中"
+    return "低"
+
+def is_ambiguous(score):
+    return any(abs(score - b) < AMBIGUOUS_MARGIN for b in (HIGH_THRESHOLD, MID_THRESHOLD))
+
+def judge_pairs(query, candidates):
+    """1行の候補をまとめて判定する。曖昧なものは None を返す"""
+    scores = score_pairs([query] * len(candidates), [c.get("要件") for c in candidates])
+    results = []
+    for candidate, score in zip(candidates, scores):
+        score = int(round(float(score)))
+        if is_ambiguous(score):
+            results.append(None)
+            continue
+        results.append({
+            "judge": candidate.get("回答"),
+            "score": score,
+            "reason": f"文言の一致度が{score}%のため、信頼度は{level(score)}です",
+            "local": True,
+        })
+    return results
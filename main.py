@@ -2,6 +2,7 @@ import asyncio
 # user modules
 import req_wxai as GEN
 import req_wml as SPM
+import iam_token as IAM
 
 # LOG
 import logging
@@ -9,6 +10,7 @@ logging.basicConfig(format='[%(asctime)s] %(message)s', level=logging.INFO)
 logger = logging.getLogger("LOG")
 
 # env
+import os
 # from dotenv import load_dotenv
 # load_dotenv()
 
@@ -20,7 +22,8 @@ C_RST = '\033[0m'
 def start():
     # GEN.call_genai({"prompt": "IBM Watsonとはなんですか？"})
     # asyncio.run(VDB.add_vdb(["Hello", "world"]))
-    iam_token = SPM.get_iam_token()
+    # ワーカーと共有しているIAMトークンを使う
+    iam_token = IAM.get_provider(os.getenv("API_KEY")).get_token()
     print("token:", iam_token)
 
     input_fields = ["id", "Comments", "Gender", "Reason"]
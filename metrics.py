@@ -0,0 +1,166 @@
+# リクエスト・上流呼び出しの計測
+# 区間ごとの所要時間をヒストグラムに集計し、/metrics (Prometheus形式) と Server-Timing ヘッダーで公開する
+import bisect
+import contextvars
+import threading
+import time
+from contextlib import contextmanager
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000)
+
+# リクエスト内で記録した区間 (Server-Timing 用)
+_spans = contextvars.ContextVar("spans", default=None)
+
+class Histogram:
+    """ラベル別の累積ヒストグラム"""
+
+    def __init__(self, name, help, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(buckets)
+        self._series = {}  # labels(tuple) -> [bucket counts..., sum, count]
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [0] * (len(self.buckets) + 2)
+            if i < len(self.buckets):
+                series[i] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    def expose(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            items = [(key, list(series)) for key, series in self._series.items()]
+        for key, series in items:
+            base = ",".join(f'{k}="{v}"' for k, v in key)
+            sep = "," if base else ""
+            cumulative = 0
+            for bound, n in zip(self.buckets, series):
+                cumulative += n
+                lines.append(f'{self.name}_bucket{{{base}{sep}le="{bound}"}} {cumulative}')
+            lines.append(f'{self.name}_bucket{{{base}{sep}le="+Inf"}} {series[-1]}')
+            lines.append(f"{self.name}_sum{{{base}}} {series[-2]}")
+            lines.append(f"{self.name}_count{{{base}}} {series[-1]}")
+        return lines
+
+class Counter:
+    """ラベル別のカウンター"""
+
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, value=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + value
+
+    def expose(self):
+        # テキスト形式では HELP / TYPE にもサンプルと同じ _total 付きの名前を使う
+        family = f"{self.name}_total"
+        lines = [f"# HELP {family} {self.help}", f"# TYPE {family} counter"]
+        with self._lock:
+            items = list(self._values.items())
+        for key, value in items:
+            base = ",".join(f'{k}="{v}"' for k, v in key)
+            lines.append(f"{family}{{{base}}} {value}" if base else f"{family} {value}")
+        return lines
+
+request_seconds = Histogram("http_request_duration_seconds", "Endpoint latency")
+upstream_seconds = Histogram("upstream_call_duration_seconds", "Upstream (Discovery / watsonx.ai) call latency")
+span_seconds = Histogram("span_duration_seconds", "Internal span latency (parse, serialize, ...)")
+wd_results = Histogram("wd_query_results", "Results returned per Discovery query", COUNT_BUCKETS)
+genai_tokens = Histogram("genai_generated_tokens", "Generated tokens per generation", COUNT_BUCKETS)
+genai_token_total = Counter("genai_tokens", "Tokens processed by watsonx.ai")
+upstream_retries = Counter("upstream_retries", "Upstream calls retried after 429 / 5xx / connection errors")
+upstream_hedges = Counter("upstream_hedges", "Hedged duplicate requests sent for slow idempotent reads")
+upstream_failures = Counter("upstream_failures", "Upstream calls failed fast (deadline exceeded / circuit open)")
+upstream_breaker_transitions = Counter("upstream_breaker_transitions", "Circuit breaker state changes")
+
+REGISTRY = [
+    request_seconds, upstream_seconds, span_seconds, wd_results, genai_tokens, genai_token_total,
+    upstream_retries, upstream_hedges, upstream_failures, upstream_breaker_transitions,
+]
+
+def _record_span(name, elapsed):
+    spans = _spans.get()
+    if spans is not None:
+        spans.append((name, elapsed))
+
+@contextmanager
+def upstream(service, op):
+    """上流呼び出し1回分の計測"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        upstream_seconds.observe(elapsed, service=service, op=op)
+        _record_span(f"{service}_{op}", elapsed)
+
+@contextmanager
+def span(name):
+    """アプリ内の区間 (JSON解析など) の計測"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        span_seconds.observe(elapsed, span=name)
+        _record_span(name, elapsed)
+
+def expose():
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.expose())
+    return "\n".join(lines) + "\n"
+
+def server_timing(spans, total):
+    parts = [f"{name};dur={elapsed * 1000:.1f}" for name, elapsed in spans]
+    parts.append(f"app;dur={total * 1000:.1f}")
+    return ", ".join(parts)
+
+class MetricsMiddleware:
+    """エンドポイントごとの所要時間の記録と Server-Timing ヘッダーの付与"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        start = time.perf_counter()
+        spans = []
+        token = _spans.set(spans)
+        status = {"code": 500}
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                status["code"] = message["status"]
+                # ヘッダー送信時点までに記録された区間を付ける
+                header = server_timing(list(spans), time.perf_counter() - start)
+                message["headers"] = list(message.get("headers", [])) + [
+                    (b"server-timing", header.encode("latin-1"))
+                ]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            _spans.reset(token)
+            route = scope.get("route")
+            request_seconds.observe(
+                time.perf_counter() - start,
+                path=getattr(route, "path", "static"),
+                method=scope["method"],
+                status=status["code"],
+            )
@@ -0,0 +1,485 @@
+# 取り込んだドキュメントのローカルミラーインデックス
+# 文字 n-gram の TF-IDF を転置配列 (特徴 -> 文書) で保持し、Discovery 結果の再ランキングと
+# Discovery が遅い・制限されているときの代替検索に使う
+#
+# コレクションごとに操作ログ (JSONL) を全ワーカーで共有し、ログから作ったスナップショットを
+# .npy ファイルに書き出して mmap で読み込む (ページキャッシュをワーカー間で共有する)
+import fcntl
+import json
+import shutil
+import tempfile
+import threading
+import time
+import zlib
+from collections import Counter
+
+import numpy as np
+import orjson
+
+# Module files
+import local_judge as LOCAL
+import xlsx_stream as XLSX
+
+# env
+import os
+from dotenv import load_dotenv
+load_dotenv()
+
+# LOG
+import logging
+logging.basicConfig(format='[%(asctime)s] %(message)s', level=logging.INFO)
+logger = logging.getLogger("LOG")
+
+MIRROR_INDEX_DIR = os.getenv("MIRROR_INDEX_DIR", os.path.join(tempfile.gettempdir(), "wx_mirror_index"))
+# ログが更新されてからスナップショットを作り直すまでの最短間隔(秒)
+MIRROR_REFRESH_INTERVAL = float(os.getenv("MIRROR_REFRESH_INTERVAL", 5))
+# 索引するフィールド / 検索結果として返すフィールド
+MIRROR_FIELDS = [f for f in os.getenv("MIRROR_FIELDS", "要件,カテゴリ").split(",") if f]
+# (代替検索の結果を判定・出力にそのまま使えるよう、取り込み時と同じ項目を保持する)
+RESULT_FIELDS = XLSX.IMPORT_FIELDS + ["行番号", "シート名", "ファイル名"]
+# 1回の集計で作るスコア行列の上限 (クエリ数 x 文書数)
+MAX_SCORE_CELLS = 1 << 22
+
+def feature_ids(text):
+    """文字 n-gram を 32bit のハッシュ値にする (ワーカー間で同じ値になるよう crc32 を使う)"""
+    return [zlib.crc32(g.encode("utf-8")) for g in LOCAL.ngrams(text)]
+
+def document_entry(file):
+    """add_document に渡した file (JSON文字列/辞書/配列) から索引用の本文と返却項目を取り出す"""
+    if isinstance(file, (bytes, str)):
+        try:
+            file = json.loads(file)
+        except (ValueError, TypeError):
+            return None
+    rows = [r for r in (file if isinstance(file, list) else [file]) if isinstance(r, dict)]
+    if not rows:
+        return None
+    text = " ".join(str(r.get(f) or "") for r in rows for f in MIRROR_FIELDS)
+    fields = {f: rows[0][f] for f in RESULT_FIELDS if f in rows[0]}
+    return {"text": text, "fields": fields}
+
+class Snapshot:
+    """1コレクション分の TF-IDF 転置配列 (mmap)"""
+
+    def __init__(self, path, log_id):
+        self.path = path
+        self.log_id = log_id
+        with open(os.path.join(path, "docs.json"), "rb") as f:
+            docs = orjson.loads(f.read())
+        self.doc_ids = [d["id"] for d in docs]
+        self.fields = [d["fields"] for d in docs]
+        self.positions = {doc_id: i for i, doc_id in enumerate(self.doc_ids)}
+        load = lambda name: np.load(os.path.join(path, f"{name}.npy"), mmap_mode="r")
+        self.features = load("features")  # 昇順の特徴ハッシュ
+        self.idf = load("idf")
+        self.indptr = load("indptr")  # features[i] の文書は postings[indptr[i]:indptr[i+1]]
+        self.postings = load("postings")
+        self.weights = load("weights")  # 文書ベクトルはL2正規化済み
+
+    def __len__(self):
+        return len(self.doc_ids)
+
+    def score(self, queries):
+        """クエリごとの全文書に対するコサイン類似度 (クエリ数 x 文書数) を返す"""
+        n_docs = len(self)
+        scores = np.zeros((len(queries), n_docs), dtype=np.float32)
+        if n_docs == 0 or len(self.features) == 0:
+            return scores
+        step = max(1, MAX_SCORE_CELLS // n_docs)
+        for start in range(0, len(queries), step):
+            scores[start:start + step] = self._score_chunk(queries[start:start + step])
+        return scores
+
+    def _score_chunk(self, queries):
+        n_queries, n_docs = len(queries), len(self)
+        rows, feats, tfs = [], [], []
+        for qi, query in enumerate(queries):
+            counts = Counter(feature_ids(query))
+            rows.extend([qi] * len(counts))
+            feats.extend(counts.keys())
+            tfs.extend(counts.values())
+        rows = np.array(rows, dtype=np.int64)
+        feats = np.array(feats, dtype=np.int64)
+        tfs = np.array(tfs, dtype=np.float32)
+
+        # 索引にある特徴だけを残す
+        pos = np.searchsorted(self.features, feats)
+        found = pos < len(self.features)
+        found[found] = self.features[pos[found]] == feats[found]
+        rows, pos = rows[found], pos[found]
+        weights = tfs[found] * self.idf[pos]
+        norms = np.sqrt(np.bincount(rows, weights=weights * weights, minlength=n_queries))
+        weights = weights / np.maximum(norms[rows], 1e-12)
+
+        # 特徴ごとの文書リストを展開して (クエリ, 文書) ごとに加算する
+        starts = self.indptr[pos]
+        lengths = self.indptr[pos + 1] - starts
+        offsets = np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+        offsets += np.repeat(starts, lengths)
+        cells = np.repeat(rows, lengths) * n_docs + self.postings[offsets]
+        values = np.repeat(weights, lengths) * self.weights[offsets]
+        scores = np.bincount(cells, weights=values, minlength=n_queries * n_docs)
+        return scores.reshape(n_queries, n_docs)
+
+def build_snapshot(path, docs):
+    """{document_id: entry} から TF-IDF 転置配列を作って path に書き出す"""
+    os.makedirs(path)
+    ids = list(docs)
+    doc_rows, doc_feats, doc_tfs = [], [], []
+    for i, doc_id in enumerate(ids):
+        counts = Counter(feature_ids(docs[doc_id]["text"]))
+        doc_rows.extend([i] * len(counts))
+        doc_feats.extend(counts.keys())
+        doc_tfs.extend(counts.values())
+    doc_rows = np.array(doc_rows, dtype=np.int32)
+    doc_feats = np.array(doc_feats, dtype=np.int64)
+    tfs = np.array(doc_tfs, dtype=np.float32)
+
+    # 特徴ハッシュ順に並べ替えて転置配列にする
+    order = np.lexsort((doc_rows, doc_feats))
+    doc_rows, doc_feats, tfs = doc_rows[order], doc_feats[order], tfs[order]
+    features, df = np.unique(doc_feats, return_counts=True)
+    idf = (np.log((len(ids) + 1) / (df + 1)) + 1).astype(np.float32)
+    indptr = np.concatenate(([0], np.cumsum(df))).astype(np.int64)
+    weights = tfs * np.repeat(idf, df)
+    norms = np.sqrt(np.bincount(doc_rows, weights=weights * weights, minlength=len(ids)))
+    weights = (weights / np.maximum(norms[doc_rows], 1e-12)).astype(np.float32)
+
+    for name, arr in (("features", features), ("idf", idf), ("indptr", indptr),
+                      ("postings", doc_rows), ("weights", weights)):
+        np.save(os.path.join(path, f"{name}.npy"), arr)
+    with open(os.path.join(path, "docs.json"), "wb") as f:
+        f.write(orjson.dumps([{"id": d, "fields": docs[d]["fields"]} for d in ids]))
+
+class MirrorIndex:
+    """コレクションごとの操作ログとスナップショットを管理する
+
+    スナップショットには作成時点までの全文書 (entries.json) を保存し、反映済みの操作はログから
+    取り除く (ログにはスナップショット以降の操作だけが残る)。作り直しはバックグラウンドで行い、
+    完了するまでは前のスナップショットで応答する
+    """
+
+    def __init__(self, path, refresh_interval=MIRROR_REFRESH_INTERVAL):
+        self.path = path
+        self.refresh_interval = refresh_interval
+        self._snapshots = {}  # collection_id -> Snapshot
+        self._checked = {}  # collection_id -> 最終確認時刻
+        self._building = set()  # 作り直し中の collection_id
+        self._lock = threading.Lock()
+        self._rebuilds = 0
+        self._compacted = 0
+        os.makedirs(self.path, exist_ok=True)
+
+    def _dir(self, collection_id):
+        return os.path.join(self.path, collection_id)
+
+    def _log(self, collection_id):
+        return os.path.join(self._dir(collection_id), "ops.jsonl")
+
+    def _log_lock(self, collection_id):
+        # ログは圧縮時に置き換えるため、ログ自体ではなく別のファイルでロックする
+        f = open(os.path.join(self._dir(collection_id), "log.lock"), "w")
+        fcntl.flock(f, fcntl.LOCK_EX)
+        return f
+
+    def _append(self, collection_id, rec):
+        os.makedirs(self._dir(collection_id), exist_ok=True)
+        # 複数ワーカーから追記されるため排他ロックを取る
+        with self._log_lock(collection_id), open(self._log(collection_id), "ab") as f:
+            f.write(orjson.dumps(rec) + b"\n")
+        self._checked.pop(collection_id, None)
+
+    def add_document(self, collection_id, document_id, file):
+        entry = document_entry(file)
+        if entry:
+            self._append(collection_id, {"op": "put", "id": document_id, **entry})
+
+    def remove_document(self, collection_id, document_id):
+        if os.path.exists(self._log(collection_id)):
+            self._append(collection_id, {"op": "del", "id": document_id})
+
+    def _log_id(self, collection_id):
+        try:
+            st = os.stat(self._log(collection_id))
+        except FileNotFoundError:
+            return None
+        return (st.st_ino, st.st_size)
+
+    def _pointer(self, collection_id):
+        """current の内容 (スナップショット名, 反映済みのログの inode, 位置)"""
+        try:
+            with open(os.path.join(self._dir(collection_id), "current"), "r") as f:
+                name, ino, offset = f.read().split()
+            return name, (int(ino), int(offset))
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def _set_pointer(self, collection_id, name, log_id):
+        current = os.path.join(self._dir(collection_id), "current")
+        tmp = f"{current}.{os.getpid()}.tmp"
+        with open(tmp, "w") as f:
+            f.write(f"{name} {log_id[0]} {log_id[1]}")
+        os.replace(tmp, current)
+
+    @staticmethod
+    def _read_ops(f, position):
+        """開いたログの position 以降の操作を返す (操作, 読み終えた位置)"""
+        ops = []
+        f.seek(position)
+        for line in f:
+            if not line.endswith(b"\n"):
+                # 書き込み途中の行は次回に回す
+                break
+            position += len(line)
+            ops.append(orjson.loads(line))
+        return ops, position
+
+    @staticmethod
+    def _apply(docs, ops):
+        for rec in ops:
+            if rec["op"] == "put":
+                docs[rec["id"]] = {"text": rec["text"], "fields": rec["fields"]}
+            else:
+                docs.pop(rec["id"], None)
+
+    def _replay(self, collection_id, docs, ino, offset):
+        """スナップショットの文書にログの offset 以降の操作を反映し、ログの (inode, 読み終えた位置) を返す"""
+        with open(self._log(collection_id), "rb") as f:
+            st = os.fstat(f.fileno())
+            # 圧縮で置き換わったログは先頭から (スナップショット以降の操作だけを含む)
+            ops, position = self._read_ops(f, offset if st.st_ino == ino else 0)
+            self._apply(docs, ops)
+            return st.st_ino, position
+
+    def collections(self):
+        """ログのあるコレクション"""
+        return sorted(
+            e.name for e in os.scandir(self.path)
+            if e.is_dir() and os.path.exists(os.path.join(e.path, "ops.jsonl"))
+        )
+
+    def entries(self, collection_id):
+        """全文書 {document_id: entry} と、読み終えたログの (inode, 位置) を返す (ログが無ければ None)
+
+        スナップショットを作らずに、現在のスナップショットの文書にログの操作を反映する
+        """
+        if not os.path.exists(self._log(collection_id)):
+            return None
+        # 圧縮と重ならないよう、current とログはロックを取ってから開く
+        with self._log_lock(collection_id):
+            pointer = self._pointer(collection_id)
+            snap = None
+            if pointer is not None:
+                snap = open(os.path.join(self._dir(collection_id), pointer[0], "entries.json"), "rb")
+            log = open(self._log(collection_id), "rb")
+        docs = {}
+        with log:
+            if snap is not None:
+                with snap:
+                    docs = orjson.loads(snap.read())
+            offset = pointer[1][1] if pointer is not None else 0
+            ops, position = self._read_ops(log, offset)
+            self._apply(docs, ops)
+            return docs, (os.fstat(log.fileno()).st_ino, position)
+
+    def changes(self, collection_id, position):
+        """entries / changes が返した位置以降の操作と、新しい位置を返す
+
+        ログが圧縮で置き換わっていれば None (entries で読み直す)
+        """
+        try:
+            with open(self._log(collection_id), "rb") as log:
+                if os.fstat(log.fileno()).st_ino != position[0]:
+                    return None
+                ops, offset = self._read_ops(log, position[1])
+                return ops, (position[0], offset)
+        except FileNotFoundError:
+            return None
+
+    def _compact(self, collection_id, name, log_id):
+        """反映済みの操作をログから取り除き、current を新しいログの先頭に向ける"""
+        log = self._log(collection_id)
+        with self._log_lock(collection_id):
+            with open(log, "rb") as f:
+                if os.fstat(f.fileno()).st_ino != log_id[0]:
+                    return
+                f.seek(log_id[1])
+                tail = f.read()
+            tmp = f"{log}.{os.getpid()}.tmp"
+            with open(tmp, "wb") as f:
+                f.write(tail)
+            os.replace(tmp, log)
+            self._set_pointer(collection_id, name, (os.stat(log).st_ino, 0))
+        self._compacted += 1
+
+    def _rebuild(self, collection_id):
+        """前のスナップショットとログから新しいスナップショットを作り、current を切り替える (作成は1ワーカーのみ)"""
+        base = self._dir(collection_id)
+        with open(os.path.join(base, "build.lock"), "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            pointer = self._pointer(collection_id)
+            if pointer is not None and pointer[1] == self._log_id(collection_id):
+                # 他のワーカーが作成済み
+                return
+            docs, ino, offset = {}, None, 0
+            if pointer is not None:
+                with open(os.path.join(base, pointer[0], "entries.json"), "rb") as f:
+                    docs = orjson.loads(f.read())
+                ino, offset = pointer[1]
+            log_id = self._replay(collection_id, docs, ino, offset)
+            name = f"snap-{time.time_ns()}"
+            path = os.path.join(base, name)
+            build_snapshot(path, docs)
+            with open(os.path.join(path, "entries.json"), "wb") as f:
+                f.write(orjson.dumps(docs))
+            self._set_pointer(collection_id, name, log_id)
+            self._compact(collection_id, name, log_id)
+            self._rebuilds += 1
+            # 読み込み中のワーカーがあるため直前のスナップショットは残す
+            snaps = sorted(e.name for e in os.scandir(base) if e.is_dir() and e.name.startswith("snap-"))
+            for old in snaps[:-2]:
+                shutil.rmtree(os.path.join(base, old), ignore_errors=True)
+            logger.info(f"mirror_index: rebuilt {collection_id} ({len(docs)} docs)")
+
+    def _load(self, collection_id, pointer):
+        """current のスナップショットを読み込む"""
+        try:
+            return Snapshot(os.path.join(self._dir(collection_id), pointer[0]), pointer[1])
+        except FileNotFoundError:
+            # 読み込み中に古いスナップショットが削除された
+            return None
+
+    def _refresh(self, collection_id):
+        try:
+            self._rebuild(collection_id)
+            pointer = self._pointer(collection_id)
+            snap = pointer and self._load(collection_id, pointer)
+            if snap is not None:
+                with self._lock:
+                    self._snapshots[collection_id] = snap
+        except Exception as e:
+            logger.error(f"mirror_index: rebuild {collection_id} failed ({str(e)})")
+        finally:
+            with self._lock:
+                self._building.discard(collection_id)
+                self._checked.pop(collection_id, None)
+
+    def snapshot(self, collection_id, wait=False):
+        """利用できるスナップショットを返す (ログが無ければ None)
+
+        ログが更新されていればバックグラウンドで作り直し、それまでは前のスナップショットを返す。
+        wait=True なら作り直しの完了を待つ
+        """
+        now = time.monotonic()
+        with self._lock:
+            snap = self._snapshots.get(collection_id)
+            if snap is not None and now - self._checked.get(collection_id, 0) < self.refresh_interval:
+                return snap
+            log_id = self._log_id(collection_id)
+            if log_id is None:
+                self._snapshots.pop(collection_id, None)
+                return None
+            if snap is None or snap.log_id != log_id:
+                # 他のワーカーが作ったスナップショットがあれば読み込む
+                pointer = self._pointer(collection_id)
+                if pointer is not None and (snap is None or pointer[1] != snap.log_id):
+                    loaded = self._load(collection_id, pointer)
+                    if loaded is not None:
+                        snap = self._snapshots[collection_id] = loaded
+            self._checked[collection_id] = now
+            stale = snap is None or snap.log_id != log_id
+            start = stale and collection_id not in self._building
+            if start:
+                self._building.add(collection_id)
+        if start:
+            if wait:
+                self._refresh(collection_id)
+                return self._snapshots.get(collection_id)
+            threading.Thread(
+                target=self._refresh, args=(collection_id,), name="mirror-rebuild", daemon=True
+            ).start()
+        return snap
+
+    def covers(self, collection_ids):
+        """全コレクションにローカルの文書があるか"""
+        return bool(collection_ids) and all(
+            (snap := self.snapshot(c)) is not None and len(snap) > 0 for c in collection_ids
+        )
+
+    def search(self, collection_ids, queries, count):
+        """複数クエリをまとめて検索し、クエリごとに (collection_id, 位置, スコア) の上位 count 件を返す"""
+        hits = [[] for _ in queries]
+        for collection_id in collection_ids:
+            snap = self.snapshot(collection_id)
+            if snap is None or len(snap) == 0:
+                continue
+            scores = snap.score(queries)
+            k = min(count, len(snap))
+            top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+            for qi, positions in enumerate(top):
+                hits[qi].extend(
+                    (collection_id, snap, int(p), float(scores[qi, p]))
+                    for p in positions if scores[qi, p] > 0
+                )
+        return [sorted(h, key=lambda hit: -hit[3])[:count] for h in hits]
+
+    def score_documents(self, collection_ids, query, document_ids):
+        """指定した文書の類似度 {document_id: score} を返す (索引にない文書は含まない)"""
+        ret = {}
+        for collection_id in collection_ids:
+            snap = self.snapshot(collection_id)
+            if snap is None or len(snap) == 0:
+                continue
+            positions = [(d, snap.positions[d]) for d in document_ids if d in snap.positions]
+            if not positions:
+                continue
+            scores = snap.score([query])[0]
+            ret.update((d, float(scores[p])) for d, p in positions)
+        return ret
+
+    def stats(self):
+        with self._lock:
+            return {
+                "collections": {c: len(s) for c, s in self._snapshots.items()},
+                "rebuilds": self._rebuilds,
+                "compactions": self._compacted,
+                "building": sorted(self._building),
+            }
+
+def to_query_result(hits):
+    """search の結果を Discovery の query 応答と同じ形にする"""
+    results = []
+    for collection_id, snap, position, score in hits:
+        fields = snap.fields[position]
+        confidence = round(score, 4)
+        results.append({
+            "document_id": snap.doc_ids[position],
+            **fields,
+            "result_metadata": {"collection_id": collection_id, "confidence": confidence},
+            # 画面の信頼度しきい値は先頭パッセージの回答信頼度で判定するため類似度を入れる
+            "document_passages": [{
+                "passage_text": fields.get("要件", ""),
+                "field": "要件",
+                "answers": [{"answer_text": fields.get("要件", ""), "confidence": confidence}],
+            }],
+        })
+    return {"matching_results": len(results), "results": results, "local_search": True}
+
+def rerank(ret, collection_ids, query, weight):
+    """Discovery の結果を confidence とローカル類似度の加重平均で並べ替える"""
+    results = ret.get("results") or []
+    if weight <= 0 or len(results) < 2:
+        return ret
+    scores = mirror_index.score_documents(
+        collection_ids, query, [r.get("document_id") for r in results]
+    )
+    if not scores:
+        return ret
+    def blended(res):
+        confidence = (res.get("result_metadata") or {}).get("confidence", 0)
+        local = scores.get(res.get("document_id"))
+        return confidence if local is None else (1 - weight) * confidence + weight * local
+    ret["results"] = sorted(results, key=blended, reverse=True)
+    return ret
+
+mirror_index = MirrorIndex(MIRROR_INDEX_DIR)
@@ -0,0 +1,362 @@
+# 稼働中のリクエストのプロファイル取得
+# PROFILE_ENABLED と管理トークンを設定したときだけ有効になり、
+#   - エンドポイントごとに指定した割合のリクエスト
+#   - X-Profile ヘッダーに管理トークンを付けたリクエスト
+# を統計的 (スタックのサンプリング) または決定的 (cProfile) なプロファイラで記録してファイルに保存する
+#
+# 記録するのはリクエストを処理しているスレッドだけ:
+#   - イベントループのスレッドは、リクエストのタスク (とそこから作られたタスク) の実行中のみ
+#   - Discovery・watsonx.ai の呼び出しなどスレッドで実行する処理は、traced() で包んで投入したもの
+import asyncio
+import contextlib
+import contextvars
+import cProfile
+import functools
+import hmac
+import itertools
+import json
+import os
+import pstats
+import random
+import re
+import sys
+import tempfile
+import threading
+import time
+import weakref
+from collections import Counter
+
+# env
+from dotenv import load_dotenv
+load_dotenv()
+
+# LOG
+import logging
+logging.basicConfig(format='[%(asctime)s] %(message)s', level=logging.INFO)
+logger = logging.getLogger("LOG")
+
+PROFILE_ENABLED = os.getenv("PROFILE_ENABLED", "false").lower() in ("1", "true")
+PROFILE_ADMIN_TOKEN = os.getenv("PROFILE_ADMIN_TOKEN", "")
+PROFILE_DIR = os.getenv("PROFILE_DIR", os.path.join(tempfile.gettempdir(), "wx_profiles"))
+PROFILE_HEADER = os.getenv("PROFILE_HEADER", "X-Profile").lower().encode()
+# 保存するプロファイルの上限 (古いものから削除)
+PROFILE_MAX_FILES = int(os.getenv("PROFILE_MAX_FILES", 200))
+# 統計的プロファイラのサンプリング間隔(秒)
+PROFILE_SAMPLE_INTERVAL = float(os.getenv("PROFILE_SAMPLE_INTERVAL", 0.005))
+MODES = ("statistical", "deterministic")
+# サンプリング設定はワーカー間で共有するためファイルに置き、この間隔で読み直す
+RULES_CHECK_INTERVAL = 1.0
+
+_NAME = re.compile(r"^[\w.-]+\.(prof|txt)$")
+# スレッドプールのスレッド名の連番 (wd_3, upstream_12 など) はまとめて表示する
+_THREAD_SEQ = re.compile(r"[_-]\d+$")
+
+# プロファイル中のリクエストのプロファイラ (タスク・スレッドへ引き継ぐ)
+_active = contextvars.ContextVar("profiler", default=None)
+
+def enabled():
+    return PROFILE_ENABLED and bool(PROFILE_ADMIN_TOKEN)
+
+def authorized(token):
+    return enabled() and bool(token) and hmac.compare_digest(token, PROFILE_ADMIN_TOKEN)
+
+def traced(func):
+    """スレッドで実行する関数を、プロファイル中のリクエストならそのスレッドも記録するように包む
+
+    投入する側 (リクエストのコンテキスト) で呼び出す。プロファイル中でなければ func をそのまま返す
+    """
+    profiler = _active.get()
+    if profiler is None:
+        return func
+
+    @functools.wraps(func)
+    def run(*args, **kwargs):
+        with profiler.trace_thread():
+            return func(*args, **kwargs)
+    return run
+
+def _task_factory(previous):
+    """プロファイル中のリクエストから作られたタスクをプロファイラに登録するタスクファクトリ"""
+    def factory(loop, coro, **kwargs):
+        if previous is not None:
+            task = previous(loop, coro, **kwargs)
+        else:
+            task = asyncio.Task(coro, loop=loop, **kwargs)
+        context = kwargs.get("context")
+        profiler = context.get(_active) if context is not None else _active.get()
+        if profiler is not None:
+            profiler.add_task(task)
+        return task
+    return factory
+
+_factory_loops = weakref.WeakSet()
+
+def _install_task_factory(loop):
+    if loop not in _factory_loops:
+        loop.set_task_factory(_task_factory(loop.get_task_factory()))
+        _factory_loops.add(loop)
+
+class StackSampler:
+    """リクエストを処理するスレッドのスタックを一定間隔で記録する統計的プロファイラ
+
+    イベントループのスレッドは、リクエストのタスクを実行している間のサンプルだけを数える
+    (同じループで並行して処理している他のリクエストは含めない)
+    """
+
+    def __init__(self, loop, interval=PROFILE_SAMPLE_INTERVAL):
+        self.loop = loop
+        self.loop_thread = threading.get_ident()
+        self.interval = interval
+        self.stacks = Counter()
+        self._tasks = weakref.WeakSet()
+        self._threads = {}  # thread_id -> (スレッド名, 実行中の traced 呼び出し数)
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="profile-sampler", daemon=True)
+
+    def add_task(self, task):
+        self._tasks.add(task)
+
+    @contextlib.contextmanager
+    def trace_thread(self):
+        tid = threading.get_ident()
+        with self._lock:
+            name, depth = self._threads.get(tid, (threading.current_thread().name, 0))
+            self._threads[tid] = (name, depth + 1)
+        try:
+            yield
+        finally:
+            with self._lock:
+                name, depth = self._threads[tid]
+                if depth > 1:
+                    self._threads[tid] = (name, depth - 1)
+                else:
+                    del self._threads[tid]
+
+    def _record(self, name, frame):
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+            frame = frame.f_back
+        if stack:
+            # スレッドごとに分けて表示できるよう、先頭にスレッド名を付ける
+            stack.append(f"[{_THREAD_SEQ.sub('', name)}]")
+            self.stacks[";".join(reversed(stack))] += 1
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frames = sys._current_frames()
+            if asyncio.current_task(self.loop) in self._tasks:
+                self._record("event-loop", frames.get(self.loop_thread))
+            with self._lock:
+                threads = [(tid, name) for tid, (name, _) in self._threads.items()]
+            for tid, name in threads:
+                self._record(name, frames.get(tid))
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self, path):
+        self._stop.set()
+        self._thread.join()
+        # flamegraph.pl / speedscope で読める collapsed stack 形式
+        with open(path, "w", encoding="utf-8") as f:
+            for stack, count in self.stacks.most_common():
+                f.write(f"{stack} {count}\n")
+
+class DeterministicProfiler:
+    """cProfile による決定的プロファイラ
+
+    traced() で投入したスレッドはスレッドごとに記録して結果にまとめる。イベントループの
+    スレッドの記録には、同じループで並行して処理している他のリクエストも含まれる
+    """
+
+    def __init__(self):
+        self.profile = cProfile.Profile()
+        self._profiles = []  # traced() のスレッドの記録
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def add_task(self, task):
+        pass
+
+    @contextlib.contextmanager
+    def trace_thread(self):
+        # 同じスレッドで入れ子になった呼び出しは外側の記録に含まれる
+        if getattr(self._local, "tracing", False):
+            yield
+            return
+        self._local.tracing = True
+        profile = cProfile.Profile()
+        profile.enable()
+        try:
+            yield
+        finally:
+            profile.disable()
+            self._local.tracing = False
+            with self._lock:
+                self._profiles.append(profile)
+
+    def start(self):
+        self.profile.enable()
+
+    def stop(self, path):
+        self.profile.disable()
+        with self._lock:
+            profiles = [p for p in [self.profile] + self._profiles if p.getstats()]
+        if not profiles:
+            self.profile.dump_stats(path)
+            return
+        stats = pstats.Stats(profiles[0])
+        for profile in profiles[1:]:
+            stats.add(profile)
+        stats.dump_stats(path)
+
+class ProfileStore:
+    """サンプリング設定とプロファイルファイルの管理"""
+
+    def __init__(self, path):
+        self.path = path
+        self.rules = {}  # path -> {"rate", "mode", "remaining"}
+        self._rules_file = os.path.join(path, "sampling.json")
+        self._rules_mtime = None
+        self._checked = 0
+        self._lock = threading.Lock()
+        self._seq = itertools.count(1)
+
+    def _refresh_rules(self):
+        now = time.monotonic()
+        if now - self._checked < RULES_CHECK_INTERVAL:
+            return
+        self._checked = now
+        try:
+            mtime = os.stat(self._rules_file).st_mtime
+        except FileNotFoundError:
+            self.rules, self._rules_mtime = {}, None
+            return
+        if mtime != self._rules_mtime:
+            try:
+                with open(self._rules_file, "r", encoding="utf-8") as f:
+                    self.rules = json.load(f)
+                self._rules_mtime = mtime
+            except ValueError:
+                pass
+
+    def set_rule(self, path, rate, mode, limit):
+        """path のリクエストを rate の割合で最大 limit 件記録する (rate 0 で解除)"""
+        os.makedirs(self.path, exist_ok=True)
+        with self._lock:
+            self._checked = 0
+            self._refresh_rules()
+            rules = dict(self.rules)
+            if rate > 0:
+                rules[path] = {"rate": rate, "mode": mode, "remaining": limit}
+            else:
+                rules.pop(path, None)
+            tmp = f"{self._rules_file}.{os.getpid()}.tmp"
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump(rules, f)
+            os.replace(tmp, self._rules_file)
+            self._checked = 0
+            self._refresh_rules()
+            return rules
+
+    def sample(self, path):
+        """このリクエストを記録する場合はプロファイラの種類を返す"""
+        self._refresh_rules()
+        rule = self.rules.get(path)
+        if rule is None or random.random() >= rule["rate"]:
+            return None
+        with self._lock:
+            # 件数の上限はワーカーごとに数える
+            if rule["remaining"] <= 0:
+                return None
+            rule["remaining"] -= 1
+        return rule["mode"]
+
+    def new_file(self, path, mode):
+        os.makedirs(self.path, exist_ok=True)
+        slug = re.sub(r"[^\w-]+", "_", path.strip("/")) or "root"
+        ext = "prof" if mode == "deterministic" else "txt"
+        stamp = time.strftime("%Y%m%d-%H%M%S")
+        # 同時刻・同一パスのリクエストでも重ならないよう連番を付ける
+        seq = next(self._seq)
+        return os.path.join(self.path, f"{stamp}-{os.getpid()}-{seq}-{slug}-{mode}.{ext}")
+
+    def prune(self):
+        files = sorted(self.list(), key=lambda f: f["mtime"])
+        for f in files[:max(0, len(files) - PROFILE_MAX_FILES)]:
+            try:
+                os.remove(os.path.join(self.path, f["name"]))
+            except FileNotFoundError:
+                pass
+
+    def list(self):
+        try:
+            entries = list(os.scandir(self.path))
+        except FileNotFoundError:
+            return []
+        return sorted(
+            ({"name": e.name, "size": e.stat().st_size, "mtime": e.stat().st_mtime}
+             for e in entries if _NAME.match(e.name)),
+            key=lambda f: f["mtime"], reverse=True,
+        )
+
+    def file_path(self, name):
+        """ダウンロード対象のパス (不正な名前・存在しない場合は None)"""
+        if not _NAME.match(name):
+            return None
+        path = os.path.join(self.path, name)
+        return path if os.path.isfile(path) else None
+
+profile_store = ProfileStore(PROFILE_DIR)
+# cProfile は同時に1つしか有効にできないため、決定的プロファイルは1件ずつ取る
+_deterministic_lock = threading.Lock()
+
+class ProfilingMiddleware:
+    """対象のリクエストをプロファイルする ASGI ミドルウェア (enabled() のときだけ追加する)"""
+
+    def __init__(self, app):
+        self.app = app
+
+    def _requested_mode(self, scope):
+        for k, v in scope["headers"]:
+            if k == PROFILE_HEADER:
+                token, _, mode = v.decode("latin-1").partition(";")
+                if authorized(token.strip()):
+                    mode = mode.strip() or "statistical"
+                    return mode if mode in MODES else "statistical"
+        return None
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        mode = self._requested_mode(scope) or profile_store.sample(scope["path"])
+        if mode is None:
+            return await self.app(scope, receive, send)
+
+        if mode == "deterministic":
+            if not _deterministic_lock.acquire(blocking=False):
+                return await self.app(scope, receive, send)
+            profiler = DeterministicProfiler()
+        else:
+            loop = asyncio.get_running_loop()
+            _install_task_factory(loop)
+            profiler = StackSampler(loop)
+            profiler.add_task(asyncio.current_task())
+        path = profile_store.new_file(scope["path"], mode)
+        # リクエストから作られるタスク・traced() で投入するスレッドへ引き継ぐ
+        token = _active.set(profiler)
+        profiler.start()
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            _active.reset(token)
+            try:
+                profiler.stop(path)
+            finally:
+                if mode == "deterministic":
+                    _deterministic_lock.release()
+            logger.info(f"profiler: saved {os.path.basename(path)}")
+            profile_store.prune()
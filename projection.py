@@ -0,0 +1,30 @@
+# Discovery 応答の項目絞り込み
+# 画面で使う項目だけを残して応答サイズとシリアライズ時間を減らす
+
+# 絞り込み時も必ず残す項目
+ALWAYS_KEEP = ("document_id", "id", "result_metadata")
+
+def project(item, fields):
+    """1件分の辞書から指定項目 (と識別子) だけを残す"""
+    if not fields or not isinstance(item, dict):
+        return item
+    keep = set(fields).union(ALWAYS_KEEP)
+    return {k: v for k, v in item.items() if k in keep}
+
+def project_query(ret, fields):
+    """検索結果 (results 配列) を絞り込む"""
+    if not fields:
+        return ret
+    return {
+        **{k: v for k, v in ret.items() if k not in ("results", "aggregations", "retrieval_details", "suggested_refinements", "table_results")},
+        "results": [project(r, fields) for r in ret.get("results", [])],
+    }
+
+def project_documents(ret, fields):
+    """ドキュメント一覧 (documents 配列) を絞り込む"""
+    if not fields:
+        return ret
+    return {
+        **ret,
+        "documents": [project(d, fields) for d in ret.get("documents", [])],
+    }
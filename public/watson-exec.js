@@ -60,6 +60,45 @@ function extractJson(text) {
   return null;
 }
 
+/**
+ * NDJSON のレスポンスを1行ずつ読み取り、行ごとにコールバックを呼びます。
+ * NDJSON 以外 (パラメータエラーなどの JSON) が返った場合は error を例外にします。
+ * @param {Response} response fetch のレスポンス
+ * @param {Function} onItem 1行ごとのコールバック (item)
+ * @param {AbortSignal} [signal] 中断用のシグナル
+ */
+async function readNdjson(response, onItem, signal) {
+  if (!response.ok) throw new Error(`API call failed: ${response.status}`);
+  if (!response.headers.get("content-type")?.includes("ndjson")) {
+    const data = await response.json();
+    throw new Error(data.error || "unexpected response");
+  }
+
+  const reader = response.body.getReader();
+  const decoder = new TextDecoder("utf-8");
+  const onAbort = () => reader.cancel();
+  signal?.addEventListener("abort", onAbort);
+  let buffer = "";
+  const handle = (line) => {
+    if (line.trim()) onItem(JSON.parse(line));
+  };
+  try {
+    while (true) {
+      const { done, value } = await reader.read();
+      if (done) break;
+      buffer += decoder.decode(value, { stream: true });
+      const lines = buffer.split("\n");
+      // 末尾の未完成の行は次のチャンクと結合する
+      buffer = lines.pop();
+      lines.forEach(handle);
+    }
+    handle(buffer + decoder.decode());
+  } finally {
+    signal?.removeEventListener("abort", onAbort);
+  }
+  if (signal?.aborted) throw new DOMException("Aborted", "AbortError");
+}
+
 // --- メインクラス (外部から利用) ---
 
 export class WatsonAPIs {
@@ -82,6 +121,9 @@ export class WatsonAPIs {
           deletedocument: "wddeletedocument",
           adddocument: "wdadddocument",
           getdocument: "wdgetdocument",
+          batchjudge: "batch/judge",
+          bulkadd: "wdbulkadd",
+          exportxlsx: "export/xlsx",
         },
       },
       llm: {
@@ -107,6 +149,15 @@ export class WatsonAPIs {
       _return: [],
     };
 
+    /**
+     * 画面とExcel出力で使う検索結果の項目 (サーバ側でこの項目だけに絞り込む)
+     */
+    this.resultFields = [
+      "カテゴリ", "要件", "回答", "備考／補足", "変更区分", "意見", "変更後要件",
+      "Ｓｉｅｒ向けコメント", "Sier向けコメント", "工数", "社内向けコメント",
+      "シート名", "行番号", "ファイル名", "document_passages",
+    ];
+
     /**
      * LLMに渡すプロンプトテンプレート
      */
@@ -143,6 +194,37 @@ export class WatsonAPIs {
     return data ? data.documents : null;
   }
 
+  /**
+   * Watson Discoveryのドキュメント一覧を詳細付きで取得します。
+   * 詳細はサーバ側で並列に取得され、ページ単位で通知されます。
+   * @param {string} collectionId 対象のコレクションID
+   * @param {boolean} isParent 親ドキュメントのみを取得するフラグ
+   * @param {Function} onPage ページごとのコールバック (documents, pageIndex)
+   * @returns {Promise<number>} ドキュメント件数
+   */
+  async fetchDocumentsWithDetails(collectionId, isParent, onPage) {
+    const apiUrl = `${this.config.api.baseUrl}${this.config.api.endpoints.listdocuments}`;
+    const response = await fetch(apiUrl, {
+      method: "POST",
+      headers: { "Content-Type": "application/json" },
+      body: JSON.stringify({
+        collection_id: collectionId,
+        is_parent: isParent,
+        include_details: true,
+      }),
+    });
+
+    let count = 0;
+    await readNdjson(response, (result) => {
+      if (result.documents && typeof onPage === "function") {
+        onPage(result.documents, result.page);
+      } else if (result.count !== undefined) {
+        count = result.count;
+      }
+    });
+    return count;
+  }
+
   /**
    * Watson Discoveryのドキュメントを削除します。
    * @param {string} collectionId 対象のコレクションID
@@ -250,6 +332,61 @@ export class WatsonAPIs {
     }
   }
 
+  /**
+   * 検索とAI判定をサーバ側でまとめて実行し、完了した行から順に通知します。
+   * @param {Array<object>} rows 対象行の配列
+   * @param {object} options wd_params, confidence_threshold, judge, local_judge, concurrency
+   * @param {Function} onRow 1行完了ごとのコールバック (index, row, error)
+   * @param {AbortSignal} [signal] 中断用のシグナル
+   */
+  async batchJudge(rows, options, onRow, signal) {
+    const apiUrl = `${this.config.api.baseUrl}${this.config.api.endpoints.batchjudge}`;
+    const params = {
+      rows: rows,
+      fields: this.resultFields,
+      prompts: this.prompts,
+      // 判定・スコアを文言の一致度で決め、曖昧な候補だけLLMに問い合わせる (options.local_judge で有効化)
+      local_judge: false,
+      llm: {
+        modelname: this.config.llm.modelname,
+        decoding_method: "greedy",
+        min_new_tokens: 10,
+        max_new_tokens: 300,
+      },
+      ...options,
+    };
+
+    const response = await fetch(apiUrl, {
+      method: "POST",
+      headers: { "Content-Type": "application/json" },
+      body: JSON.stringify(params),
+      signal: signal,
+    });
+
+    await readNdjson(response, (result) => {
+      if (!result.done && typeof onRow === "function") {
+        onRow(result.index, result.row, result.error);
+      }
+    }, signal);
+  }
+
+  /**
+   * 判定結果をサーバ側でXLSXに変換します。
+   * @param {Array<object>} rows 判定結果の行の配列
+   * @param {string} filename 出力ファイル名
+   * @returns {Promise<Blob>} XLSXファイル
+   */
+  async exportResultsXlsx(rows, filename) {
+    const apiUrl = `${this.config.api.baseUrl}${this.config.api.endpoints.exportxlsx}`;
+    const response = await fetch(apiUrl, {
+      method: "POST",
+      headers: { "Content-Type": "application/json" },
+      body: JSON.stringify({ rows: rows, filename: filename }),
+    });
+    if (!response.ok) throw new Error(`API call failed: ${response.status}`);
+    return await response.blob();
+  }
+
   /**
    * Watson Discoveryにドキュメントを追加します。
    * @param {string} collectionId 対象のコレクションID
@@ -286,6 +423,34 @@ export class WatsonAPIs {
     }
   }
 
+  /**
+   * 複数行を1行1ドキュメントとしてまとめて登録し、1行ごとに進捗を通知します。
+   * 登録済みの行はサーバ側でスキップされます。
+   * @param {string} collectionId 対象のコレクションID
+   * @param {Array<object>} rows 登録する行の配列
+   * @param {string} filename ファイル名の接頭辞
+   * @param {Function} onProgress 1行ごとの進捗通知コールバック (result)
+   * @returns {Promise<object>} 集計結果 (added, skipped, error)
+   */
+  async bulkAddDocuments(collectionId, rows, filename, onProgress) {
+    const apiUrl = `${this.config.api.baseUrl}${this.config.api.endpoints.bulkadd}`;
+    const response = await fetch(apiUrl, {
+      method: "POST",
+      headers: { "Content-Type": "application/json" },
+      body: JSON.stringify({ collection_id: collectionId, rows: rows, filename: filename }),
+    });
+
+    let summary = null;
+    await readNdjson(response, (result) => {
+      if (result.done) {
+        summary = result;
+      } else if (typeof onProgress === "function") {
+        onProgress(result);
+      }
+    });
+    return summary;
+  }
+
   /**
    * Watson Discoveryの特定のドキュメントを取得します。
    * @param {string} collectionId 対象のコレクションID
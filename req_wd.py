@@ -1,6 +1,7 @@
 # LOG
 import logging
 import json
+import threading
 logging.basicConfig(format='[%(asctime)s] %(message)s', level=logging.INFO)
 logger = logging.getLogger("LOG")
 
@@ -9,21 +10,68 @@ import os
 from dotenv import load_dotenv
 load_dotenv()
 
-# ibm-watson
-from ibm_watson import DiscoveryV2
-from ibm_cloud_sdk_core.authenticators import IAMAuthenticator
+# ibm-watson は読み込みに時間がかかるため、クライアント生成時に import する
+from requests.adapters import HTTPAdapter
+
+# Module files
+import app_log as LOG
+import iam_token as IAM
+import metrics as METRICS
+import resilience as RESILIENCE
+import wd_cache as WDCACHE
+import autocomp_index as ACINDEX
+import mirror_index as MIRROR
 
 # 環境変数から設定を読み込み
 wd_key = os.getenv("WD_KEY", None)
 wd_url = os.getenv("WD_URL", None)
 prj_id = os.getenv("WD_PRJID", None)
-
-authenticator = IAMAuthenticator(wd_key)
-discovery = DiscoveryV2(
-    version='2023-03-31',
-    authenticator=authenticator
-)
-discovery.set_service_url(wd_url)
+# rerank 指定時のローカル類似度の重み (0〜1)
+MIRROR_RERANK_WEIGHT = float(os.getenv("MIRROR_RERANK_WEIGHT", 0.5))
+
+# Discovery クライアントは初回利用時 (またはウォームアップ時) に生成する
+_discovery = None
+_discovery_lock = threading.Lock()
+_pool_size = None
+
+def _mount_pool(client, size):
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=size)
+    http_client = client.get_http_client()
+    http_client.mount("https://", adapter)
+    http_client.mount("http://", adapter)
+
+def get_discovery():
+    global _discovery
+    if _discovery is not None:
+        return _discovery
+    with _discovery_lock:
+        if _discovery is None:
+            from ibm_watson import DiscoveryV2
+
+            # IAMトークンは全ワーカーで共有し、期限前にバックグラウンドで更新する
+            authenticator = IAM.SharedIAMAuthenticator(IAM.get_provider(wd_key))
+            client = DiscoveryV2(
+                version='2023-03-31',
+                authenticator=authenticator
+            )
+            client.set_service_url(wd_url)
+            # 期限切れで見捨てた呼び出しのスレッドが残り続けないよう、HTTP にもタイムアウトを設定する
+            client.set_http_config({"timeout": RESILIENCE.http_timeout("wd")})
+            if _pool_size:
+                _mount_pool(client, _pool_size)
+            _discovery = client
+        return _discovery
+
+def set_pool_size(size):
+    """同時実行数に合わせてHTTPコネクションプールのサイズを設定する"""
+    global _pool_size
+    _pool_size = size
+    if _discovery is not None:
+        _mount_pool(_discovery, size)
+
+def warmup():
+    """クライアントを生成し、IAMトークンを取得しておく"""
+    get_discovery().authenticator.provider.get_token()
 
 # prjs = discovery.list_projects().get_result()
 # prj_ids = prjs['projects']
@@ -39,17 +87,15 @@ def call_getcollections():
     """コレクション一覧を取得する"""
     logger.info(f"call_getcollections")
 
-    ret = discovery.list_collections(
+    ret = RESILIENCE.upstream.call("wd", "list_collections", lambda: get_discovery().list_collections(
         project_id=prj_id
-    ).get_result()
-    logger.info(ret)
+    ).get_result(), hedge=True)
+    logger.info(LOG.payload(ret))
 
     return ret
 
-def call_wdsearch(params):
-    """検索クエリを実行する"""
-    logger.info(f"call_wdsearch: { params }")
-
+def search_key(params):
+    """検索結果キャッシュ・集約のキーと passages の設定を返す"""
     # 必須パラメータのチェック
     check_required_params(params, ["collection_ids", "count", "natural_language_query"])
 
@@ -69,36 +115,100 @@ def call_wdsearch(params):
         # countはparamsのcountに合わせる
         passages_config["count"] = params["count"]
 
-    ret = discovery.query(
+    cache_key = WDCACHE.make_key(
+        params["collection_ids"], params["count"],
+        params["natural_language_query"], passages_config
+    )
+    return cache_key, passages_config
+
+def call_wdquery(params):
+    """検索クエリを実行する (rerank 前の Discovery の結果)"""
+    logger.info(f"call_wdsearch: {LOG.payload(params)}")
+    cache_key, passages_config = search_key(params)
+
+    # 同一条件の検索結果はキャッシュから返す
+    cached = WDCACHE.query_cache.get(cache_key)
+    if cached is not None:
+        logger.info("call_wdsearch: cache hit")
+        return cached
+
+    generation = WDCACHE.query_cache.generation(params["collection_ids"])
+    ret = RESILIENCE.upstream.call("wd", "query", lambda: get_discovery().query(
         project_id = prj_id,
         collection_ids = params["collection_ids"],
         count = params["count"],
         natural_language_query = params["natural_language_query"],
         passages = passages_config
-    ).get_result()
-    logger.info(ret)
+    ).get_result(), hedge=True)
+    logger.info(LOG.payload(ret))
+    METRICS.wd_results.observe(len(ret.get("results", [])), op="query")
 
+    WDCACHE.query_cache.put(cache_key, params["collection_ids"], ret, generation)
     return ret
 
+def call_wdsearch(params):
+    """検索クエリを実行する"""
+    return rerank(params, call_wdquery(params))
+
+def rerank(params, ret):
+    """rerank 指定時はローカルインデックスの類似度を加味して並べ替える"""
+    if not params.get("rerank"):
+        return ret
+    return MIRROR.rerank(
+        ret, params["collection_ids"], params["natural_language_query"], MIRROR_RERANK_WEIGHT
+    )
+
+def call_localsearch(params):
+    """ローカルインデックスで検索し、Discovery の query と同じ形で返す"""
+    logger.info(f"call_localsearch: {LOG.payload(params)}")
+
+    # 必須パラメータのチェック
+    check_required_params(params, ["collection_ids", "count", "natural_language_query"])
+
+    hits = MIRROR.mirror_index.search(
+        params["collection_ids"], [params["natural_language_query"]], int(params["count"])
+    )[0]
+    return MIRROR.to_query_result(hits)
+
 def call_wdautocomp(params):
     """オートコンプリートを取得する"""
-    logger.info(f"call_wdautocomp: { params }")
+    logger.info(f"call_wdautocomp: {LOG.payload(params)}")
 
     # 必須パラメータのチェック
     check_required_params(params, ["prefix", "count"])
 
-    ret = discovery.get_autocompletion(
-        project_id = prj_id,
-        prefix = params["prefix"],
-        count = params["count"]
-    ).get_result()
-    logger.info(ret)
-
-    return ret
+    # 取り込み済みドキュメントの語句 (ミラーインデックスから読み込む)
+    collection_ids = params.get("collection_ids") or []
+    ACINDEX.sync(collection_ids)
+    local = ACINDEX.prefix_index.complete(params["prefix"], params["count"], collection_ids)
+    # 対象コレクションの語句を読み込み済みなら、一致する語句がある限り Discovery を呼ばない
+    if local and ACINDEX.prefix_index.is_warm(collection_ids):
+        return {"completions": local}
+
+    # 未読み込みのコレクション・ローカルに無い接頭辞は Discovery の結果にローカルの語句を加える
+    completions = ACINDEX.prefix_index.upstream(params["prefix"], params["count"])
+    if completions is None:
+        try:
+            ret = RESILIENCE.upstream.call("wd", "get_autocompletion", lambda: get_discovery().get_autocompletion(
+                project_id = prj_id,
+                prefix = params["prefix"],
+                count = params["count"]
+            ).get_result(), hedge=True)
+        except Exception as e:
+            # Discovery が使えないときはローカルの語句だけで返す
+            if not local or not (isinstance(e, RESILIENCE.UpstreamError) or RESILIENCE.is_upstream_failure(e)):
+                raise
+            logger.error(f"call_wdautocomp: ローカルの語句で応答 ({str(e)})")
+            return {"completions": local}
+        logger.info(LOG.payload(ret))
+        completions = ret.get("completions") or []
+        ACINDEX.prefix_index.set_upstream(params["prefix"], params["count"], completions)
+
+    return {"completions": ACINDEX.merge(completions, local, params["count"])}
 
 def call_listdocuments(params):
     """ドキュメント一覧を取得する"""
-    logger.info(f"call_listdocuments: { params }")
+    logger.info(f"call_listdocuments: {LOG.payload(params)}")
 
     # 必須パラメータのチェック
     check_required_params(params, ["collection_id"])
@@ -126,16 +236,18 @@ def call_listdocuments(params):
     for param, api_param in option_map.items():
         if param in params:
             api_params[api_param] = params[param]
-            logger.info(f"オプションパラメータを設定: {param}={params[param]}")
+            logger.info(f"オプションパラメータを設定: {param}={LOG.payload(params[param])}")
 
-    ret = discovery.list_documents(**api_params).get_result()
-    logger.info(ret)
+    ret = RESILIENCE.upstream.call(
+        "wd", "list_documents", lambda: get_discovery().list_documents(**api_params).get_result(), hedge=True
+    )
+    logger.info(LOG.payload(ret))
 
     return ret
 
 def call_adddocument(params):
     """ドキュメントを追加する"""
-    logger.info(f"call_adddocument 開始: { params }")
+    logger.info(f"call_adddocument 開始: {LOG.payload(params)}")
 
     try:
         # 必須パラメータのチェック
@@ -157,7 +269,7 @@ def call_adddocument(params):
             'project_id': prj_id,
             'collection_id': collection_id
         }
-        logger.info(f"初期APIパラメータ: {api_params}")
+        logger.info(f"初期APIパラメータ: {LOG.payload(api_params)}")
     
         # パラメータのチェックと設定
         if 'filename' not in params:
@@ -184,9 +296,17 @@ def call_adddocument(params):
                 api_params[param] = params[param]
                 logger.info(f"{param} パラメータを設定: {params[param]}")
 
-        logger.info(f"API呼び出し準備完了: {api_params}")
-        ret = discovery.add_document(**api_params).get_result()
-        logger.info(f"API呼び出し結果: {ret}")
+        logger.info(f"API呼び出し準備完了: {LOG.payload(api_params)}")
+        # 書き込みは上流に届いていない 429 だけ再試行する (重複登録を避ける)
+        ret = RESILIENCE.upstream.call(
+            "wd", "add_document", lambda: get_discovery().add_document(**api_params).get_result(),
+            retry_statuses=RESILIENCE.REJECTED_STATUSES, deadline=RESILIENCE.WRITE_DEADLINE
+        )
+        logger.info(f"API呼び出し結果: {LOG.payload(ret)}")
+        WDCACHE.query_cache.invalidate_collection(collection_id)
+        if 'file' in params and ret.get('document_id'):
+            ACINDEX.prefix_index.add_document(collection_id, ret['document_id'], params['file'])
+            MIRROR.mirror_index.add_document(collection_id, ret['document_id'], params['file'])
 
         return ret
     except Exception as e:
@@ -195,7 +315,7 @@ def call_adddocument(params):
 
 def call_getdocument(params):
     """ドキュメントを取得する"""
-    logger.info(f"call_getdocument: { params }")
+    logger.info(f"call_getdocument: {LOG.payload(params)}")
 
     # 必須パラメータのチェック
     check_required_params(params, ["collection_id", "document_id"])
@@ -213,14 +333,16 @@ def call_getdocument(params):
     if 'return_fields' in params:
         api_params['_return'] = params['return_fields']
 
-    ret = discovery.get_document(**api_params).get_result()
-    logger.info(ret)
+    ret = RESILIENCE.upstream.call(
+        "wd", "get_document", lambda: get_discovery().get_document(**api_params).get_result(), hedge=True
+    )
+    logger.info(LOG.payload(ret))
 
     return ret
 
 def call_updatedocument(params):
     """ドキュメントを更新する"""
-    logger.info(f"call_updatedocument: { params }")
+    logger.info(f"call_updatedocument: {LOG.payload(params)}")
 
     # 必須パラメータのチェック
     check_required_params(params, ["collection_id", "document_id"])
@@ -245,14 +367,21 @@ def call_updatedocument(params):
         if param in params:
             api_params[param] = params[param]
 
-    ret = discovery.update_document(**api_params).get_result()
-    logger.info(ret)
+    ret = RESILIENCE.upstream.call(
+        "wd", "update_document", lambda: get_discovery().update_document(**api_params).get_result(),
+        retry_statuses=RESILIENCE.REJECTED_STATUSES, deadline=RESILIENCE.WRITE_DEADLINE
+    )
+    logger.info(LOG.payload(ret))
+    WDCACHE.query_cache.invalidate_collection(collection_id)
+    if 'file' in params:
+        ACINDEX.prefix_index.add_document(collection_id, document_id, params['file'])
+        MIRROR.mirror_index.add_document(collection_id, document_id, params['file'])
 
     return ret
 
 def call_deletedocument(params):
     """ドキュメントを削除する"""
-    logger.info(f"call_deletedocument: { params }")
+    logger.info(f"call_deletedocument: {LOG.payload(params)}")
 
     # 必須パラメータのチェック
     check_required_params(params, ["collection_id", "document_id"])
@@ -270,7 +399,13 @@ def call_deletedocument(params):
     if 'x_watson_discovery_force' in params:
         api_params['x_watson_discovery_force'] = params['x_watson_discovery_force']
 
-    ret = discovery.delete_document(**api_params).get_result()
-    logger.info(ret)
+    ret = RESILIENCE.upstream.call(
+        "wd", "delete_document", lambda: get_discovery().delete_document(**api_params).get_result(),
+        retry_statuses=RESILIENCE.REJECTED_STATUSES, deadline=RESILIENCE.WRITE_DEADLINE
+    )
+    logger.info(LOG.payload(ret))
+    WDCACHE.query_cache.invalidate_collection(collection_id)
+    ACINDEX.prefix_index.remove_document(collection_id, document_id)
+    MIRROR.mirror_index.remove_document(collection_id, document_id)
 
     return ret
@@ -1,7 +1,14 @@
 from pydantic import BaseModel
 import asyncio
+import concurrent.futures
+import json
+import threading
+import time
+from collections import OrderedDict
 from typing import AsyncGenerator
 
+from starlette.concurrency import run_in_threadpool
+
 # LOG
 import logging
 logging.basicConfig(format='[%(asctime)s] %(message)s', level=logging.INFO)
@@ -12,22 +19,56 @@ import os
 from dotenv import load_dotenv
 load_dotenv()
 
-# Langchain
-from langchain_core.prompts import PromptTemplate
+# Module files
+import app_log as LOG
+import iam_token as IAM
+import metrics as METRICS
+import resilience as RESILIENCE
+import gen_cache as GENCACHE
+import profiler as PROFILE
 
-# ibm-watsonx-ai
-from ibm_watsonx_ai import APIClient, Credentials
-from ibm_watsonx_ai.foundation_models.utils.enums import ModelTypes, DecodingMethods
-from ibm_watsonx_ai.metanames import GenTextParamsMetaNames
-from langchain_ibm import WatsonxLLM
+from singleflight import SingleFlight
 
+# Langchain / ibm-watsonx-ai は読み込みに時間がかかるため、使用時に import する
+# (gunicorn --preload ではマスタープロセスで読み込み済み)
 
 api_key = os.getenv("API_KEY", None) 
 api_url = os.getenv("WML_URL", None)
-creds = Credentials(url=api_url, api_key=api_key)
 prj_id = os.getenv("WX_PRJID", None)
 
-# print([model.name for model in ModelTypes])
+# GenTextParamsMetaNames / DecodingMethods の値 (SDK を読み込まずに使う)
+GREEDY = "greedy"
+DECODING_METHOD = "decoding_method"
+MAX_NEW_TOKENS = "max_new_tokens"
+MIN_NEW_TOKENS = "min_new_tokens"
+TEMPERATURE = "temperature"
+REPETITION_PENALTY = "repetition_penalty"
+TOP_K = "top_k"
+TOP_P = "top_p"
+STOP_SEQUENCES = "stop_sequences"
+
+# 全チェーンで共有する APIClient (IAMトークンは iam_token で共有・更新する)
+_api_client = None
+_api_client_lock = threading.Lock()
+
+def getApiClient():
+    global _api_client
+    with _api_client_lock:
+        if _api_client is None:
+            import httpx
+            from ibm_watsonx_ai import APIClient, Credentials
+            provider = IAM.get_provider(api_key)
+            # 期限切れで見捨てた生成のスレッドが残り続けないよう、HTTP にもタイムアウトを設定する
+            timeout = RESILIENCE.http_timeout("wxai")
+            client = APIClient(
+                credentials=Credentials(url=api_url, token=provider.get_token()),
+                project_id=prj_id,
+                httpx_client=httpx.Client(timeout=httpx.Timeout(timeout, connect=10.0) if timeout else None)
+            )
+            provider.add_listener(client.set_token)
+            _api_client = client
+        return _api_client
+
 DEFAULT_MODEL = "meta-llama/llama-3-3-70b-instruct"
 
 # Parameters
@@ -39,27 +80,42 @@ class Params(BaseModel):
     min_new_tokens: int = 10
     max_new_tokens: int = 50
     repetition_penalty: float = 1.1
+    # greedy の生成結果をディスクキャッシュから返す (opt-in)
+    cache: bool = False
     # top_k: int = 3
     # temperature: float = 0.05
     # random_seed: int = 1
     # stop_sequences: list[str]
 
-def setLlmChain(params:Params):
+# 複数プロンプトをまとめて生成する場合のパラメータ
+class BatchParams(Params):
+    prompts: list[str] = []
+
+PROMPT_TEMPLATE = "日本語で答えてください : {question}"
+
+def getLlmParams(params:Params):
     prms = {
-        GenTextParamsMetaNames.DECODING_METHOD: params.decoding_method if params and hasattr(params,'decoding_method') else DecodingMethods.GREEDY.value,
-        GenTextParamsMetaNames.MAX_NEW_TOKENS: params.max_new_tokens if params and hasattr(params,'max_new_tokens') else 100,
-        GenTextParamsMetaNames.MIN_NEW_TOKENS: params.min_new_tokens if params and hasattr(params,'min_new_tokens') else 10,
-        GenTextParamsMetaNames.TEMPERATURE: params.temperature if params and hasattr(params,'temperature') else 0.5,
-        GenTextParamsMetaNames.REPETITION_PENALTY: params.repetition_penalty if params and hasattr(params,'repetition_penalty') else 1.1,
-        GenTextParamsMetaNames.TOP_K: params.top_k if params and hasattr(params,'top_k') else 50,
-        GenTextParamsMetaNames.TOP_P: params.top_p if params and hasattr(params,'top_p') else 1,
-        GenTextParamsMetaNames.STOP_SEQUENCES: params.stop_sequences if params and hasattr(params,'stop_sequences') else []
+        DECODING_METHOD: params.decoding_method if params and hasattr(params,'decoding_method') else GREEDY,
+        MAX_NEW_TOKENS: params.max_new_tokens if params and hasattr(params,'max_new_tokens') else 100,
+        MIN_NEW_TOKENS: params.min_new_tokens if params and hasattr(params,'min_new_tokens') else 10,
+        TEMPERATURE: params.temperature if params and hasattr(params,'temperature') else 0.5,
+        REPETITION_PENALTY: params.repetition_penalty if params and hasattr(params,'repetition_penalty') else 1.1,
+        TOP_K: params.top_k if params and hasattr(params,'top_k') else 50,
+        TOP_P: params.top_p if params and hasattr(params,'top_p') else 1,
+        STOP_SEQUENCES: params.stop_sequences if params and hasattr(params,'stop_sequences') else []
     }
+    return prms
+
+def getModelId(params:Params):
+    return params.modelname if params and hasattr(params,'modelname') else DEFAULT_MODEL
+
+def buildLlmChain(model_id, prms):
+    from langchain_core.prompts import PromptTemplate
+    from langchain_ibm import WatsonxLLM
 
     llm = WatsonxLLM(
-        model_id = params.modelname if params and hasattr(params,'modelname') else DEFAULT_MODEL,
-        url = creds["url"],
-        apikey = creds["apikey"],
+        model_id = model_id,
+        watsonx_client = getApiClient(),
         project_id = prj_id,
         params=prms
     )
@@ -67,25 +123,293 @@ def setLlmChain(params:Params):
 
     ptemplate = PromptTemplate(
         input_variables=["question"],
-        template="日本語で答えてください : {question}",
+        template=PROMPT_TEMPLATE,
     )
     lchain = ptemplate | llm
     return lchain
 
+class ChainPool:
+    """モデルID・生成パラメータ単位でLLMチェーンを再利用するプール"""
+
+    def __init__(self, max_size=16, idle_ttl=1800):
+        self.max_size = max_size
+        self.idle_ttl = idle_ttl
+        self._chains = OrderedDict()
+        self._lock = threading.Lock()
+        # 同一キーのチェーン生成(認証含む)を1回に抑えるためのキー別ロック
+        self._building = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def make_key(model_id, prms):
+        items = []
+        for k, v in sorted(prms.items(), key=lambda kv: str(kv[0])):
+            if isinstance(v, list):
+                v = tuple(v)
+            items.append((str(k), v))
+        return (model_id, tuple(items))
+
+    def _evict_idle(self, now):
+        # OrderedDictは最終利用順なので、先頭から期限切れを削除する
+        while self._chains:
+            key, (chain, last_used) = next(iter(self._chains.items()))
+            if now - last_used <= self.idle_ttl:
+                break
+            del self._chains[key]
+            self.evictions += 1
+
+    def get(self, model_id, prms):
+        key = self.make_key(model_id, prms)
+        with self._lock:
+            now = time.monotonic()
+            self._evict_idle(now)
+            entry = self._chains.get(key)
+            if entry is not None:
+                self._chains[key] = (entry[0], now)
+                self._chains.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+            self.misses += 1
+            build_lock = self._building.setdefault(key, threading.Lock())
+
+        with build_lock:
+            try:
+                with self._lock:
+                    entry = self._chains.get(key)
+                    if entry is not None:
+                        self._chains[key] = (entry[0], time.monotonic())
+                        self._chains.move_to_end(key)
+                        return entry[0]
+                chain = buildLlmChain(model_id, dict(prms))
+                with self._lock:
+                    self._chains[key] = (chain, time.monotonic())
+                    self._chains.move_to_end(key)
+                    while len(self._chains) > self.max_size:
+                        self._chains.popitem(last=False)
+                        self.evictions += 1
+            finally:
+                # 生成に失敗したキーのロックも残さない
+                with self._lock:
+                    if self._building.get(key) is build_lock:
+                        self._building.pop(key, None)
+        return chain
+
+    def clear(self):
+        with self._lock:
+            self._chains.clear()
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "size": len(self._chains),
+                "max_size": self.max_size,
+                "idle_ttl": self.idle_ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": (self.hits / total) if total else 0.0,
+            }
+
+chain_pool = ChainPool(
+    max_size=int(os.getenv("LLM_POOL_SIZE", 16)),
+    idle_ttl=float(os.getenv("LLM_POOL_IDLE_TTL", 1800)),
+)
+
+def setLlmChain(params:Params):
+    return chain_pool.get(getModelId(params), getLlmParams(params))
+
+def prewarm():
+    """起動時にデフォルトモデルのチェーンを生成しておく (失敗時は例外をそのまま返す)"""
+    logger.info(f"prewarm: {DEFAULT_MODEL}")
+    setLlmChain(Params())
+
+_token_usage_handler = None
+
+def TokenUsageHandler(model_id):
+    """生成結果のトークン数をメトリクスに記録するコールバック"""
+    global _token_usage_handler
+    if _token_usage_handler is None:
+        from langchain_core.callbacks import BaseCallbackHandler
+
+        class _TokenUsageHandler(BaseCallbackHandler):
+            def __init__(self, model_id):
+                self.model_id = model_id
+
+            def on_llm_end(self, response, **kwargs):
+                usage = (response.llm_output or {}).get("token_usage") or {}
+                generated = usage.get("generated_token_count")
+                if generated is not None:
+                    METRICS.genai_tokens.observe(generated, model=self.model_id)
+                    METRICS.genai_token_total.inc(generated, model=self.model_id, kind="generated")
+                if usage.get("input_token_count") is not None:
+                    METRICS.genai_token_total.inc(usage["input_token_count"], model=self.model_id, kind="input")
+
+        _token_usage_handler = _TokenUsageHandler
+    return _token_usage_handler(model_id)
+
+def generate_key(params: Params):
+    """生成キャッシュ・集約のキー (greedy 以外は同じ入力でも出力が変わるため None)"""
+    if params.decoding_method != GREEDY:
+        return None
+    return GENCACHE.make_key(
+        getModelId(params), getLlmParams(params),
+        PROMPT_TEMPLATE.format(question=params.prompt)
+    )
+
 def call_genai(params: Params):
-    logger.info(f"call_genai: { params }")
+    logger.info(f"call_genai: {LOG.payload(params)}")
+
+    # greedy は同じ入力に同じ出力を返すので、指定があればキャッシュを使う
+    cache_key = generate_key(params)
+    if params.cache and cache_key is not None:
+        ret = GENCACHE.generation_cache.get(cache_key)
+        if ret is not None:
+            logger.info("call_genai: cache hit")
+            return ret
 
     lchain = setLlmChain(params)
-    ret = lchain.invoke({"question":params.prompt})
-    logger.info(ret)
+    ret = RESILIENCE.upstream.call("wxai", "generate", lambda: lchain.invoke(
+        {"question":params.prompt},
+        config={"callbacks": [TokenUsageHandler(getModelId(params))]}
+    ))
+    logger.info(LOG.payload(ret))
 
+    if params.cache and cache_key is not None:
+        GENCACHE.generation_cache.put(cache_key, ret)
     return ret
 
-async def call_genai_stream(params) -> AsyncGenerator[str, None]:
-    logger.info(f"call_genai_stream: { params }")
+# 同一入力で実行中の greedy 生成は1回の呼び出しにまとめる
+generate_flight = SingleFlight("genai")
 
-    lchain = setLlmChain(params)
-    for chunk in lchain.stream({"question": params.prompt}):
-        print (chunk)
-        yield chunk
-        await asyncio.sleep(0.001)
+async def acall_genai(params: Params):
+    """call_genai を同期エンドポイントと同じスレッドプールで実行する
+
+    greedy で同じ入力の生成が実行中なら、スレッドを使わずにイベントループ上でその結果を待つ
+    """
+    cache_key = generate_key(params)
+    if cache_key is None:
+        return await run_in_threadpool(PROFILE.traced(call_genai), params)
+    return await generate_flight.do(cache_key, lambda: run_in_threadpool(PROFILE.traced(call_genai), params))
+
+def call_genai_batch(params: BatchParams):
+    """複数プロンプトを1回の generate 呼び出しで生成する (結果はプロンプトと同じ順)"""
+    logger.info(f"call_genai_batch: prompts={len(params.prompts)} {LOG.payload(params)}")
+
+    model_id = getModelId(params)
+    llm_params = getLlmParams(params)
+    use_cache = params.cache and params.decoding_method == GREEDY
+    keys = [
+        GENCACHE.make_key(model_id, llm_params, PROMPT_TEMPLATE.format(question=prompt))
+        for prompt in params.prompts
+    ] if use_cache else [None] * len(params.prompts)
+
+    results = [None] * len(params.prompts)
+    if use_cache:
+        for i, key in enumerate(keys):
+            results[i] = GENCACHE.generation_cache.get(key)
+    missing = [i for i, ret in enumerate(results) if ret is None]
+    if not missing:
+        return results
+
+    # チェーン末尾の WatsonxLLM へ展開済みプロンプトのリストを渡す
+    llm = setLlmChain(params).last
+    generated = RESILIENCE.upstream.call("wxai", "generate_batch", lambda: llm.generate(
+        [PROMPT_TEMPLATE.format(question=params.prompts[i]) for i in missing],
+        callbacks=[TokenUsageHandler(model_id)]
+    ))
+    for i, generation in zip(missing, generated.generations):
+        results[i] = generation[0].text
+        if use_cache:
+            GENCACHE.generation_cache.put(keys[i], results[i])
+    logger.info(LOG.payload(results))
+    return results
+
+async def acall_genai_batch(params: BatchParams):
+    """call_genai_batch を同期エンドポイントと同じスレッドプールで実行する"""
+    return await run_in_threadpool(PROFILE.traced(call_genai_batch), params)
+
+# ストリーミングのバッファ上限(クライアントが遅い場合は生成側を待たせる)
+STREAM_QUEUE_SIZE = int(os.getenv("STREAM_QUEUE_SIZE", 32))
+_STREAM_END = object()
+
+def sse_event(data, event=None):
+    """SSE形式の1イベントを組み立てる"""
+    frame = f"event: {event}\n" if event else ""
+    return frame + f"data: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+def _stream_producer(params, loop, queue, stop):
+    """別スレッドでチェーンを用意して同期ストリームを読み、イベントループのキューへ渡す"""
+    def put(item):
+        fut = asyncio.run_coroutine_threadsafe(queue.put(item), loop)
+        while True:
+            try:
+                fut.result(timeout=0.5)
+                return True
+            except concurrent.futures.TimeoutError:
+                if stop.is_set():
+                    fut.cancel()
+                    return False
+
+    # チェーンの生成 (SDK の読み込み・認証を含む) もイベントループを止めないようこのスレッドで行う
+    try:
+        lchain = setLlmChain(params)
+        config = {"callbacks": [TokenUsageHandler(getModelId(params))]}
+    except Exception as e:
+        logger.error(f"call_genai_stream エラー: {str(e)}")
+        put(e)
+        return
+    # ストリームは途中から再送できないため再試行・ヘッジはせず、ブレーカーの判定だけ行う
+    try:
+        RESILIENCE.upstream.check("wxai")
+    except RESILIENCE.CircuitOpenError as e:
+        logger.error(f"call_genai_stream エラー: {str(e)}")
+        put(e)
+        return
+    stream = lchain.stream({"question": params.prompt}, config=config)
+    error = None
+    try:
+        with METRICS.upstream("wxai", "stream"):
+            for chunk in stream:
+                if stop.is_set() or not put(chunk):
+                    logger.info("call_genai_stream: クライアント切断のため生成を中断")
+                    break
+            else:
+                put(_STREAM_END)
+    except Exception as e:
+        error = e
+        logger.error(f"call_genai_stream エラー: {str(e)}")
+        put(e)
+    finally:
+        RESILIENCE.upstream.record("wxai", error)
+        # 途中終了時は上流のHTTPレスポンスも閉じる
+        stream.close()
+
+async def call_genai_stream(params, request=None) -> AsyncGenerator[str, None]:
+    logger.info(f"call_genai_stream: {LOG.payload(params)}")
+
+    loop = asyncio.get_running_loop()
+    queue = asyncio.Queue(maxsize=STREAM_QUEUE_SIZE)
+    stop = threading.Event()
+    producer = threading.Thread(
+        target=PROFILE.traced(_stream_producer),
+        args=(params, loop, queue, stop),
+        daemon=True
+    )
+    producer.start()
+    try:
+        while True:
+            item = await queue.get()
+            if item is _STREAM_END:
+                yield sse_event({}, event="end")
+                break
+            if isinstance(item, Exception):
+                yield sse_event({"error": str(item)}, event="error")
+                break
+            if request is not None and await request.is_disconnected():
+                break
+            yield sse_event({"text": item})
+    finally:
+        stop.set()
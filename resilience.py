@@ -0,0 +1,314 @@
+# 上流 (Discovery / watsonx.ai) 呼び出しの耐障害層
+#   - 呼び出しごとの期限 (deadline)
+#   - 冪等な読み取りのヘッジ (応答がレイテンシのパーセンタイルを超えたら同じ要求をもう1本送る)
+#   - 429 / 5xx / 接続エラーのジッター付き再試行
+#   - 上流の異常が続いたら一定時間すぐに失敗させるサーキットブレーカー
+import contextvars
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from requests.exceptions import ConnectionError, Timeout
+
+# Module files
+import metrics as METRICS
+import profiler as PROFILE
+
+# env
+import os
+from dotenv import load_dotenv
+load_dotenv()
+
+# LOG
+import logging
+logging.basicConfig(format='[%(asctime)s] %(message)s', level=logging.INFO)
+logger = logging.getLogger("LOG")
+
+RESILIENCE_ENABLED = os.getenv("RESILIENCE_ENABLED", "true").lower() in ("1", "true")
+# ヘッジを送るレイテンシのパーセンタイルと、判断に必要な最小サンプル数
+HEDGE_PERCENTILE = float(os.getenv("RESILIENCE_HEDGE_PERCENTILE", 95))
+HEDGE_MIN_SAMPLES = int(os.getenv("RESILIENCE_HEDGE_MIN_SAMPLES", 20))
+HEDGE_MIN_DELAY = float(os.getenv("RESILIENCE_HEDGE_MIN_DELAY", 0.05))
+LATENCY_WINDOW = 200
+# 再試行する HTTP ステータス
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+# 上流へ届いていない可能性が高いエラーだけ再試行する場合 (追加・更新・削除)
+REJECTED_STATUSES = (429,)
+# 追加・更新など大きな本文を送る呼び出しの期限(秒)
+WRITE_DEADLINE = float(os.getenv("RESILIENCE_WRITE_DEADLINE", 60))
+UPSTREAM_THREADS = int(os.getenv("RESILIENCE_THREADS", 64))
+
+class UpstreamError(Exception):
+    code = 500
+
+class DeadlineExceeded(UpstreamError):
+    code = 504
+
+class CircuitOpenError(UpstreamError):
+    code = 503
+
+class PoolSaturated(UpstreamError):
+    code = 503
+
+class Policy:
+    """サービスごとの設定 (環境変数 RESILIENCE_<SERVICE>_* で変更できる)"""
+
+    def __init__(self, service, deadline, retries=2, backoff=0.2, backoff_max=2.0,
+                 breaker_threshold=5, breaker_cooldown=30.0):
+        prefix = f"RESILIENCE_{service.upper()}_"
+        env = lambda name, default: float(os.getenv(prefix + name, default))
+        self.deadline = env("DEADLINE", deadline)
+        self.retries = int(env("RETRIES", retries))
+        self.backoff = env("BACKOFF", backoff)
+        self.backoff_max = env("BACKOFF_MAX", backoff_max)
+        self.breaker_threshold = int(env("BREAKER_THRESHOLD", breaker_threshold))
+        self.breaker_cooldown = env("BREAKER_COOLDOWN", breaker_cooldown)
+
+    def as_dict(self):
+        return dict(vars(self))
+
+POLICIES = {
+    "wd": Policy("wd", deadline=10.0),
+    "wxai": Policy("wxai", deadline=120.0),
+}
+
+class CircuitBreaker:
+    """連続失敗で open、cooldown 後に1件だけ試す half-open、成功で closed に戻る"""
+
+    def __init__(self, service, threshold, cooldown):
+        self.service = service
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = 0.0
+        self._probing = False
+        self._lock = threading.Lock()
+
+    def _set_state(self, state):
+        if state != self.state:
+            logger.info(f"resilience: {self.service} circuit {self.state} -> {state}")
+            METRICS.upstream_breaker_transitions.inc(service=self.service, state=state)
+            self.state = state
+
+    def before_call(self):
+        if self.threshold <= 0:
+            return
+        with self._lock:
+            if self.state == "closed":
+                return
+            if self.state == "open" and time.monotonic() - self.opened_at >= self.cooldown:
+                self._set_state("half_open")
+            if self.state == "half_open" and not self._probing:
+                self._probing = True
+                return
+        METRICS.upstream_failures.inc(service=self.service, kind="circuit_open")
+        raise CircuitOpenError(f"{self.service} circuit is open")
+
+    def record(self, failed):
+        if self.threshold <= 0:
+            return
+        with self._lock:
+            self._probing = False
+            if not failed:
+                self.failures = 0
+                self._set_state("closed")
+                return
+            self.failures += 1
+            if self.state == "half_open" or self.failures >= self.threshold:
+                self.opened_at = time.monotonic()
+                self._set_state("open")
+
+    def stats(self):
+        with self._lock:
+            return {"state": self.state, "consecutive_failures": self.failures}
+
+def status_of(e):
+    """SDK の例外から HTTP ステータスを取り出す (ApiException.code / response.status_code)"""
+    code = getattr(e, "code", None)
+    if isinstance(code, int):
+        return code
+    response = getattr(e, "response", None)
+    return getattr(response, "status_code", None)
+
+def http_timeout(service):
+    """SDK の HTTP タイムアウト (期限切れで見捨てた呼び出しのスレッドを解放するため期限に合わせる)"""
+    deadline = POLICIES[service].deadline
+    if service == "wd":
+        deadline = max(deadline, WRITE_DEADLINE) if deadline > 0 else deadline
+    return deadline if deadline > 0 else None
+
+def is_upstream_failure(e):
+    """上流の異常とみなすエラーか (400/404 などの要求側のエラーは含めない)"""
+    if isinstance(e, (DeadlineExceeded, ConnectionError, Timeout)):
+        return True
+    return status_of(e) in RETRY_STATUSES
+
+class Resilience:
+    def __init__(self, policies):
+        self.policies = policies
+        self.breakers = {
+            s: CircuitBreaker(s, p.breaker_threshold, p.breaker_cooldown) for s, p in policies.items()
+        }
+        self._latencies = {}  # (service, op) -> deque
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=UPSTREAM_THREADS, thread_name_prefix="upstream")
+        # 実行中の呼び出し数と、そのうち期限切れで見捨てた (まだスレッドを占有している) 呼び出し数
+        self._inflight = 0
+        self._abandoned = 0
+
+    def _record_latency(self, key, elapsed):
+        with self._lock:
+            window = self._latencies.get(key)
+            if window is None:
+                window = self._latencies[key] = deque(maxlen=LATENCY_WINDOW)
+            window.append(elapsed)
+
+    def hedge_delay(self, key):
+        """ヘッジを送るまでの待ち時間 (サンプル不足なら None)"""
+        with self._lock:
+            window = self._latencies.get(key)
+            if window is None or len(window) < HEDGE_MIN_SAMPLES:
+                return None
+            ordered = sorted(window)
+        index = min(len(ordered) - 1, int(len(ordered) * HEDGE_PERCENTILE / 100))
+        return max(HEDGE_MIN_DELAY, ordered[index])
+
+    def _submit(self, service, op, func):
+        def timed():
+            start = time.perf_counter()
+            with METRICS.upstream(service, op):
+                ret = func()
+            self._record_latency((service, op), time.perf_counter() - start)
+            return ret
+        with self._lock:
+            self._inflight += 1
+        # ログ設定などのコンテキストは要求ごとに複製して引き継ぐ
+        fut = self._executor.submit(contextvars.copy_context().run, PROFILE.traced(timed))
+        fut.add_done_callback(self._finished)
+        return fut
+
+    def _finished(self, fut):
+        with self._lock:
+            self._inflight -= 1
+
+    def _abandon(self, futures):
+        """期限切れで待つのをやめた呼び出しを、終わるまで数えておく"""
+        def done(fut):
+            with self._lock:
+                self._abandoned -= 1
+        for fut in futures:
+            with self._lock:
+                self._abandoned += 1
+            fut.add_done_callback(done)
+
+    def saturated(self):
+        """全スレッドが使用中 (新しい呼び出しはキューで待つことになる)"""
+        with self._lock:
+            return self._inflight >= UPSTREAM_THREADS
+
+    def _attempt(self, service, op, func, deadline, hedge):
+        """1回の試行 (期限まで待ち、必要ならヘッジを1本追加する)"""
+        futures = {self._submit(service, op, func)}
+        hedge_at = None
+        # スレッドが空いていなければヘッジは待ち行列を伸ばすだけなので送らない
+        if hedge and not self.saturated():
+            delay = self.hedge_delay((service, op))
+            if delay is not None:
+                hedge_at = time.monotonic() + delay
+        error = None
+        while futures:
+            now = time.monotonic()
+            timeout = deadline - now if deadline != float("inf") else None
+            if hedge_at is not None:
+                timeout = hedge_at - now if timeout is None else min(timeout, hedge_at - now)
+            if timeout is not None:
+                timeout = max(0.0, timeout)
+            done, futures = wait(futures, timeout=timeout, return_when=FIRST_COMPLETED)
+            for fut in done:
+                if fut.exception() is None:
+                    return fut.result()
+                error = fut.exception()
+            now = time.monotonic()
+            if hedge_at is not None and now >= hedge_at and futures:
+                hedge_at = None
+                if not self.saturated():
+                    METRICS.upstream_hedges.inc(service=service, op=op)
+                    futures.add(self._submit(service, op, func))
+            elif futures and now >= deadline:
+                self._abandon(futures)
+                METRICS.upstream_failures.inc(service=service, kind="deadline")
+                raise DeadlineExceeded(f"{service} {op} exceeded {self.policies[service].deadline}s")
+        raise error
+
+    def call(self, service, op, func, hedge=False, retry_statuses=RETRY_STATUSES, deadline=None):
+        """上流呼び出しを期限・ヘッジ・再試行・サーキットブレーカー付きで実行する
+
+        hedge: 冪等な読み取りのみ True にする
+        retry_statuses: 再試行する HTTP ステータス (書き込みは REJECTED_STATUSES)
+        deadline: 秒 (省略時はサービスの設定, 0 以下で無期限)
+        """
+        if not RESILIENCE_ENABLED:
+            with METRICS.upstream(service, op):
+                return func()
+        policy = self.policies[service]
+        breaker = self.breakers[service]
+        timeout = policy.deadline if deadline is None else deadline
+        deadline_at = time.monotonic() + timeout if timeout > 0 else float("inf")
+        attempt = 0
+        while True:
+            # 見捨てた呼び出しがスレッドを使い切っている間は、キューで期限切れを待たずにすぐ失敗させる
+            with self._lock:
+                abandoned = self._abandoned
+            if abandoned >= UPSTREAM_THREADS:
+                METRICS.upstream_failures.inc(service=service, kind="saturated")
+                raise PoolSaturated(f"{service} {op}: {abandoned} abandoned upstream calls occupy the pool")
+            breaker.before_call()
+            try:
+                ret = self._attempt(service, op, func, deadline_at, hedge)
+            except Exception as e:
+                breaker.record(is_upstream_failure(e))
+                retryable = status_of(e) in retry_statuses or (
+                    isinstance(e, (ConnectionError, Timeout)) and retry_statuses is RETRY_STATUSES
+                )
+                if not retryable or attempt >= policy.retries:
+                    raise
+                # full jitter
+                delay = random.uniform(0, min(policy.backoff_max, policy.backoff * (2 ** attempt)))
+                if time.monotonic() + delay >= deadline_at:
+                    raise
+                attempt += 1
+                METRICS.upstream_retries.inc(service=service, op=op)
+                logger.info(f"resilience: {service} {op} 再試行 {attempt}/{policy.retries} ({str(e)})")
+                time.sleep(delay)
+                continue
+            breaker.record(False)
+            return ret
+
+    def check(self, service):
+        """ストリーミングなど call を通さない呼び出しの前に、ブレーカーの状態を確認する"""
+        if RESILIENCE_ENABLED:
+            self.breakers[service].before_call()
+
+    def record(self, service, error=None):
+        if RESILIENCE_ENABLED:
+            self.breakers[service].record(error is not None and is_upstream_failure(error))
+
+    def stats(self):
+        with self._lock:
+            pool = {"threads": UPSTREAM_THREADS, "inflight": self._inflight, "abandoned": self._abandoned}
+        ret = {"enabled": RESILIENCE_ENABLED, "pool": pool, "services": {}}
+        for service, policy in self.policies.items():
+            ret["services"][service] = {
+                "policy": policy.as_dict(),
+                "breaker": self.breakers[service].stats(),
+                "hedge_delays": {
+                    op: self.hedge_delay((s, op))
+                    for (s, op) in list(self._latencies) if s == service
+                },
+            }
+        return ret
+
+upstream = Resilience(POLICIES)
@@ -0,0 +1,82 @@
+# バッチ判定結果のXLSX出力
+# excel.html の createXlSXfile と同じ2段ヘッダー(優先度ごとのセル結合)で行を順に書き出す
+import json
+import os
+import tempfile
+
+from xlsx_writer import XlsxStreamWriter
+
+BASE_HEADERS = ['行番号', '検索カテゴリ', '検索要件']
+PRIORITY_SUB_HEADERS = [
+    'カテゴリ', '要件', '回答', '備考／補足', '変更区分', '意見', '変更後要件',
+    'Ｓｉｅｒ向けコメント', '工数', '社内向けコメント',
+    'シート名', 'シート行番号', 'ファイル名', 'AI判定', 'AIスコア', 'AI理由',
+]
+# シート行番号は候補ドキュメントの行番号を出力する
+PRIORITY_FIELDS = [
+    'カテゴリ', '要件', '回答', '備考／補足', '変更区分', '意見', '変更後要件',
+    'Ｓｉｅｒ向けコメント', '工数', '社内向けコメント',
+    'シート名', '行番号', 'ファイル名',
+]
+PRIORITIES = ['優先度1', '優先度2', '優先度3']
+PRIORITY_COLORS = ["F08080", "20B2AA", "FFF8DC"]  # lightcoral, lightseagreen, cornsilk
+
+def header_layout():
+    """ヘッダー2行・セル結合・ヘッダーのスタイルを返す"""
+    cols = len(PRIORITY_SUB_HEADERS)
+    row1 = list(BASE_HEADERS)
+    row2 = [''] * len(BASE_HEADERS)
+    styles = [0] * len(BASE_HEADERS)
+    merges = []
+    for index, priority in enumerate(PRIORITIES):
+        row1 += [priority] + [''] * (cols - 1)
+        row2 += PRIORITY_SUB_HEADERS
+        styles += [index + 1] * cols
+        start = len(BASE_HEADERS) + index * cols
+        merges.append(((0, start), (0, start + cols - 1)))
+    for col in range(len(BASE_HEADERS)):
+        merges.append(((0, col), (1, col)))
+    return row1, row2, styles, merges
+
+def result_row(item):
+    """判定結果の1行を出力列の並びにする"""
+    row = [item.get('行番号'), item.get('検索カテゴリ'), item.get('検索要件')]
+    for i in range(1, len(PRIORITIES) + 1):
+        wditem = item.get(f'wditem{i}') or {}
+        ai_result = wditem.get('ai_result') or {}
+        row += [wditem.get(key) for key in PRIORITY_FIELDS]
+        row += [ai_result.get('judge'), ai_result.get('score'), ai_result.get('reason')]
+    return row
+
+def write_results(fileobj, items):
+    """items (イテレータ可) を1行ずつXLSXに書き出す"""
+    row1, row2, styles, merges = header_layout()
+    writer = XlsxStreamWriter(fileobj, "Results", merges, PRIORITY_COLORS)
+    writer.write_row(row1, styles)
+    writer.write_row(row2, styles)
+    count = 0
+    for item in items:
+        writer.write_row(result_row(item))
+        count += 1
+    writer.close()
+    return count
+
+def iter_ndjson_results(lines):
+    """/batch/judge の NDJSON 出力から行を取り出す"""
+    for line in lines:
+        if not line.strip():
+            continue
+        rec = json.loads(line)
+        if rec.get("done"):
+            continue
+        yield rec["row"] if "row" in rec else rec
+
+def export_to_tempfile(items):
+    fd, path = tempfile.mkstemp(suffix=".xlsx")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            write_results(f, items)
+    except Exception:
+        os.remove(path)
+        raise
+    return path
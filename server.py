@@ -1,69 +1,364 @@
+# 起動時間の計測 (他のモジュールより先に読み込む)
+import startup as STARTUP
+STARTUP.track_imports()
+
 # Module files
+import app_log as LOG
+import metrics as METRICS
 import req_wxai as GEN
-import req_wd as WDFUNC
+import wd_async as WDASYNC
+import batch_judge as BATCH
+import bulk_ingest as BULK
+import xlsx_stream as XLSX
+import result_export as EXPORT
+import projection as PROJECTION
+import wd_cache as WDCACHE
+import gen_cache as GENCACHE
+import mirror_index as MIRROR
+import autocomp_index as ACINDEX
+import profiler as PROFILE
+import resilience as RESILIENCE
+
+import asyncio
+import json
+import os
+import time
+from urllib.parse import quote
 
 # Server
 import uvicorn
 from fastapi import FastAPI, Request
-from fastapi.responses import StreamingResponse
+from fastapi.responses import FileResponse, JSONResponse, ORJSONResponse, PlainTextResponse, StreamingResponse
 from fastapi.staticfiles import StaticFiles
+from starlette.concurrency import run_in_threadpool
 
 # LOG
 import logging
 logging.basicConfig(format='[%(asctime)s] %(message)s', level=logging.INFO)
 logger = logging.getLogger("LOG")
 
+LOG.setup()
+
 app = FastAPI(debug=True)
 
+# リクエスト単位で全ペイロードのログ出力を切り替える
+app.add_middleware(LOG.PayloadLoggingMiddleware)
+# エンドポイントごとの所要時間と Server-Timing ヘッダー
+app.add_middleware(METRICS.MetricsMiddleware)
+# 稼働中のリクエストのプロファイル (PROFILE_ENABLED と PROFILE_ADMIN_TOKEN の設定時のみ)
+if PROFILE.enabled():
+    app.add_middleware(PROFILE.ProfilingMiddleware)
+
+async def read_json(request: Request):
+    with METRICS.span("parse_json"):
+        return await request.json()
+
+def json_response(content):
+    """大きな応答は orjson でシリアライズする"""
+    with METRICS.span("serialize"):
+        return ORJSONResponse(content)
+
+# Prometheus形式のメトリクス
+@app.get("/metrics")
+async def metrics():
+    return PlainTextResponse(METRICS.expose(), media_type="text/plain; version=0.0.4")
+
+# プロファイルの管理 (X-Admin-Token ヘッダーに管理トークンが必要)
+def profile_admin_error(request: Request):
+    if not PROFILE.enabled():
+        return JSONResponse({"error": "profiling is disabled"}, status_code=404)
+    if not PROFILE.authorized(request.headers.get("X-Admin-Token")):
+        return JSONResponse({"error": "forbidden"}, status_code=403)
+    return None
+
+@app.get("/admin/profiles")
+async def list_profiles(request: Request):
+    if (error := profile_admin_error(request)) is not None:
+        return error
+    return {"profiles": PROFILE.profile_store.list()}
+
+@app.get("/admin/profiles/sampling")
+async def get_profile_sampling(request: Request):
+    if (error := profile_admin_error(request)) is not None:
+        return error
+    return PROFILE.profile_store.rules
+
+@app.post("/admin/profiles/sampling")
+async def set_profile_sampling(request: Request):
+    # {"path": "/wdsearch", "rate": 0.05, "mode": "statistical", "limit": 20} (rate 0 で解除)
+    if (error := profile_admin_error(request)) is not None:
+        return error
+    data = await read_json(request)
+    path = data.get("path")
+    mode = data.get("mode", "statistical")
+    rate = float(data.get("rate", 0))
+    if not path or mode not in PROFILE.MODES or not 0 <= rate <= 1:
+        return {"error": "invalid params"}
+    return PROFILE.profile_store.set_rule(path, rate, mode, int(data.get("limit", 20)))
+
+@app.get("/admin/profiles/{name}")
+async def download_profile(request: Request, name: str):
+    if (error := profile_admin_error(request)) is not None:
+        return error
+    path = PROFILE.profile_store.file_path(name)
+    if path is None:
+        return JSONResponse({"error": "not found"}, status_code=404)
+    return FileResponse(path, filename=name)
+
+# クライアントの事前生成 (ワーカーごと・fork 後に実行)
+async def warmup_component(name, func):
+    start = time.perf_counter()
+    try:
+        await func()
+        STARTUP.set_component(name, time.perf_counter() - start)
+    except Exception as e:
+        logger.error(f"warmup エラー ({name}): {str(e)}")
+        STARTUP.set_component(name, time.perf_counter() - start, str(e))
+
+async def warmup():
+    await asyncio.gather(
+        warmup_component("wxai", lambda: run_in_threadpool(GEN.prewarm)),
+        warmup_component("wd", WDASYNC.warmup),
+        # オートコンプリートの語句を取り込み済みの文書から読み込む
+        warmup_component("autocomp", lambda: run_in_threadpool(ACINDEX.warmup)),
+    )
+    STARTUP.stop_tracking()
+    logger.info(f"warmup: {STARTUP.readiness()}")
+
+@app.on_event("startup")
+async def startup():
+    # 完了を待たずに受け付けを始め、準備ができるまで /ready は 503 を返す
+    if STARTUP.STARTUP_WARMUP:
+        app.state.warmup = asyncio.create_task(warmup())
+    else:
+        STARTUP.stop_tracking()
+
+@app.get("/ready")
+async def ready():
+    status = STARTUP.readiness()
+    return JSONResponse(status, status_code=200 if status["ready"] else 503)
+
+# 起動時間の内訳 (モジュールごとの import 時間など)
+@app.get("/startup")
+async def startup_report():
+    return STARTUP.report()
+
 # Path Routing
 @app.post("/gen")
 # text invoke
-def ibm_genai(params: GEN.Params):
-    return GEN.call_genai(params)
+async def ibm_genai(params: GEN.Params):
+    return await GEN.acall_genai(params)
+
+# 複数プロンプトをまとめて生成
+@app.post("/gen/batch")
+async def ibm_genai_batch(params: GEN.BatchParams):
+    return await GEN.acall_genai_batch(params)
 
 # test stream
 @app.post("/stream")
-async def stream(params: GEN.Params):
-    generator = GEN.call_genai_stream(params)
-    return StreamingResponse(generator, media_type='text/event-stream')
+async def stream(params: GEN.Params, request: Request):
+    generator = GEN.call_genai_stream(params, request)
+    return StreamingResponse(
+        generator,
+        media_type='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
+
+# LLMチェーンプールの利用状況
+@app.get("/genpool")
+async def genpool():
+    return GEN.chain_pool.stats()
+
+# Excel比較のバッチ処理 (検索 + AI判定)
+@app.post("/batch/judge")
+async def batch_judge(request: Request):
+    data = await read_json(request)
+    batch = BATCH.BatchJudge(data)
+    try:
+        batch.validate()
+    except ValueError as e:
+        return {"error": str(e)}
+    return StreamingResponse(batch.stream(), media_type='application/x-ndjson')
+
+# WD検索結果キャッシュの利用状況
+@app.get("/wdcache")
+async def wdcache():
+    return WDCACHE.query_cache.stats()
+
+# ローカルミラーインデックスの状態
+@app.get("/wdmirror")
+async def wdmirror():
+    return MIRROR.mirror_index.stats()
+
+# 上流呼び出しの期限・ヘッジ・サーキットブレーカーの状態
+@app.get("/resilience")
+async def resilience():
+    return RESILIENCE.upstream.stats()
+
+# XLSXのサーバ側読み込み (本文にxlsxファイルをそのまま送る)
+def xlsx_response(path, rows):
+    """行を NDJSON で返し、終わったら一時ファイルを削除する"""
+    async def generator():
+        try:
+            async for line in rows:
+                yield line
+        finally:
+            os.remove(path)
+    return StreamingResponse(generator(), media_type='application/x-ndjson')
+
+async def iter_ndjson(rows):
+    async for row in XLSX.aiter_rows(rows):
+        yield json.dumps(row, ensure_ascii=False) + "\n"
+
+async def open_xlsx(request, sheet):
+    """本文を一時ファイルに書き出し、ストリーミング開始前にワークブックとして開けるか確認する"""
+    path = await XLSX.spool_request(request)
+    try:
+        name = await run_in_threadpool(XLSX.sheet_name, path, sheet)
+    except Exception as e:
+        os.remove(path)
+        raise ValueError(f"invalid xlsx: {str(e)}")
+    return path, name
+
+@app.post("/xlsx/rows")
+async def xlsx_rows(request: Request, sheet: int = 0):
+    try:
+        path, _ = await open_xlsx(request, sheet)
+    except ValueError as e:
+        return {"error": str(e)}
+    return xlsx_response(path, iter_ndjson(XLSX.iter_row_objects(path, sheet)))
+
+@app.post("/xlsx/bulkadd")
+async def xlsx_bulkadd(request: Request, collection_id: str, filename: str = "upload.xlsx", sheet: int = 0):
+    try:
+        path, name = await open_xlsx(request, sheet)
+    except ValueError as e:
+        return {"error": str(e)}
+    rows = XLSX.to_import_rows(XLSX.iter_row_objects(path, sheet), name, filename)
+    bulk = BULK.BulkIngest({"collection_id": collection_id, "filename": filename}, rows)
+    return xlsx_response(path, bulk.stream())
+
+@app.post("/xlsx/judge")
+async def xlsx_judge(request: Request, options: str = "{}", sheet: int = 0):
+    # 検索・判定の設定は /batch/judge の本文 (rows 以外) を JSON 文字列で渡す
+    try:
+        data = json.loads(options)
+        if not isinstance(data, dict):
+            raise ValueError("options must be a JSON object")
+    except ValueError as e:
+        return {"error": f"invalid options: {str(e)}"}
+    try:
+        path, _ = await open_xlsx(request, sheet)
+    except ValueError as e:
+        return {"error": str(e)}
+    try:
+        batch = BATCH.BatchJudge(data, XLSX.to_judge_rows(XLSX.iter_row_objects(path, sheet)))
+        batch.validate()
+    except Exception as e:
+        os.remove(path)
+        if isinstance(e, ValueError):
+            return {"error": str(e)}
+        raise
+    return xlsx_response(path, batch.stream())
+
+# 判定結果のXLSX出力
+# 本文は {"rows": [...], "filename": ...} か、/batch/judge の NDJSON 出力そのもの
+def file_response(path, filename, media_type, chunk_size=64 * 1024):
+    """一時ファイルを分割して返し、終わったら削除する"""
+    def generator():
+        try:
+            with open(path, "rb") as f:
+                while chunk := f.read(chunk_size):
+                    yield chunk
+        finally:
+            os.remove(path)
+    headers = {'Content-Disposition': f"attachment; filename*=UTF-8''{quote(filename)}"}
+    return StreamingResponse(generator(), media_type=media_type, headers=headers)
+
+def export_ndjson_file(src):
+    with open(src, "r", encoding="utf-8") as f:
+        return EXPORT.export_to_tempfile(EXPORT.iter_ndjson_results(f))
+
+@app.post("/export/xlsx")
+async def export_xlsx(request: Request, filename: str = "results.xlsx"):
+    if "ndjson" in request.headers.get("content-type", ""):
+        src = await XLSX.spool_request(request, suffix=".ndjson")
+        try:
+            path = await run_in_threadpool(export_ndjson_file, src)
+        finally:
+            os.remove(src)
+    else:
+        data = await read_json(request)
+        filename = data.get("filename") or filename
+        path = await run_in_threadpool(EXPORT.export_to_tempfile, data.get("rows") or [])
+    return file_response(
+        path, filename,
+        'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+    )
+
+# 実行中の検索・生成の集約状況
+@app.get("/singleflight")
+async def singleflight():
+    return {
+        "wdsearch": WDASYNC.search_flight.stats(),
+        "genai": GEN.generate_flight.stats(),
+    }
+
+# WD非同期アクセス層の利用状況
+@app.get("/wdstats")
+async def wdstats():
+    return WDASYNC.stats()
+
+# 生成キャッシュの利用状況
+@app.get("/gencache")
+async def gencache():
+    return await run_in_threadpool(GENCACHE.generation_cache.stats)
 
 # WD func
 @app.get("/wdcols")
 async def wdcols():
-    return WDFUNC.call_getcollections()
+    return await WDASYNC.call_getcollections()
 
 @app.post("/wdsearch")
 async def wdsearch(request: Request):
-    data = await request.json()
+    data = await read_json(request)
     natural_language_query = data.get("natural_language_query")
     if natural_language_query is not None:
-        return WDFUNC.call_wdsearch(data)
+        ret = await WDASYNC.call_wdsearch(data)
+        return json_response(PROJECTION.project_query(ret, data.get("fields")))
     else:
         return {"error": "invalid params"}
 
 @app.post("/wdautocomp")
 async def wdautocomp(request: Request):
-    data = await request.json()
+    data = await read_json(request)
     prefix = data.get("prefix")
     if prefix is not None:
-        return WDFUNC.call_wdautocomp(data)
+        return await WDASYNC.call_wdautocomp(data)
     else:
         return {"error": "invalid params"}
 
 @app.post("/wdlistdocuments")
 async def wdlistdocuments(request: Request):
-    data = await request.json()
+    data = await read_json(request)
     collection_id = data.get("collection_id")
     if collection_id is not None:
-        return WDFUNC.call_listdocuments(data)
+        if data.get("include_details"):
+            # 詳細付きの一覧はページ単位で NDJSON を返す
+            return StreamingResponse(
+                WDASYNC.iter_documents_with_details(data),
+                media_type='application/x-ndjson'
+            )
+        ret = await WDASYNC.call_listdocuments(data)
+        return json_response(PROJECTION.project_documents(ret, data.get("fields")))
     else:
         return {"error": "collection_id is required"}
 
 @app.post("/wdadddocument")
 async def wdadddocument(request: Request):
     logger.info("wdadddocument エンドポイント呼び出し")
-    data = await request.json()
-    logger.info(f"リクエストデータ: {data}")
+    data = await read_json(request)
+    logger.info(f"リクエストデータ: {LOG.payload(data)}")
     
     collection_id = data.get("collection_id")
     logger.info(f"collection_id: {collection_id}")
@@ -72,44 +367,59 @@ async def wdadddocument(request: Request):
     
     if collection_id is not None and ('file' in data or 'filename' in data):
         logger.info("call_adddocument を呼び出します")
-        result = WDFUNC.call_adddocument(data)
-        logger.info(f"call_adddocument 結果: {result}")
+        result = await WDASYNC.call_adddocument(data)
+        logger.info(f"call_adddocument 結果: {LOG.payload(result)}")
         return result
     else:
         error_msg = "collection_id and either file or filename are required"
         logger.error(f"エラー: {error_msg}")
         return {"error": error_msg}
 
+@app.post("/wdbulkadd")
+async def wdbulkadd(request: Request):
+    data = await read_json(request)
+    # rows の代わりに JSON 配列の文字列を file で渡すこともできる
+    if 'rows' not in data and isinstance(data.get('file'), str):
+        data['rows'] = json.loads(data['file'])
+    bulk = BULK.BulkIngest(data)
+    try:
+        bulk.validate()
+    except ValueError as e:
+        return {"error": str(e)}
+    return StreamingResponse(bulk.stream(), media_type='application/x-ndjson')
+
 @app.post("/wdgetdocument")
 async def wdgetdocument(request: Request):
-    data = await request.json()
+    data = await read_json(request)
     collection_id = data.get("collection_id")
     document_id = data.get("document_id")
     if collection_id is not None and document_id is not None:
-        return WDFUNC.call_getdocument(data)
+        ret = await WDASYNC.call_getdocument(data)
+        return json_response(PROJECTION.project(ret, data.get("fields")))
     else:
         return {"error": "collection_id and document_id are required"}
 
 @app.post("/wdupdatedocument")
 async def wdupdatedocument(request: Request):
-    data = await request.json()
+    data = await read_json(request)
     collection_id = data.get("collection_id")
     document_id = data.get("document_id")
     if collection_id is not None and document_id is not None:
-        return WDFUNC.call_updatedocument(data)
+        return await WDASYNC.call_updatedocument(data)
     else:
         return {"error": "collection_id and document_id are required"}
 
 @app.post("/wddeletedocument")  # DELETEからPOSTに変更
 async def wddeletedocument(request: Request):
-    data = await request.json()
+    data = await read_json(request)
     collection_id = data.get("collection_id")
     document_id = data.get("document_id")
     logger.info(f"wddeletedocument エンドポイント呼び出し - collection_id: {collection_id}, document_id: {document_id}")
     
     if collection_id is not None and document_id is not None:
-        result = WDFUNC.call_deletedocument(data)
-        logger.info(f"削除結果: {result}")
+        result = await WDASYNC.call_deletedocument(data)
+        await run_in_threadpool(BULK.ingest_ledger.forget, collection_id, document_id)
+        logger.info(f"削除結果: {LOG.payload(result)}")
         return result
     else:
         return {"error": "collection_id and document_id are required"}
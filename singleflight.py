@@ -0,0 +1,45 @@
+# 同一キーの同時呼び出しの集約
+# 実行中の呼び出しと同じキーで呼ばれたら、上流へは送らずその結果を待って共有する
+# (イベントループ上で待つため、待っている側はスレッドも同時実行枠も使わない)
+import asyncio
+
+class SingleFlight:
+    """キーごとに実行中の呼び出しを1つにまとめる (同じイベントループの要求間で共有)"""
+
+    def __init__(self, name):
+        self.name = name
+        self._calls = {}  # key -> asyncio.Future
+        self.leaders = 0
+        self.shared = 0
+
+    async def do(self, key, func, copy=None):
+        """await func() の結果を返す。同じキーが実行中ならその結果を待つ
+
+        func は同時実行枠の確保から行うコルーチン関数。
+        copy を指定すると、各呼び出し元には結果の複製を返す (呼び出し側での書き換え対策)。
+        """
+        future = self._calls.get(key)
+        if future is not None:
+            self.shared += 1
+        else:
+            self.leaders += 1
+            # 先頭の要求が中断されても待っている側には結果を返すため、別タスクで実行する
+            future = self._calls[key] = asyncio.ensure_future(func())
+            future.add_done_callback(lambda f: self._done(key, f))
+        # 呼び出し元が切断・中断されても、実行中の呼び出しは止めない
+        result = await asyncio.shield(future)
+        return copy(result) if copy else result
+
+    def _done(self, key, future):
+        if self._calls.get(key) is future:
+            del self._calls[key]
+        # 誰も待っていない失敗を「取得されなかった例外」として記録させない
+        if not future.cancelled():
+            future.exception()
+
+    def stats(self):
+        return {
+            "inflight": len(self._calls),
+            "leaders": self.leaders,
+            "shared": self.shared,
+        }
@@ -0,0 +1,138 @@
+# 起動時間の計測と準備完了 (readiness) の管理
+#   - モジュールごとの import 時間 (自身 / 子を含む) を記録する
+#   - 重い SDK は gunicorn --preload 時にマスタープロセスで読み込み、fork 後のワーカーで共有する
+#   - クライアントの生成 (ウォームアップ) が終わったコンポーネントを記録し、/ready で返す
+import importlib
+import importlib.abc
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+# env
+import os
+from dotenv import load_dotenv
+load_dotenv()
+
+# LOG
+import logging
+logging.basicConfig(format='[%(asctime)s] %(message)s', level=logging.INFO)
+logger = logging.getLogger("LOG")
+
+# 起動時にクライアントを生成しておく (false なら初回利用時に生成)
+STARTUP_WARMUP = os.getenv("STARTUP_WARMUP", "true").lower() in ("1", "true")
+# モジュールごとの import 時間を記録する
+STARTUP_IMPORT_TIMING = os.getenv("STARTUP_IMPORT_TIMING", "true").lower() in ("1", "true")
+# 準備完了の条件とするコンポーネント
+READY_COMPONENTS = ("wxai", "wd")
+# 遅延読み込みする SDK (--preload 時はマスタープロセスで読み込む)
+SDK_MODULES = ("ibm_watsonx_ai", "langchain_core", "langchain_ibm", "ibm_watson")
+# 報告する import の件数
+REPORT_TOP = 30
+
+_process_start = time.perf_counter()
+_imports = {}  # module -> (子を含む秒, 自身の秒)
+_phases = {}  # 名前 -> 秒
+_components = {}  # 名前 -> {"ready", "seconds", "error"}
+_local = threading.local()
+
+class _TimingLoader:
+    """exec_module の所要時間を記録するローダーのラッパー"""
+
+    def __init__(self, loader):
+        self._loader = loader
+
+    def __getattr__(self, name):
+        return getattr(self._loader, name)
+
+    def create_module(self, spec):
+        return self._loader.create_module(spec)
+
+    def exec_module(self, module):
+        stack = getattr(_local, "stack", None)
+        if stack is None:
+            stack = _local.stack = []
+        stack.append(0.0)
+        start = time.perf_counter()
+        try:
+            self._loader.exec_module(module)
+        finally:
+            total = time.perf_counter() - start
+            children = stack.pop()
+            if stack:
+                stack[-1] += total
+            _imports[module.__name__] = (total, total - children)
+
+class _ImportTimer(importlib.abc.MetaPathFinder):
+    def find_spec(self, fullname, path, target=None):
+        for finder in sys.meta_path:
+            if finder is self or not hasattr(finder, "find_spec"):
+                continue
+            spec = finder.find_spec(fullname, path, target)
+            if spec is None:
+                continue
+            if spec.loader is not None and hasattr(spec.loader, "exec_module"):
+                spec.loader = _TimingLoader(spec.loader)
+            return spec
+        return None
+
+_timer = _ImportTimer()
+
+def track_imports():
+    """以降の import の時間を記録する (server.py の先頭で呼ぶ)"""
+    if STARTUP_IMPORT_TIMING and _timer not in sys.meta_path:
+        sys.meta_path.insert(0, _timer)
+
+def stop_tracking():
+    if _timer in sys.meta_path:
+        sys.meta_path.remove(_timer)
+
+@contextmanager
+def phase(name):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        _phases[name] = time.perf_counter() - start
+
+def import_sdks():
+    """重い SDK を読み込む (gunicorn のマスタープロセスで呼ぶとワーカー間でメモリを共有できる)"""
+    for name in SDK_MODULES:
+        with phase(f"import {name}"):
+            try:
+                importlib.import_module(name)
+            except ImportError as e:
+                logger.error(f"startup: {name} を読み込めません ({str(e)})")
+
+def set_component(name, seconds, error=None):
+    _components[name] = {
+        "ready": error is None,
+        "seconds": round(seconds, 3),
+        "error": error,
+    }
+
+def is_ready():
+    if not STARTUP_WARMUP:
+        return True
+    return all(_components.get(c, {}).get("ready") for c in READY_COMPONENTS)
+
+def readiness():
+    return {
+        "ready": is_ready(),
+        "warmup": STARTUP_WARMUP,
+        "components": {c: _components.get(c, {"ready": False}) for c in READY_COMPONENTS},
+    }
+
+def report():
+    """起動時間の内訳 (import は子を含む時間の長い順)"""
+    imports = sorted(_imports.items(), key=lambda kv: kv[1][0], reverse=True)[:REPORT_TOP]
+    return {
+        "pid": os.getpid(),
+        "uptime": round(time.perf_counter() - _process_start, 3),
+        "phases": {k: round(v, 3) for k, v in _phases.items()},
+        "components": dict(_components),
+        "imports": [
+            {"module": name, "total_ms": round(total * 1000, 1), "self_ms": round(own * 1000, 1)}
+            for name, (total, own) in imports
+        ],
+    }
@@ -0,0 +1,47 @@
+import json
+
+import autocomp_index as ACINDEX
+import mirror_index as MIRROR
+
+def rows(*requirements):
+    return json.dumps([{"カテゴリ": "認証", "要件": r} for r in requirements], ensure_ascii=False)
+
+def test_warm_start_from_mirror(tmp_path):
+    mirror = MIRROR.MirrorIndex(str(tmp_path), refresh_interval=0)
+    mirror.add_document("c1", "d1", rows("多要素認証に対応すること", "多言語に対応すること"))
+    mirror.add_document("c2", "d2", rows("多重化構成であること"))
+    mirror.snapshot("c1", wait=True)
+    mirror.add_document("c1", "d3", rows("多要素認証に対応すること"))
+
+    # 再起動後のワーカー: スナップショットとログの両方から語句を読み込む
+    index = ACINDEX.PrefixIndex(refresh_interval=0)
+    assert not index.is_warm(["c1"])
+    index.sync("c1", mirror)
+    assert index.is_warm(["c1"])
+    assert not index.is_warm(["c1", "c2"])
+    assert index.complete("多", 5, ["c1"]) == ["多要素認証に対応すること", "多言語に対応すること"]
+
+def test_sync_applies_changes_from_other_workers(tmp_path):
+    mirror = MIRROR.MirrorIndex(str(tmp_path), refresh_interval=0)
+    mirror.add_document("c1", "d1", rows("監査ログを保存すること"))
+    index = ACINDEX.PrefixIndex(refresh_interval=0)
+    index.sync("c1", mirror)
+
+    # 他のワーカーでの追加・削除はログから反映される
+    mirror.add_document("c1", "d2", rows("監視できること"))
+    mirror.remove_document("c1", "d1")
+    index.sync("c1", mirror)
+    assert index.complete("監", 5, ["c1"]) == ["監視できること"]
+
+    # 圧縮でログが置き換わった後は読み直す
+    mirror.add_document("c1", "d3", rows("監査証跡を残すこと"))
+    mirror.snapshot("c1", wait=True)
+    index.sync("c1", mirror)
+    assert sorted(index.complete("監", 5, ["c1"])) == ["監査証跡を残すこと", "監視できること"]
+
+def test_sync_without_mirror_stays_cold(tmp_path):
+    mirror = MIRROR.MirrorIndex(str(tmp_path), refresh_interval=0)
+    index = ACINDEX.PrefixIndex(refresh_interval=0)
+    index.sync("c1", mirror)
+    assert not index.is_warm(["c1"])
+    assert index.complete("多", 5, ["c1"]) == []
@@ -0,0 +1,10 @@
+import metrics as METRICS
+
+def test_counter_family_matches_samples():
+    counter = METRICS.Counter("demo", "Demo counter")
+    counter.inc(kind="a")
+    counter.inc(2)
+    lines = counter.expose()
+    assert lines[:2] == ["# HELP demo_total Demo counter", "# TYPE demo_total counter"]
+    assert 'demo_total{kind="a"} 1' in lines
+    assert "demo_total 2" in lines
@@ -0,0 +1,62 @@
+import json
+import os
+
+import mirror_index as MIRROR
+import xlsx_stream as XLSX
+
+ROW = {
+    "カテゴリ": "認証", "要件": "多要素認証に対応していること", "回答": "〇", "備考／補足": "TOTP に対応",
+    "変更区分": "", "意見": "", "変更後要件": "", "Ｓｉｅｒ向けコメント": "", "工数": "",
+    "社内向けコメント": "", "行番号": 12, "シート名": "機能要件", "ファイル名": "要件一覧.xlsx",
+}
+
+def discovery_result(document_id, row, collection_id):
+    """add_document した行を Discovery の query で取得したときの結果"""
+    return {
+        "document_id": document_id,
+        **row,
+        "result_metadata": {"collection_id": collection_id, "confidence": 0.5},
+        "document_passages": [],
+    }
+
+def test_query_result_matches_discovery(tmp_path):
+    index = MIRROR.MirrorIndex(str(tmp_path), refresh_interval=0)
+    index.add_document("c1", "d1", json.dumps([ROW], ensure_ascii=False))
+    index.add_document("c1", "d2", json.dumps([{**ROW, "要件": "監査ログを保存すること"}], ensure_ascii=False))
+    index.snapshot("c1", wait=True)
+
+    ret = MIRROR.to_query_result(index.search(["c1"], ["多要素認証"], 5)[0])
+    expected = discovery_result("d1", ROW, "c1")
+    result = ret["results"][0]
+    assert set(result) == set(expected)
+    assert {k: result[k] for k in ROW} == ROW
+    assert result["result_metadata"]["collection_id"] == "c1"
+    # 行の変換で付く項目がすべて保持されている
+    item = next(XLSX.to_import_rows([ROW], "機能要件", "要件一覧.xlsx"))
+    assert set(item) <= set(result)
+
+def test_rebuild_compacts_log(tmp_path):
+    index = MIRROR.MirrorIndex(str(tmp_path), refresh_interval=0)
+    for i in range(3):
+        index.add_document("c1", f"d{i}", json.dumps({"要件": f"要件 {i}"}, ensure_ascii=False))
+    index.remove_document("c1", "d0")
+    snap = index.snapshot("c1", wait=True)
+    assert sorted(snap.doc_ids) == ["d1", "d2"]
+    assert os.path.getsize(index._log("c1")) == 0
+
+    # 圧縮後のログに追記した操作も前のスナップショットに積み上げて反映される
+    index.add_document("c1", "d3", json.dumps({"要件": "要件 3"}, ensure_ascii=False))
+    assert index.snapshot("c1", wait=True) is not None
+    assert sorted(index.snapshot("c1").doc_ids) == ["d1", "d2", "d3"]
+
+    # 別ワーカー (別インスタンス) からも同じ内容が読める
+    other = MIRROR.MirrorIndex(str(tmp_path), refresh_interval=0)
+    assert sorted(other.snapshot("c1").doc_ids) == ["d1", "d2", "d3"]
+
+def test_stale_snapshot_served_during_rebuild(tmp_path):
+    index = MIRROR.MirrorIndex(str(tmp_path), refresh_interval=0)
+    index.add_document("c1", "d1", json.dumps({"要件": "要件 1"}, ensure_ascii=False))
+    old = index.snapshot("c1", wait=True)
+    index.add_document("c1", "d2", json.dumps({"要件": "要件 2"}, ensure_ascii=False))
+    # 作り直しはバックグラウンドで行い、その間は前のスナップショットを返す
+    assert index.snapshot("c1") is old
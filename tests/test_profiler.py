@@ -0,0 +1,49 @@
+import asyncio
+import contextvars
+import time
+
+import profiler as PROFILE
+
+def busy(seconds):
+    end = time.perf_counter() + seconds
+    while time.perf_counter() < end:
+        pass
+
+def busy_in_thread():
+    busy(0.05)
+
+async def busy_in_child_task():
+    busy(0.05)
+
+async def busy_in_other_request():
+    busy(0.05)
+
+def test_sampler_records_request_threads_and_tasks_only(tmp_path):
+    async def main():
+        loop = asyncio.get_running_loop()
+        PROFILE._install_task_factory(loop)
+        # 他のリクエストのタスク (プロファイル対象外のコンテキストで作る)
+        other = loop.create_task(busy_in_other_request(), context=contextvars.Context())
+
+        sampler = PROFILE.StackSampler(loop, interval=0.001)
+        sampler.add_task(asyncio.current_task())
+        token = PROFILE._active.set(sampler)
+        sampler.start()
+        try:
+            await asyncio.to_thread(PROFILE.traced(busy_in_thread))
+            await loop.create_task(busy_in_child_task())
+            await other
+        finally:
+            PROFILE._active.reset(token)
+            sampler.stop(str(tmp_path / "profile.txt"))
+        return (tmp_path / "profile.txt").read_text(encoding="utf-8")
+
+    text = asyncio.run(main())
+    assert "busy_in_thread" in text
+    assert "busy_in_child_task" in text
+    assert "busy_in_other_request" not in text
+    # スレッド名を先頭に付ける
+    assert any(line.startswith("[event-loop];") for line in text.splitlines())
+
+def test_traced_is_noop_outside_profiled_request():
+    assert PROFILE.traced(busy_in_thread) is busy_in_thread
@@ -0,0 +1,87 @@
+import threading
+import time
+
+import pytest
+
+import resilience as RESILIENCE
+
+class ApiError(Exception):
+    def __init__(self, code):
+        super().__init__(code)
+        self.code = code
+
+def make_upstream(**policy):
+    policies = {"wd": RESILIENCE.Policy("wd", **{"deadline": 1.0, "backoff": 0.01, **policy})}
+    return RESILIENCE.Resilience(policies)
+
+def test_no_deadline():
+    upstream = make_upstream(deadline=0)
+    assert upstream.call("wd", "query", lambda: "ok") == "ok"
+    assert upstream.call("wd", "query", lambda: "ok", hedge=True, deadline=0) == "ok"
+
+def test_no_deadline_with_hedge():
+    upstream = make_upstream(deadline=0)
+    for _ in range(RESILIENCE.HEDGE_MIN_SAMPLES):
+        upstream.call("wd", "query", lambda: time.sleep(0.01), hedge=True)
+    assert upstream.call("wd", "query", lambda: time.sleep(0.2) or "ok", hedge=True) == "ok"
+
+def test_deadline_exceeded():
+    upstream = make_upstream()
+    start = time.monotonic()
+    with pytest.raises(RESILIENCE.DeadlineExceeded):
+        upstream.call("wd", "query", lambda: time.sleep(1), deadline=0.1)
+    assert time.monotonic() - start < 0.5
+
+def test_retry_statuses():
+    upstream = make_upstream()
+    calls = []
+    def flaky():
+        calls.append(1)
+        if len(calls) < 3:
+            raise ApiError(503)
+        return "ok"
+    assert upstream.call("wd", "query", flaky) == "ok"
+    assert len(calls) == 3
+
+    calls.clear()
+    with pytest.raises(ApiError):
+        upstream.call("wd", "add_document", flaky, retry_statuses=RESILIENCE.REJECTED_STATUSES)
+    assert len(calls) == 1
+
+def test_hedge_returns_first_result():
+    upstream = make_upstream()
+    for _ in range(RESILIENCE.HEDGE_MIN_SAMPLES):
+        upstream.call("wd", "query", lambda: time.sleep(0.01), hedge=True)
+    calls = []
+    lock = threading.Lock()
+    def slow_first():
+        with lock:
+            calls.append(1)
+            n = len(calls)
+        time.sleep(0.5 if n == 1 else 0.01)
+        return n
+    assert upstream.call("wd", "query", slow_first, hedge=True) == 2
+
+def test_circuit_breaker():
+    upstream = make_upstream(retries=0, breaker_threshold=2, breaker_cooldown=60)
+    for _ in range(2):
+        with pytest.raises(ApiError):
+            upstream.call("wd", "query", lambda: (_ for _ in ()).throw(ApiError(500)))
+    with pytest.raises(RESILIENCE.CircuitOpenError):
+        upstream.call("wd", "query", lambda: "ok")
+
+    upstream.breakers["wd"].cooldown = 0
+    assert upstream.call("wd", "query", lambda: "ok") == "ok"
+    assert upstream.breakers["wd"].state == "closed"
+
+def test_abandoned_calls_fail_fast(monkeypatch):
+    monkeypatch.setattr(RESILIENCE, "UPSTREAM_THREADS", 1)
+    upstream = make_upstream(retries=0)
+    release = threading.Event()
+    with pytest.raises(RESILIENCE.DeadlineExceeded):
+        upstream.call("wd", "query", release.wait, deadline=0.05)
+    with pytest.raises(RESILIENCE.PoolSaturated):
+        upstream.call("wd", "query", lambda: "ok")
+    release.set()
+    time.sleep(0.05)
+    assert upstream.call("wd", "query", lambda: "ok") == "ok"
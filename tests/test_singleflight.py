@@ -0,0 +1,72 @@
+import asyncio
+
+import pytest
+
+from singleflight import SingleFlight
+
+def test_waiters_share_leader_result():
+    async def main():
+        flight = SingleFlight("test")
+        calls = 0
+        release = asyncio.Event()
+
+        async def func():
+            nonlocal calls
+            calls += 1
+            await release.wait()
+            return {"value": 1}
+
+        tasks = [asyncio.ensure_future(flight.do("k", func, copy=dict)) for _ in range(3)]
+        await asyncio.sleep(0)
+        assert flight.stats() == {"inflight": 1, "leaders": 1, "shared": 2}
+        release.set()
+        results = await asyncio.gather(*tasks)
+        assert calls == 1
+        assert results == [{"value": 1}] * 3
+        # 呼び出し元ごとに別の複製
+        assert len({id(r) for r in results}) == 3
+        assert flight.stats()["inflight"] == 0
+    asyncio.run(main())
+
+def test_exception_propagates_to_waiters():
+    async def main():
+        flight = SingleFlight("test")
+        release = asyncio.Event()
+
+        async def func():
+            await release.wait()
+            raise ValueError("upstream failed")
+
+        tasks = [asyncio.ensure_future(flight.do("k", func)) for _ in range(2)]
+        await asyncio.sleep(0)
+        release.set()
+        results = await asyncio.gather(*tasks, return_exceptions=True)
+        assert all(isinstance(r, ValueError) for r in results)
+        assert flight.stats()["inflight"] == 0
+
+        # 失敗した後は新しい呼び出しになる
+        async def ok():
+            return 2
+        assert await flight.do("k", ok) == 2
+        assert flight.stats()["leaders"] == 2
+    asyncio.run(main())
+
+def test_leader_cancellation_does_not_cancel_waiters():
+    async def main():
+        flight = SingleFlight("test")
+        release = asyncio.Event()
+
+        async def func():
+            await release.wait()
+            return "done"
+
+        leader = asyncio.ensure_future(flight.do("k", func))
+        await asyncio.sleep(0)
+        waiter = asyncio.ensure_future(flight.do("k", func))
+        await asyncio.sleep(0)
+        leader.cancel()
+        release.set()
+        assert await waiter == "done"
+        with pytest.raises(asyncio.CancelledError):
+            await leader
+    asyncio.run(main())
@@ -0,0 +1,31 @@
+import wd_cache as WDCACHE
+
+def key(query):
+    return WDCACHE.make_key(["c1"], 3, query, None)
+
+def test_invalidation_is_shared_between_workers(tmp_path):
+    # 同じディレクトリを使う2つのワーカー
+    worker1 = WDCACHE.QueryCache(path=str(tmp_path))
+    worker2 = WDCACHE.QueryCache(path=str(tmp_path))
+    worker1.put(key("認証"), ["c1"], {"results": [1]})
+    worker1.put(WDCACHE.make_key(["c2"], 3, "認証", None), ["c2"], {"results": [2]})
+    assert worker1.get(key("認証")) == {"results": [1]}
+
+    worker2.invalidate_collection("c1")
+    assert worker1.get(key("認証")) is None
+    assert worker1.stats()["entries"] == 1
+    # 他のコレクションの結果は残る
+    assert worker1.get(WDCACHE.make_key(["c2"], 3, "認証", None)) == {"results": [2]}
+
+def test_put_discards_result_started_before_invalidation(tmp_path):
+    worker1 = WDCACHE.QueryCache(path=str(tmp_path))
+    worker2 = WDCACHE.QueryCache(path=str(tmp_path))
+    generation = worker1.generation(["c1"])
+    # 問い合わせ中に他のワーカーで更新された
+    worker2.invalidate_collection("c1")
+    worker1.put(key("認証"), ["c1"], {"results": []}, generation)
+    assert worker1.get(key("認証")) is None
+
+    generation = worker1.generation(["c1"])
+    worker1.put(key("認証"), ["c1"], {"results": []}, generation)
+    assert worker1.get(key("認証")) == {"results": []}
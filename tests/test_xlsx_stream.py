@@ -0,0 +1,67 @@
+import asyncio
+import zipfile
+
+import pytest
+
+import xlsx_stream as XLSX
+
+MAIN = "http://schemas.openxmlformats.org/spreadsheetml/2006/main"
+
+def write_xlsx(path, rows_xml, shared=None, sheet_name="要件"):
+    workbook = (
+        f'<workbook xmlns="{MAIN}" '
+        'xmlns:r="http://schemas.openxmlformats.org/officeDocument/2006/relationships">'
+        f'<sheets><sheet name="{sheet_name}" sheetId="1" r:id="rId1"/></sheets></workbook>'
+    )
+    rels = (
+        '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+        '<Relationship Id="rId1" '
+        'Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/worksheet" '
+        'Target="worksheets/sheet1.xml"/></Relationships>'
+    )
+    sheet = f'<worksheet xmlns="{MAIN}"><sheetData>{rows_xml}</sheetData></worksheet>'
+    with zipfile.ZipFile(path, "w") as zf:
+        zf.writestr("xl/workbook.xml", workbook)
+        zf.writestr("xl/_rels/workbook.xml.rels", rels)
+        zf.writestr("xl/worksheets/sheet1.xml", sheet)
+        if shared is not None:
+            items = "".join(f"<si><t>{s}</t></si>" for s in shared)
+            zf.writestr("xl/sharedStrings.xml", f'<sst xmlns="{MAIN}">{items}</sst>')
+    return str(path)
+
+def test_cell_types(tmp_path):
+    path = write_xlsx(tmp_path / "a.xlsx", (
+        '<row r="1"><c r="A1" t="s"><v>0</v></c><c r="B1" t="inlineStr"><is><t>直接</t></is></c>'
+        '<c r="C1"><v>3</v></c><c r="D1"><v>1.5</v></c><c r="E1" t="b"><v>1</v></c>'
+        '<c r="F1" t="d"><v>2024-04-01T00:00:00</v></c><c r="G1" t="str"><v>式</v></c></row>'
+    ), shared=["共有"])
+    assert list(XLSX.iter_sheet_rows(path)) == [["共有", "直接", 3, 1.5, True, "2024-04-01T00:00:00", "式"]]
+
+def test_skipped_rows_and_columns(tmp_path):
+    path = write_xlsx(tmp_path / "a.xlsx", (
+        '<row r="1"><c r="A1" t="inlineStr"><is><t>a</t></is></c></row>'
+        '<row r="3"><c r="C3"><v>1</v></c></row>'
+    ))
+    assert list(XLSX.iter_sheet_rows(path)) == [["a"], [], ["", "", 1]]
+
+def test_import_rows(tmp_path):
+    path = write_xlsx(tmp_path / "a.xlsx", (
+        '<row r="1"><c r="A1" t="s"><v>0</v></c><c r="B1" t="s"><v>1</v></c></row>'
+        '<row r="2"><c r="A2" t="s"><v>2</v></c><c r="B2" t="s"><v>3</v></c></row>'
+        '<row r="3"><c r="A3" t="s"><v>4</v></c><c r="B3" t="s"><v>5</v></c></row>'
+    ), shared=["要件", "回答", "認証", "〇", "監査", "-"])
+    assert XLSX.sheet_name(path) == "要件"
+    rows = list(XLSX.to_import_rows(XLSX.iter_row_objects(path), "要件", "a.xlsx"))
+    assert rows == [{"要件": "認証", "回答": "〇", "行番号": 2, "シート名": "要件", "ファイル名": "a.xlsx"}]
+
+def test_invalid_workbook(tmp_path):
+    path = tmp_path / "bad.xlsx"
+    path.write_bytes(b"not a zip")
+    with pytest.raises(zipfile.BadZipFile):
+        XLSX.sheet_name(str(path))
+
+def test_aiter_rows_reads_generators_in_batches():
+    async def collect(rows):
+        return [row async for row in XLSX.aiter_rows(rows, batch=2)]
+    assert asyncio.run(collect(iter(range(5)))) == [0, 1, 2, 3, 4]
+    assert asyncio.run(collect([1, 2])) == [1, 2]
@@ -0,0 +1,168 @@
+# Watson Discovery 非同期アクセス層
+# req_wd の同期SDK呼び出しを専用スレッドプールで実行し、イベントループを止めない
+import asyncio
+import contextvars
+import functools
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import orjson
+
+# Module files
+import req_wd as WDFUNC
+import mirror_index as MIRROR
+import projection as PROJECTION
+import profiler as PROFILE
+from singleflight import SingleFlight
+
+# LOG
+import logging
+logging.basicConfig(format='[%(asctime)s] %(message)s', level=logging.INFO)
+logger = logging.getLogger("LOG")
+
+# 種別ごとの同時実行数
+# バッチの add_document が枠を使い切っても検索・オートコンプリートは別枠で流れる
+WD_LIMITS = {
+    "search": int(os.getenv("WD_SEARCH_CONCURRENCY", 8)),
+    "autocomplete": int(os.getenv("WD_AUTOCOMP_CONCURRENCY", 4)),
+    "read": int(os.getenv("WD_READ_CONCURRENCY", 4)),
+    "mutation": int(os.getenv("WD_MUTATION_CONCURRENCY", 4)),
+    # ドキュメント一覧の詳細取得 (一覧表示の並列取得が他の読み取りを待たせないよう別枠)
+    "detail": int(os.getenv("WD_DETAIL_CONCURRENCY", 8)),
+}
+
+# スレッド数・コネクション数は全種別の上限の合計
+_pool_size = sum(WD_LIMITS.values())
+_executor = ThreadPoolExecutor(max_workers=_pool_size, thread_name_prefix="wd")
+WDFUNC.set_pool_size(_pool_size)
+
+_semaphores = {kind: asyncio.Semaphore(limit) for kind, limit in WD_LIMITS.items()}
+_inflight = {kind: 0 for kind in WD_LIMITS}
+
+async def run(kind, func, *args, **kwargs):
+    """種別の同時実行枠を確保してからスレッドプールで関数を実行する"""
+    async with _semaphores[kind]:
+        _inflight[kind] += 1
+        try:
+            loop = asyncio.get_running_loop()
+            # リクエスト単位のログ設定などをスレッド側へ引き継ぐ
+            ctx = contextvars.copy_context()
+            return await loop.run_in_executor(
+                _executor, functools.partial(ctx.run, PROFILE.traced(func), *args, **kwargs)
+            )
+        finally:
+            _inflight[kind] -= 1
+
+def stats():
+    return {
+        "pool_size": _pool_size,
+        "limits": dict(WD_LIMITS),
+        "inflight": dict(_inflight),
+        "local_fallbacks": dict(_fallbacks),
+    }
+
+async def warmup():
+    return await run("read", WDFUNC.warmup)
+
+async def call_getcollections():
+    return await run("read", WDFUNC.call_getcollections)
+
+# Discovery の検索がこの秒数を超えたらローカルインデックスの結果を返す (0 で無効)
+MIRROR_LATENCY_BUDGET = float(os.getenv("MIRROR_LATENCY_BUDGET", 0))
+# ローカル検索に切り替える Discovery のエラー (スロットリング・一時的な障害)
+FALLBACK_STATUS = (429, 500, 502, 503, 504)
+_fallbacks = {"timeout": 0, "error": 0}
+
+# 同一条件で実行中の検索は1回の問い合わせにまとめる
+# (同時実行枠を確保する前に集約し、待っている要求はスレッドも枠も使わない)
+search_flight = SingleFlight("wdsearch")
+
+async def search_discovery(params):
+    cache_key, _ = WDFUNC.search_key(params)
+    # 呼び出し側で結果を書き換えるため、それぞれに複製を返す
+    ret = await search_flight.do(
+        cache_key, lambda: run("search", WDFUNC.call_wdquery, params),
+        copy=lambda ret: orjson.loads(orjson.dumps(ret)),
+    )
+    if not params.get("rerank"):
+        return ret
+    return await asyncio.to_thread(WDFUNC.rerank, params, ret)
+
+async def call_wdsearch(params):
+    if MIRROR_LATENCY_BUDGET <= 0:
+        return await search_discovery(params)
+    # スナップショットの再作成が走ることがあるためスレッドで確認する
+    if not await asyncio.to_thread(MIRROR.mirror_index.covers, params.get("collection_ids")):
+        return await search_discovery(params)
+
+    task = asyncio.ensure_future(search_discovery(params))
+    try:
+        return await asyncio.wait_for(asyncio.shield(task), MIRROR_LATENCY_BUDGET)
+    except asyncio.TimeoutError:
+        # Discovery の結果はそのまま待ち、届いたら検索キャッシュに入る
+        task.add_done_callback(lambda t: t.cancelled() or t.exception())
+        _fallbacks["timeout"] += 1
+        logger.info("call_wdsearch: Discovery の応答が遅いためローカルインデックスで検索します")
+    except Exception as e:
+        if getattr(e, "code", None) not in FALLBACK_STATUS:
+            raise
+        _fallbacks["error"] += 1
+        logger.info(f"call_wdsearch: Discovery エラーのためローカルインデックスで検索します ({str(e)})")
+    return await asyncio.to_thread(WDFUNC.call_localsearch, params)
+
+async def call_wdautocomp(params):
+    return await run("autocomplete", WDFUNC.call_wdautocomp, params)
+
+async def call_listdocuments(params):
+    return await run("read", WDFUNC.call_listdocuments, params)
+
+async def call_getdocument(params):
+    return await run("read", WDFUNC.call_getdocument, params)
+
+async def call_adddocument(params):
+    return await run("mutation", WDFUNC.call_adddocument, params)
+
+async def call_updatedocument(params):
+    return await run("mutation", WDFUNC.call_updatedocument, params)
+
+async def call_deletedocument(params):
+    return await run("mutation", WDFUNC.call_deletedocument, params)
+
+# ドキュメント詳細の1ページあたりの件数 (同時取得数は WD_LIMITS["detail"])
+WD_DETAIL_PAGE_SIZE = int(os.getenv("WD_DETAIL_PAGE_SIZE", 50))
+
+async def iter_documents_with_details(params):
+    """ドキュメント一覧と各ドキュメントの詳細をページ単位の NDJSON で返す
+
+    一覧取得後、詳細は並列に取得し、一覧の順にページが揃ったものから返す。
+    """
+    page_size = int(params.get("page_size") or WD_DETAIL_PAGE_SIZE)
+    fields = params.get("fields")
+    listed = await call_listdocuments(params)
+    documents = listed.get("documents", [])
+    yield json.dumps({
+        "matching_results": listed.get("matching_results", len(documents)),
+        "count": len(documents),
+    }, ensure_ascii=False) + "\n"
+
+    async def detail(doc):
+        try:
+            ret = await run("detail", WDFUNC.call_getdocument, {
+                "collection_id": params["collection_id"],
+                "document_id": doc["document_id"],
+            })
+            return PROJECTION.project({**doc, **ret}, fields)
+        except Exception as e:
+            logger.error(f"ドキュメント詳細取得エラー ({doc.get('document_id')}): {str(e)}")
+            return {**doc, "error": True}
+
+    tasks = [asyncio.create_task(detail(doc)) for doc in documents]
+    try:
+        for page, start in enumerate(range(0, len(tasks), page_size)):
+            docs = await asyncio.gather(*tasks[start:start + page_size])
+            yield orjson.dumps({"page": page, "documents": docs}) + b"\n"
+        yield json.dumps({"done": True}, ensure_ascii=False) + "\n"
+    finally:
+        for task in tasks:
+            task.cancel()
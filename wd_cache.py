@@ -0,0 +1,158 @@
+# Watson Discovery 検索結果キャッシュ
+# 正規化したクエリをキーに、TTL付き・メモリ上限付きのLRUで保持する
+#
+# キャッシュはワーカーごとだが、コレクションの更新回数 (世代) はファイルで全ワーカーに共有し、
+# 他のワーカーでドキュメントが更新されたら取得時に古い結果を捨てる
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+
+import orjson
+
+# env
+import os
+from dotenv import load_dotenv
+load_dotenv()
+
+WD_CACHE_DIR = os.getenv("WD_CACHE_DIR", os.path.join(tempfile.gettempdir(), "wx_wd_cache"))
+
+def normalize_query(text):
+    """空白の揺れを吸収した検索文字列"""
+    return " ".join(str(text).split())
+
+def make_key(collection_ids, count, natural_language_query, passages):
+    return orjson.dumps(
+        {
+            "collection_ids": sorted(collection_ids),
+            "count": count,
+            "natural_language_query": normalize_query(natural_language_query),
+            "passages": passages,
+        },
+        option=orjson.OPT_SORT_KEYS,
+    )
+
+class QueryCache:
+    """検索結果のTTL/LRUキャッシュ (コレクション単位で無効化可能)"""
+
+    def __init__(self, max_bytes=64 * 1024 * 1024, ttl=600, path=WD_CACHE_DIR):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.path = path
+        self._entries = OrderedDict()  # key -> (data, collection_ids, expires, generation)
+        self._by_collection = {}  # collection_id -> set(key)
+        self._lock = threading.Lock()
+        os.makedirs(self.path, exist_ok=True)
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def _remove(self, key):
+        data, collection_ids, _, _ = self._entries.pop(key)
+        self.bytes -= len(data) + len(key)
+        for cid in collection_ids:
+            keys = self._by_collection.get(cid)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._by_collection[cid]
+
+    def _generation_file(self, collection_id):
+        return os.path.join(self.path, f"{collection_id}.gen")
+
+    def generation(self, collection_ids):
+        """コレクションの更新回数 (問い合わせ開始時点の値と比べて古い結果を捨てるため)
+
+        更新のたびに世代ファイルへ1バイト追記するので、ファイルサイズが全ワーカー共通の更新回数になる
+        """
+        ret = []
+        for cid in collection_ids:
+            try:
+                ret.append(os.stat(self._generation_file(cid)).st_size)
+            except FileNotFoundError:
+                ret.append(0)
+        return tuple(ret)
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+        # 期限切れ、または作成後に (他のワーカーを含めて) コレクションが更新された
+        stale = entry is not None and (
+            entry[2] < time.monotonic() or entry[3] != self.generation(entry[1])
+        )
+        with self._lock:
+            if entry is None or stale:
+                if stale and self._entries.get(key) is entry:
+                    self._remove(key)
+                self.misses += 1
+                return None
+            if key in self._entries:
+                self._entries.move_to_end(key)
+            self.hits += 1
+            data = entry[0]
+        # 呼び出し側で結果を書き換えてもキャッシュに影響しないよう毎回デコードする
+        return orjson.loads(data)
+
+    def put(self, key, collection_ids, result, generation=None):
+        data = orjson.dumps(result)
+        size = len(data) + len(key)
+        if size > self.max_bytes:
+            return
+        current = self.generation(collection_ids)
+        if generation is not None and generation != current:
+            # 問い合わせ中にドキュメントが更新された
+            return
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (data, tuple(collection_ids), time.monotonic() + self.ttl, current)
+            self.bytes += size
+            for cid in collection_ids:
+                self._by_collection.setdefault(cid, set()).add(key)
+            while self.bytes > self.max_bytes and self._entries:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    def invalidate_collection(self, collection_id):
+        # 追記は複数ワーカーから同時に行っても失われない
+        with open(self._generation_file(collection_id), "ab") as f:
+            f.write(b".")
+        with self._lock:
+            keys = self._by_collection.get(collection_id)
+            if not keys:
+                return 0
+            keys = list(keys)
+            for key in keys:
+                if key in self._entries:
+                    self._remove(key)
+            self.invalidations += len(keys)
+            return len(keys)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._by_collection.clear()
+            self.bytes = 0
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "bytes": self.bytes,
+                "max_bytes": self.max_bytes,
+                "ttl": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": (self.hits / total) if total else 0.0,
+                "evictions": self.evictions,
+                "invalidations": self.invalidations,
+            }
+
+query_cache = QueryCache(
+    max_bytes=int(os.getenv("WD_CACHE_MAX_BYTES", 64 * 1024 * 1024)),
+    ttl=float(os.getenv("WD_CACHE_TTL", 600)),
+    path=WD_CACHE_DIR,
+)
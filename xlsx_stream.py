@@ -0,0 +1,203 @@
+# XLSX のストリーミング読み込み
+# ワークブック全体を展開せず、シートXMLを1行ずつ読んで行オブジェクトを返す
+import asyncio
+import os
+import re
+import tempfile
+import zipfile
+import xml.etree.ElementTree as ET
+from typing import Iterator
+
+# LOG
+import logging
+logging.basicConfig(format='[%(asctime)s] %(message)s', level=logging.INFO)
+logger = logging.getLogger("LOG")
+
+NS = "{http://schemas.openxmlformats.org/spreadsheetml/2006/main}"
+REL_NS = "{http://schemas.openxmlformats.org/officeDocument/2006/relationships}"
+PKG_REL_NS = "{http://schemas.openxmlformats.org/package/2006/relationships}"
+
+_CELL_REF = re.compile(r"([A-Z]+)(\d+)")
+
+def column_index(letters):
+    """列記号 (A, B, ..., AA) を0始まりの列番号にする"""
+    n = 0
+    for c in letters:
+        n = n * 26 + (ord(c) - 64)
+    return n - 1
+
+def _text(elem):
+    # リッチテキストは<r><t>を連結し、ふりがな(<rPh>)は除く
+    if elem is None:
+        return ""
+    t = elem.find(f"{NS}t")
+    if t is not None and not elem.findall(f"{NS}r"):
+        return t.text or ""
+    return "".join(
+        (r.find(f"{NS}t").text or "")
+        for r in elem.findall(f"{NS}r")
+        if r.find(f"{NS}t") is not None
+    )
+
+def _shared_strings(zf):
+    try:
+        f = zf.open("xl/sharedStrings.xml")
+    except KeyError:
+        return []
+    strings = []
+    with f:
+        for _, elem in ET.iterparse(f):
+            if elem.tag == f"{NS}si":
+                strings.append(_text(elem))
+                elem.clear()
+    return strings
+
+def _sheet_path(zf, sheet_index):
+    """workbook.xml のシート順から対象シートのXMLパスを求める"""
+    workbook = ET.fromstring(zf.read("xl/workbook.xml"))
+    sheets = workbook.find(f"{NS}sheets").findall(f"{NS}sheet")
+    sheet = sheets[sheet_index]
+    rid = sheet.get(f"{REL_NS}id")
+    rels = ET.fromstring(zf.read("xl/_rels/workbook.xml.rels"))
+    for rel in rels.findall(f"{PKG_REL_NS}Relationship"):
+        if rel.get("Id") == rid:
+            target = rel.get("Target").lstrip("/")
+            if not target.startswith("xl/"):
+                target = "xl/" + target
+            return sheet.get("name"), target
+    raise ValueError(f"sheet not found: {sheet.get('name')}")
+
+def _cell_value(cell, shared):
+    t = cell.get("t", "n")
+    if t == "inlineStr":
+        return _text(cell.find(f"{NS}is"))
+    v = cell.find(f"{NS}v")
+    if v is None or v.text is None:
+        return ""
+    if t == "s":
+        return shared[int(v.text)]
+    if t == "b":
+        return v.text == "1"
+    # 数式の文字列・エラー値・ISO 8601 の日付 (t="d") は文字列のまま返す
+    if t in ("str", "e", "d"):
+        return v.text
+    num = float(v.text)
+    return int(num) if num.is_integer() else num
+
+def sheet_name(path, sheet_index=0):
+    with zipfile.ZipFile(path) as zf:
+        return _sheet_path(zf, sheet_index)[0]
+
+def iter_sheet_rows(path, sheet_index=0) -> Iterator[list]:
+    """シートの行を値の配列として順に返す (空行も行番号どおりに返す)"""
+    with zipfile.ZipFile(path) as zf:
+        shared = _shared_strings(zf)
+        _, sheet_xml = _sheet_path(zf, sheet_index)
+        with zf.open(sheet_xml) as f:
+            expected = None
+            context = ET.iterparse(f, events=("start", "end"))
+            # 行は <sheetData> の子要素なので、読み終えた行は sheetData から外す
+            sheet_data = None
+            for event, elem in context:
+                if event == "start":
+                    if elem.tag == f"{NS}sheetData":
+                        sheet_data = elem
+                    continue
+                if elem.tag != f"{NS}row":
+                    continue
+                rownum = int(elem.get("r")) if elem.get("r") else (expected or 1)
+                if expected is not None:
+                    # 省略された空行を埋める
+                    for _ in range(rownum - expected):
+                        yield []
+                expected = rownum + 1
+
+                row = []
+                for cell in elem.findall(f"{NS}c"):
+                    ref = cell.get("r")
+                    col = column_index(_CELL_REF.match(ref).group(1)) if ref else len(row)
+                    if col > len(row):
+                        row.extend([""] * (col - len(row)))
+                    row.append(_cell_value(cell, shared))
+                yield row
+                # 読み終えた行は解放してメモリを一定に保つ
+                if sheet_data is not None:
+                    sheet_data.clear()
+                else:
+                    elem.clear()
+
+# 同期のイテレータから1回に取り出す行数
+ROW_BATCH = 256
+
+def _next_batch(iterator, size):
+    return [row for _, row in zip(range(size), iterator)]
+
+async def aiter_rows(rows, batch=ROW_BATCH):
+    """行を非同期に返す (シートの読み込みなど同期のイテレータはスレッドで読み進める)"""
+    if isinstance(rows, (list, tuple)):
+        for row in rows:
+            yield row
+        return
+    iterator = iter(rows)
+    while True:
+        chunk = await asyncio.to_thread(_next_batch, iterator, batch)
+        for row in chunk:
+            yield row
+        if len(chunk) < batch:
+            return
+
+def iter_row_objects(path, sheet_index=0) -> Iterator[dict]:
+    """1行目をヘッダーとして、以降の行を {ヘッダー: 値} で返す (excel.html の readXLSX と同じ対応付け)"""
+    rows = iter_sheet_rows(path, sheet_index)
+    headers = next(rows, None)
+    if headers is None:
+        return
+    for row in rows:
+        obj = {}
+        for index, header in enumerate(headers):
+            if header not in ("", None):
+                obj[str(header)] = row[index] if index < len(row) else ""
+        yield obj
+
+# スキップする回答の値 (import.html / excel.html の ignore_list と同じ)
+IGNORE_LIST = ['', '-', '---', '－']
+
+# 取り込み対象の項目 (import.html の import_tbl_headers と同じ)
+IMPORT_FIELDS = [
+    'カテゴリ', '要件', '回答', '備考／補足', '変更区分', '意見', '変更後要件',
+    'Ｓｉｅｒ向けコメント', '工数', '社内向けコメント',
+]
+
+def to_import_rows(rows, sheet_name, filename, ignore_list=IGNORE_LIST) -> Iterator[dict]:
+    """シートの行を登録用の行にする (import.html の processJsonArray と同じ変換)"""
+    for index, row in enumerate(rows):
+        if row.get("回答") in ignore_list:
+            continue
+        item = {key: row[key] for key in IMPORT_FIELDS if key in row}
+        item["行番号"] = index + 2
+        item["シート名"] = sheet_name
+        item["ファイル名"] = filename
+        yield item
+
+def to_judge_rows(rows, ignore_list=IGNORE_LIST) -> Iterator[dict]:
+    """シートの行を判定対象の行にする (excel.html の processJsonArray と同じ変換)"""
+    for index, row in enumerate(rows):
+        if row.get("回答") in ignore_list:
+            continue
+        yield {
+            "行番号": index + 2,
+            "検索カテゴリ": row.get("カテゴリ"),
+            "検索要件": row.get("要件"),
+        }
+
+async def spool_request(request, suffix=".xlsx"):
+    """リクエストボディを一時ファイルへ書き出す (zip の読み込みにはシークが必要なため)"""
+    fd, path = tempfile.mkstemp(suffix=suffix)
+    try:
+        with os.fdopen(fd, "wb") as f:
+            async for chunk in request.stream():
+                f.write(chunk)
+    except Exception:
+        os.remove(path)
+        raise
+    return path
@@ -0,0 +1,134 @@
+# XLSX のストリーミング書き出し
+# 行を受け取るたびにシートXMLへ直接書き込み、行数に関係なくメモリを一定に保つ
+import re
+import zipfile
+from xml.sax.saxutils import escape
+
+# XMLに含められない制御文字
+_ILLEGAL_XML = re.compile(r"[\x00-\x08\x0b\x0c\x0e-\x1f]")
+
+CONTENT_TYPES = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+    '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+    '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+    '<Default Extension="xml" ContentType="application/xml"/>'
+    '<Override PartName="/xl/workbook.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet.main+xml"/>'
+    '<Override PartName="/xl/worksheets/sheet1.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml"/>'
+    '<Override PartName="/xl/styles.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.styles+xml"/>'
+    '</Types>'
+)
+
+ROOT_RELS = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+    '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+    '<Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument" Target="xl/workbook.xml"/>'
+    '</Relationships>'
+)
+
+WORKBOOK_RELS = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+    '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+    '<Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/worksheet" Target="worksheets/sheet1.xml"/>'
+    '<Relationship Id="rId2" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/styles" Target="styles.xml"/>'
+    '</Relationships>'
+)
+
+def column_letters(index):
+    """0始まりの列番号を列記号 (A, B, ..., AA) にする"""
+    letters = ""
+    index += 1
+    while index:
+        index, rem = divmod(index - 1, 26)
+        letters = chr(65 + rem) + letters
+    return letters
+
+def cell_ref(row, col):
+    return f"{column_letters(col)}{row + 1}"
+
+def _styles_xml(fill_colors):
+    # スタイル0は標準、1以降は fill_colors の順に塗りつぶし+太字
+    fills = '<fill><patternFill patternType="none"/></fill><fill><patternFill patternType="gray125"/></fill>'
+    for color in fill_colors:
+        fills += f'<fill><patternFill patternType="solid"><fgColor rgb="FF{color}"/></patternFill></fill>'
+    xfs = '<xf numFmtId="0" fontId="0" fillId="0" borderId="0" xfId="0"/>'
+    for i in range(len(fill_colors)):
+        xfs += f'<xf numFmtId="0" fontId="1" fillId="{i + 2}" borderId="0" xfId="0" applyFont="1" applyFill="1"/>'
+    return (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+        '<styleSheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main">'
+        '<fonts count="2"><font><sz val="11"/><name val="Calibri"/></font>'
+        '<font><b/><sz val="11"/><name val="Calibri"/></font></fonts>'
+        f'<fills count="{len(fill_colors) + 2}">{fills}</fills>'
+        '<borders count="1"><border><left/><right/><top/><bottom/><diagonal/></border></borders>'
+        '<cellStyleXfs count="1"><xf numFmtId="0" fontId="0" fillId="0" borderId="0"/></cellStyleXfs>'
+        f'<cellXfs count="{len(fill_colors) + 1}">{xfs}</cellXfs>'
+        '</styleSheet>'
+    )
+
+class XlsxStreamWriter:
+    """1シートのXLSXを行単位で書き出す
+
+    文字列はインライン文字列で書くため共有文字列表を持たない。
+    セル結合はシートXMLの末尾に書くため、生成時に渡しておく。
+    """
+
+    def __init__(self, fileobj, sheet_name="Sheet1", merges=(), fill_colors=()):
+        self.zf = zipfile.ZipFile(fileobj, "w", compression=zipfile.ZIP_DEFLATED)
+        self.merges = list(merges)
+        self.rows = 0
+        self.zf.writestr("[Content_Types].xml", CONTENT_TYPES)
+        self.zf.writestr("_rels/.rels", ROOT_RELS)
+        self.zf.writestr("xl/_rels/workbook.xml.rels", WORKBOOK_RELS)
+        self.zf.writestr("xl/styles.xml", _styles_xml(list(fill_colors)))
+        self.zf.writestr(
+            "xl/workbook.xml",
+            '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+            '<workbook xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main" '
+            'xmlns:r="http://schemas.openxmlformats.org/officeDocument/2006/relationships">'
+            f'<sheets><sheet name="{escape(sheet_name, {chr(34): "&quot;"})}" sheetId="1" r:id="rId1"/></sheets>'
+            '</workbook>'
+        )
+        # シートは最後に開き、close まで書き続ける
+        self.sheet = self.zf.open("xl/worksheets/sheet1.xml", "w", force_zip64=True)
+        self._write(
+            '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+            '<worksheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main">'
+            '<sheetData>'
+        )
+
+    def _write(self, text):
+        self.sheet.write(text.encode("utf-8"))
+
+    @staticmethod
+    def _cell(ref, value, style):
+        s = f' s="{style}"' if style else ""
+        if isinstance(value, bool):
+            return f'<c r="{ref}" t="b"{s}><v>{int(value)}</v></c>'
+        if isinstance(value, (int, float)):
+            return f'<c r="{ref}"{s}><v>{value}</v></c>'
+        text = escape(_ILLEGAL_XML.sub("", str(value)))
+        return f'<c r="{ref}" t="inlineStr"{s}><is><t xml:space="preserve">{text}</t></is></c>'
+
+    def write_row(self, values, styles=None):
+        """1行を書き込む (None のセルは書かない)。styles は列ごとのスタイル番号"""
+        r = self.rows
+        cells = []
+        for col, value in enumerate(values):
+            style = styles[col] if styles and col < len(styles) else 0
+            if value is None and not style:
+                continue
+            cells.append(self._cell(cell_ref(r, col), "" if value is None else value, style))
+        self._write(f'<row r="{r + 1}">{"".join(cells)}</row>')
+        self.rows += 1
+
+    def close(self):
+        self._write("</sheetData>")
+        if self.merges:
+            refs = "".join(
+                f'<mergeCell ref="{cell_ref(*start)}:{cell_ref(*end)}"/>'
+                for start, end in self.merges
+            )
+            self._write(f'<mergeCells count="{len(self.merges)}">{refs}</mergeCells>')
+        self._write("</worksheet>")
+        self.sheet.close()
+        self.zf.close()